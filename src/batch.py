@@ -0,0 +1,251 @@
+import numpy as np
+from scipy.stats import norm, gamma
+
+from grubbs_test import grubbs_critical_value
+from yn_sigman import yn_sigman_values
+from k_coefficient import DISTRIBUTIONS, RETURN_PERIODS
+from disaggregation_coef import disaggregation_coef
+
+# Constants
+MIN_SAMPLE_SIZE = 3
+LOG_DISTRIBUTIONS = ("log_normal", "log_pearson")
+
+
+def masked_moments(values, mask):
+    """Return the sample size, mean and standard deviation (ddof=1) of every row,
+    considering only the entries where 'mask' is True."""
+    sample_size = mask.sum(axis=1)
+    filled = np.where(mask, values, 0.0)
+    mean = filled.sum(axis=1) / sample_size
+    deviation = np.where(mask, values - mean[:, None], 0.0)
+    std = np.sqrt((deviation ** 2).sum(axis=1) / (sample_size - 1))
+    return sample_size, mean, std
+
+
+def masked_skew(values, mask, sample_size, mean, std):
+    """Return the skewness coefficient used by 'distributions.params_calculation' for every row."""
+    standardized = np.where(mask, (values - mean[:, None]) / std[:, None], 0.0)
+    return (sample_size / ((sample_size - 1) * (sample_size - 2))) * (standardized ** 3).sum(axis=1)
+
+
+def masked_r2(observed, estimated, mask):
+    """Return the squared Pearson correlation of every row, considering only the masked entries."""
+    sample_size = mask.sum(axis=1)
+    observed_mean = np.where(mask, observed, 0.0).sum(axis=1) / sample_size
+    estimated_mean = np.where(mask, estimated, 0.0).sum(axis=1) / sample_size
+    observed_dev = np.where(mask, observed - observed_mean[:, None], 0.0)
+    estimated_dev = np.where(mask, estimated - estimated_mean[:, None], 0.0)
+    covariance = (observed_dev * estimated_dev).sum(axis=1)
+    r = covariance / np.sqrt((observed_dev ** 2).sum(axis=1) * (estimated_dev ** 2).sum(axis=1))
+    return r ** 2
+
+
+def batch_outlier_test(values, mask):
+    """Apply the Grubbs and Grubbs and Beck tests of 'outlier_test' to every row.
+    The critical values do not change while outliers are removed, so removing the largest
+    (smallest) value while it is an outlier is the same as removing every value beyond
+    both upper (lower) limits at once.
+    Args:
+        values (ndarray): Annual maxima, stations x years.
+        mask (ndarray): True where 'values' holds an annual maximum.
+    Returns:
+        ndarray: The mask without the outliers.
+    """
+    sample_size, mean, std = masked_moments(values, mask)
+    ln_values = np.log(np.where(mask, values, 1.0))
+    _, ln_mean, ln_std = masked_moments(ln_values, mask)
+
+    t_crit_10 = grubbs_critical_value(np.maximum(sample_size, MIN_SAMPLE_SIZE))
+    k_n_10 = -3.62201 + 6.28446*(sample_size**0.25) - 2.49835*(
+        sample_size**0.5) + 0.491436*(sample_size**0.75) - 0.037911*sample_size
+    x_h = np.exp(ln_mean + k_n_10 * ln_std)
+    x_l = np.exp(ln_mean - k_n_10 * ln_std)
+
+    t_value = (values - mean[:, None]) / std[:, None]
+    high = (t_value > t_crit_10[:, None]) & (values > x_h[:, None])
+    low = (-t_value > t_crit_10[:, None]) & (values < x_l[:, None])
+    return mask & ~high & ~low
+
+
+def sort_descending(values, mask):
+    """Sort every row in descending order, moving the entries outside the mask to the end."""
+    order = np.argsort(np.where(mask, -values, np.inf), axis=1, kind="stable")
+    sorted_values = np.take_along_axis(values, order, axis=1)
+    sorted_mask = np.take_along_axis(mask, order, axis=1)
+    return np.where(sorted_mask, sorted_values, np.nan), sorted_mask
+
+
+def batch_params(sorted_values, sorted_mask):
+    """Compute the parameters of 'distributions.params_calculation' for every row.
+    Returns:
+        dict: Arrays with one value per station, under the same keys as the scalar version.
+    """
+    sample_size, mean, std_dev = masked_moments(sorted_values, sorted_mask)
+    log_values = np.log10(np.where(sorted_mask, sorted_values, 1.0))
+    _, meanw, stdw = masked_moments(log_values, sorted_mask)
+
+    g = masked_skew(sorted_values, sorted_mask, sample_size, mean, std_dev)
+    gw = masked_skew(log_values, sorted_mask, sample_size, meanw, stdw)
+    yn, sigman = yn_sigman_values(np.maximum(sample_size, 1))
+
+    return {
+        "size": sample_size,
+        "mean": mean,
+        "std_dev": std_dev,
+        "g": g,
+        "alpha": 4 / (g * g),
+        "meanw": meanw,
+        "stdw": stdw,
+        "gw": gw,
+        "alphaw": 4 / (gw * gw),
+        "sigman": sigman,
+        "yn": yn
+    }
+
+
+def batch_distribution_quantiles(sorted_mask, params):
+    """Compute the values estimated by each distribution at the empirical plotting
+    positions of 'distributions.exceedence_calculation'.
+    Returns:
+        ndarray: Estimates shaped stations x distributions x years, in the order of 'DISTRIBUTIONS'.
+    """
+    rank = np.arange(1, sorted_mask.shape[1] + 1)
+    F = np.where(sorted_mask, rank / (params["size"][:, None] + 1), 0.5)
+    one_minus_F = 1 - F
+
+    def column(name):
+        return params[name][:, None]
+
+    log_normal = np.power(10, column("meanw") + column("stdw") * norm.ppf(one_minus_F))
+
+    ytr = gamma.ppf(np.where(column("g") > 0, one_minus_F, F), column("alpha"), scale=1)
+    pearson = column("mean") + column("std_dev") * (column("g") / 2) * (ytr - column("alpha"))
+
+    ytrw = gamma.ppf(np.where(column("gw") > 0, one_minus_F, F), column("alphaw"), scale=1)
+    log_pearson = np.power(10, column("meanw") + column("stdw") *
+                           (column("gw") / 2) * (ytrw - column("alphaw")))
+
+    y = -np.log(-np.log(one_minus_F))
+    gumbel_theoretical = column("mean") + column("std_dev") * (0.7797 * y - 0.45)
+    gumbel_finite = column("mean") + column("std_dev") * (y - column("yn")) / column("sigman")
+
+    return np.stack([log_normal, pearson, log_pearson, gumbel_theoretical, gumbel_finite], axis=1)
+
+
+def batch_dist_calculations(sorted_values, sorted_mask, params):
+    """Compute the r2 of every distribution and the one with the largest r2, for every row.
+    Returns:
+        tuple: r2 (stations x distributions, rounded as in 'dist_calculations') and the
+               index of the chosen distribution in 'DISTRIBUTIONS'.
+    """
+    estimates = batch_distribution_quantiles(sorted_mask, params)
+    r2 = np.stack([
+        masked_r2(sorted_values, estimates[:, index], sorted_mask)
+        for index in range(len(DISTRIBUTIONS))
+    ], axis=1).round(4)
+    max_dist = np.argmax(np.nan_to_num(r2, nan=-np.inf), axis=1)
+    return r2, max_dist
+
+
+def batch_k_coefficient(params):
+    """Compute the k coefficient of every distribution and return period for every row.
+    Returns:
+        ndarray: k shaped stations x distributions x return periods, rounded as in 'k_coefficient'.
+    """
+    exceedance = 1 / np.asarray(RETURN_PERIODS)
+    no_exceedance = 1 - exceedance
+
+    def column(name):
+        return params[name][:, None]
+
+    k_log_normal = np.broadcast_to(norm.ppf(no_exceedance), (params["size"].size, exceedance.size))
+
+    ytr = gamma.ppf(np.where(column("g") > 0, no_exceedance, exceedance), column("alpha"), scale=1)
+    k_pearson = (column("g") / 2) * (ytr - column("alpha"))
+
+    ytrw = gamma.ppf(np.where(column("gw") > 0, no_exceedance, exceedance), column("alphaw"), scale=1)
+    k_log_pearson = (column("gw") / 2) * (ytrw - column("alphaw"))
+
+    y = -np.log(-np.log(no_exceedance))
+    k_gumbel_theoretical = np.broadcast_to(0.7797 * y - 0.45, k_log_normal.shape)
+    k_gumbel_finite = (y - column("yn")) / column("sigman")
+
+    return np.stack([k_log_normal, k_pearson, k_log_pearson,
+                     k_gumbel_theoretical, k_gumbel_finite], axis=1).round(4)
+
+
+def batch_rain_intensity_calculations(k, params):
+    """Compute the rainfall intensities of 'ventechow.rain_intensity_calculations' for every
+    row and distribution.
+    Args:
+        k (ndarray): k coefficients, stations x distributions x return periods.
+        params (dict): The output of 'batch_params'.
+    Returns:
+        tuple: The 1-day rainfall (stations x distributions x return periods), the intensities
+               (stations x distributions x return periods x durations, in mm/h) and the
+               duration names.
+    """
+    coefficients, time_interval = disaggregation_coef()
+    log_distribution = np.array([name in LOG_DISTRIBUTIONS for name in DISTRIBUTIONS])[None, :, None]
+
+    def column(name):
+        return params[name][:, None, None]
+
+    one_day = np.where(log_distribution,
+                       np.power(10, column("meanw") + k * column("stdw")),
+                       column("mean") + k * column("std_dev"))
+
+    rain_24h = one_day * coefficients["24h"]
+    factors = np.array([
+        1 / time_interval["24h"] if name == "24h" else coefficients[name] / time_interval[name]
+        for name in time_interval
+    ])
+    intensities = rain_24h[..., None] * factors
+    return one_day, intensities, list(time_interval)
+
+
+def main(values, mask=None):
+    """Run the statistical core of the pipeline (outlier test, distribution fits,
+    k coefficients and rainfall intensities) for many stations at once.
+    Args:
+        values (ndarray): Annual maxima padded to a stations x years matrix.
+        mask (ndarray): True where 'values' holds an annual maximum. Defaults to the
+                        finite, positive entries.
+    Returns:
+        dict: Per-station arrays. 'valid' marks the stations with at least three values
+              left after the outlier test; the results of the other stations are meaningless.
+    """
+    values = np.atleast_2d(np.asarray(values, dtype=float))
+    if mask is None:
+        mask = np.isfinite(values) & (values > 0)
+    mask = np.atleast_2d(np.asarray(mask, dtype=bool)) & np.isfinite(values)
+
+    with np.errstate(divide="ignore", invalid="ignore"):
+        no_outlier_mask = batch_outlier_test(values, mask)
+        sorted_values, sorted_mask = sort_descending(values, no_outlier_mask)
+
+        params = batch_params(sorted_values, sorted_mask)
+        r2, max_dist = batch_dist_calculations(sorted_values, sorted_mask, params)
+        k = batch_k_coefficient(params)
+        one_day, intensities, durations = batch_rain_intensity_calculations(k, params)
+
+    stations = np.arange(values.shape[0])
+    valid = params["size"] >= MIN_SAMPLE_SIZE
+
+    return {
+        "valid": valid,
+        "sample_size": params["size"],
+        "outliers": mask.sum(axis=1) - params["size"],
+        "mask": no_outlier_mask,
+        "params": params,
+        "distributions": DISTRIBUTIONS,
+        "r2": r2,
+        "max_dist": max_dist,
+        "return_periods": np.asarray(RETURN_PERIODS),
+        "durations": durations,
+        "k": k,
+        "one_day": one_day,
+        "intensities": intensities,
+        "selected_one_day": one_day[stations, max_dist],
+        "selected_intensities": intensities[stations, max_dist]
+    }
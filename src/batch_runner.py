@@ -0,0 +1,188 @@
+import argparse
+import glob
+import json
+import os
+import time
+from concurrent.futures import FIRST_COMPLETED, ProcessPoolExecutor, wait
+
+import numpy as np
+
+from main import configure_logging, main as idf_pipeline
+from serialization import to_json
+from station_archive import open_archive
+
+# Constants
+# Tasks submitted per worker ahead of the results, so huge runs do not queue every file at once
+TASKS_PER_WORKER = 4
+RUN_OPTIONS = ("distribution", "models", "grouping", "window", "timeout")
+
+
+def collect_sources(paths=(), manifest=None, archive=None):
+    """List the inputs of a run as (source, station_code) pairs, in a stable order.
+    Args:
+        paths (list): CSV files, or directories searched recursively for CSV files.
+        manifest (str): File with one CSV path per line, relative to the manifest unless
+                        absolute; blank lines and lines starting with '#' are skipped.
+        archive (str): Station archive whose stations are all processed.
+    """
+    csv_paths = []
+    for path in paths:
+        if os.path.isdir(path):
+            csv_paths.extend(sorted(glob.glob(os.path.join(path, "**", "*.csv"), recursive=True)))
+        else:
+            csv_paths.append(path)
+    if manifest:
+        with open(manifest, encoding="utf-8") as manifest_file:
+            csv_paths.extend(os.path.join(os.path.dirname(manifest), line.strip()) for line in manifest_file
+                             if line.strip() and not line.startswith("#"))
+
+    sources = [(os.path.abspath(path), None) for path in csv_paths]
+    if archive:
+        sources.extend((os.path.abspath(archive), code) for code in open_archive(archive)["stations"])
+    return list(dict.fromkeys(sources))
+
+
+def read_checkpoint(output_path, retry_failed=False):
+    """Return the sources already recorded in an output file, so they are not processed
+    again. A line cut short by an interrupted run is removed from the file.
+    Args:
+        retry_failed (bool): Leave out the sources whose line records an error.
+    Returns:
+        set: The completed (source, station_code) pairs.
+    """
+    done = set()
+    if not os.path.exists(output_path):
+        return done
+
+    complete_size = 0
+    with open(output_path, "rb") as output_file:
+        for line in output_file:
+            try:
+                record = json.loads(line)
+            except ValueError:
+                break
+            if not line.endswith(b"\n"):
+                break
+            complete_size += len(line)
+            if not (retry_failed and record["status"] == "error"):
+                done.add((record["source"], record["station_code"]))
+
+    if complete_size != os.path.getsize(output_path):
+        print(f"Removing an incomplete last line from {output_path}")
+        with open(output_path, "r+b") as output_file:
+            output_file.truncate(complete_size)
+    return done
+
+
+def process_source(source, station_code=None, options=None):
+    """Run the pipeline on one input; this runs in the worker processes.
+    Returns:
+        tuple: The status ('ok', 'rejected' when the pipeline returned a message, or 'error'),
+               the elapsed time and the NDJSON line of the result.
+    """
+    start = time.perf_counter()
+    try:
+        output = idf_pipeline(source, station_code=station_code, **(options or {}))
+        if isinstance(output, dict):
+            status, result = "ok", {"output": output}
+        else:
+            status, result = "rejected", {"message": json.loads(output) if output else None}
+    except Exception as e:
+        status, result = "error", {"message": f"{type(e).__name__}: {e}"}
+    elapsed = time.perf_counter() - start
+
+    line = to_json({"source": source, "station_code": station_code, "status": status,
+                    "elapsed": round(elapsed, 4), **result})
+    return status, elapsed, line + b"\n"
+
+
+def summarize(counts, times, skipped, elapsed, interrupted):
+    """Build the summary of a run from the status counts and the time of every input."""
+    times = np.array(times)
+    processed = int(times.size)
+    return {
+        "processed": processed,
+        "skipped": skipped,
+        **counts,
+        "interrupted": interrupted,
+        "elapsed": round(elapsed, 3),
+        "stations_per_second": round(processed / elapsed, 3) if elapsed else None,
+        "station_time": {
+            "mean": round(float(times.mean()), 4),
+            "p50": round(float(np.percentile(times, 50)), 4),
+            "p95": round(float(np.percentile(times, 95)), 4),
+            "max": round(float(times.max()), 4)
+        } if processed else None
+    }
+
+
+def main(sources, output_path, workers=None, options=None, retry_failed=False):
+    """Process many stations in parallel, appending one NDJSON line per station to
+    'output_path' as soon as it finishes. The output file is also the checkpoint:
+    stations already in it are skipped, so an interrupted run is resumed by running the
+    same command again.
+    Args:
+        sources (list): (source, station_code) pairs from 'collect_sources'.
+        output_path (str): The NDJSON file.
+        workers (int): Number of processes.
+        options (dict): Keyword arguments of 'main.main' for every station.
+        retry_failed (bool): Process again the stations recorded with an error.
+    Returns:
+        dict: The summary of the run.
+    """
+    workers = workers or os.cpu_count() or 1
+    done = read_checkpoint(output_path, retry_failed)
+    skipped = sum(source in done for source in sources)
+    pending = iter([source for source in sources if source not in done])
+
+    counts = {"ok": 0, "rejected": 0, "error": 0}
+    times = []
+    interrupted = False
+    start = time.perf_counter()
+    with open(output_path, "ab") as output_file, ProcessPoolExecutor(max_workers=workers) as executor:
+        running = set()
+        try:
+            while True:
+                while len(running) < workers * TASKS_PER_WORKER:
+                    source = next(pending, None)
+                    if source is None:
+                        break
+                    running.add(executor.submit(process_source, *source, options))
+                if not running:
+                    break
+                finished, running = wait(running, return_when=FIRST_COMPLETED)
+                for future in finished:
+                    status, elapsed, line = future.result()
+                    output_file.write(line)
+                    output_file.flush()
+                    counts[status] += 1
+                    times.append(elapsed)
+        except KeyboardInterrupt:
+            # Stations still running are not recorded and run again on resume
+            interrupted = True
+            executor.shutdown(wait=False, cancel_futures=True)
+
+    return summarize(counts, times, skipped, time.perf_counter() - start, interrupted)
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(
+        description="Run the IDF pipeline over many stations, streaming NDJSON results and resuming interrupted runs.")
+    parser.add_argument("output", help="NDJSON file the results are appended to")
+    parser.add_argument("paths", nargs="*", help="CSV files or directories containing them")
+    parser.add_argument("--manifest", help="File listing one CSV path per line")
+    parser.add_argument("--archive", help="Station archive to process every station of")
+    parser.add_argument("--workers", type=int, default=None)
+    parser.add_argument("--retry-failed", action="store_true", help="Process again the stations that failed")
+    parser.add_argument("--distribution")
+    parser.add_argument("--models", type=lambda value: value.split(","))
+    parser.add_argument("--grouping", choices=["season", "month"])
+    parser.add_argument("--window", type=int)
+    parser.add_argument("--timeout", type=float)
+    args = parser.parse_args()
+    configure_logging()
+
+    run_options = {option: getattr(args, option) for option in RUN_OPTIONS if getattr(args, option) is not None}
+    summary = main(collect_sources(args.paths, args.manifest, args.archive), args.output, args.workers,
+                   run_options, args.retry_failed)
+    print(json.dumps(summary, indent=2))
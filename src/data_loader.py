@@ -0,0 +1,84 @@
+import unicodedata
+
+import pandas as pd
+
+# Constants
+HEADER_LINES = 12
+
+# Normalized HidroWeb header keys and the station metadata field they fill
+HEADER_FIELDS = {
+    "codigo da estacao": "code",
+    "codigo": "code",
+    "nome da estacao": "name",
+    "estacao": "name",
+    "nome": "name",
+    "latitude": "latitude",
+    "longitude": "longitude",
+    "altitude": "altitude",
+    "municipio": "city",
+    "estado": "state",
+    "bacia": "basin"
+}
+NUMERIC_FIELDS = ("latitude", "longitude", "altitude")
+
+
+def normalize_key(key):
+    """Lowercase a header key and strip its accents."""
+    decomposed = unicodedata.normalize("NFKD", key.strip().lower())
+    return "".join(char for char in decomposed if not unicodedata.combining(char))
+
+
+def parse_header(lines):
+    """Parse the station metadata from the HidroWeb header lines.
+    Args:
+        lines (list): The lines before the column names.
+    Returns:
+        dict: The 'code', 'name', 'latitude', 'longitude' and 'altitude' of the station, plus
+              any other known field found. Missing fields are None.
+    """
+    station = {"code": None, "name": None, "latitude": None, "longitude": None, "altitude": None}
+    for line in lines:
+        key, separator, value = line.partition(":")
+        field = HEADER_FIELDS.get(normalize_key(key))
+        # Legend lines such as 'NivelConsistencia: 1 = Bruto' are not metadata
+        if not separator or field is None or "=" in value:
+            continue
+        value = value.strip()
+        if field in NUMERIC_FIELDS:
+            try:
+                value = float(value.replace(",", "."))
+            except ValueError:
+                value = None
+        station[field] = value or None
+    return station
+
+
+def load_data(csv_file_path):
+    """Function to load the required data for further analysis.
+    The header lines are parsed for the station metadata in the same pass.
+    Returns:
+        tuple: The data and the station metadata dictionary, or None when the file cannot be read.
+    """
+    try:
+        with open(csv_file_path, encoding='ISO 8859-1') as csv_file:
+            header = [csv_file.readline() for _ in range(HEADER_LINES)]
+            input_data = pd.read_csv(csv_file, sep=";", decimal=",",
+                                     usecols=["NivelConsistencia", "Data", "Maxima"], index_col=False)
+
+        # Check if the necessary columns are present
+        required_columns = ["NivelConsistencia", "Data", "Maxima"]
+        if not all(column in input_data.columns for column in required_columns):
+            print(
+                f"CSV file {csv_file_path} does not have the required columns")
+            return None
+
+        return input_data, parse_header(header)
+    except FileNotFoundError:
+        print(f"File {csv_file_path} not found")
+        return None
+    except pd.errors.ParserError:
+        print(f"Error parsing CSV file {csv_file_path}")
+        return None
+    except Exception as e:
+        print(f"Unexpected error reading CSV file {csv_file_path}: {e}")
+        return None
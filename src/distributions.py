@@ -1,6 +1,8 @@
 import numpy as np
 from scipy.stats import norm, stats, gamma
 
+from yn_sigman import yn_sigman_values
+
 
 def exceedence_calculation(df, sample_size):
     """Calculate exceedence for the given dataframe."""
@@ -41,11 +43,9 @@ def params_calculation(df, yn, sigmaN, sample_size):
     return params
 
 
-def yn_sigman_calculation(yn_table, sigman_table, sample_size):
-    """Function to get 'sigmaN' and 'YN' values from
-    the dataframe based on the sample size."""
-    yn = yn_table[sample_size]
-    sigman = sigman_table[sample_size]
+def yn_sigman_calculation(sample_size):
+    """Function to get 'sigmaN' and 'YN' values based on the sample size."""
+    yn, sigman = yn_sigman_values(sample_size)
     return yn, sigman
 
 
@@ -109,6 +109,8 @@ def dist_gumbel_theoretical(df, params):
 
 def dist_gumbel_finite(df, params):
     """Function to calculate r2 for the finite Gumbel distribution."""
+    if "y" not in df.columns:
+        df["y"] = df["one_minus_F"].apply(lambda x: -np.log(-np.log(x)))
     df["KG_F"] = (df["y"] - params["yn"]) / params["sigman"]
     df["P_gumbel_finite"] = params["mean"] + params["std_dev"] * df["KG_F"]
 
@@ -119,44 +121,42 @@ def dist_gumbel_finite(df, params):
     return r2_gumbel_finite.round(4)
 
 
-def dist_calculations(no_oulier_data, params):
-    """Function to perform various distribution calculations."""
-
-    r2_log_normal = dist_log_normal(no_oulier_data, params)
-
-    r2_pearson = dist_pearson(no_oulier_data, params)
+DISTRIBUTION_FITS = {
+    "log_normal": dist_log_normal,
+    "pearson": dist_pearson,
+    "log_pearson": dist_log_pearson,
+    "gumbel_theoretical": dist_gumbel_theoretical,
+    "gumbel_finite": dist_gumbel_finite
+}
 
-    r2_log_pearson = dist_log_pearson(no_oulier_data, params)
 
-    r2_gumbel_theo = dist_gumbel_theoretical(no_oulier_data, params)
-
-    r2_gumbel_finite = dist_gumbel_finite(no_oulier_data, params)
+def dist_calculations(no_oulier_data, params):
+    """Function to perform various distribution calculations.
+    The fits run serially, in the order of 'DISTRIBUTION_FITS', and add their columns to
+    the dataframe; on a few dozen rows each takes well under a millisecond, less than
+    handing it to a worker thread."""
 
-    distributions_r2 = {
-        "log_normal": r2_log_normal,
-        "pearson": r2_pearson,
-        "log_pearson": r2_log_pearson,
-        "gumbel_theoretical": r2_gumbel_theo,
-        "gumbel_finite": r2_gumbel_finite
-    }
+    distributions_r2 = {dist_name: dist_function(no_oulier_data, params)
+                        for dist_name, dist_function in DISTRIBUTION_FITS.items()}
 
     max_dist = max(distributions_r2, key=distributions_r2.get)
     max_r2 = distributions_r2[max_dist]
 
     dist_r2 = {"max_dist": max_dist,
-               "max_value_r2": max_r2}
+               "max_value_r2": max_r2,
+               "r2": distributions_r2}
 
     return no_oulier_data, dist_r2
 
 
-def main(no_oulier_data, yn_table, sigman_table):
+def main(no_oulier_data):
     """Main function to perform various calculations."""
 
     sample_size = len(no_oulier_data)
 
     distribuitions_df = exceedence_calculation(no_oulier_data, sample_size)
 
-    yn, sigmaN = yn_sigman_calculation(yn_table, sigman_table, sample_size)
+    yn, sigmaN = yn_sigman_calculation(sample_size)
 
     params = params_calculation(distribuitions_df, yn, sigmaN, sample_size)
 
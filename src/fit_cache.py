@@ -0,0 +1,87 @@
+import copy
+import hashlib
+import os
+import threading
+from collections import OrderedDict
+
+import numpy as np
+
+# Constants
+FIT_CACHE_SIZE = int(os.environ.get("IDF_FIT_CACHE_SIZE", 128))
+
+_cache = OrderedDict()
+# Fingerprint of the latest fit of each station code, and the station codes of each
+# cached fingerprint, so the stations leave with the fits they point to
+_stations = {}
+_key_stations = {}
+_lock = threading.Lock()
+_stats = {"hits": 0, "misses": 0, "evictions": 0, "replacements": 0}
+
+
+def fingerprint(no_outlier_data):
+    """Return a hash of the cleaned annual maxima, independent of their row order.
+    Args:
+        no_outlier_data (DataFrame): The annual maxima after the outlier test.
+    Returns:
+        str: Hexadecimal digest identifying the 'Pmax_anual' sample.
+    """
+    values = np.sort(no_outlier_data["Pmax_anual"].to_numpy(dtype=np.float64))
+    return hashlib.blake2b(np.ascontiguousarray(values).tobytes(), digest_size=16).hexdigest()
+
+
+def get(key):
+    """Return a copy of the cached fit for the given fingerprint, or None on a miss."""
+    with _lock:
+        entry = _cache.get(key)
+        if entry is None:
+            _stats["misses"] += 1
+            return None
+        _cache.move_to_end(key)
+        _stats["hits"] += 1
+    return copy.deepcopy(entry)
+
+
+def _drop(key):
+    """Remove a fit and the stations pointing to it; called with the lock held."""
+    del _cache[key]
+    for station_code in _key_stations.pop(key, ()):
+        if _stations.get(station_code) == key:
+            del _stations[station_code]
+
+
+def put(key, entry, station_code=None):
+    """Store a fit under the given fingerprint, evicting the least recently used entries.
+    When the station code is given, the previous fit of the station is dropped if its data
+    changed, so updated series do not leave stale fits behind."""
+    if FIT_CACHE_SIZE <= 0:
+        return
+    entry = copy.deepcopy(entry)
+    with _lock:
+        if station_code is not None:
+            previous_key = _stations.get(station_code)
+            if previous_key is not None and previous_key != key and previous_key in _cache:
+                _drop(previous_key)
+                _stats["replacements"] += 1
+            _stations[station_code] = key
+            _key_stations.setdefault(key, set()).add(station_code)
+        _cache[key] = entry
+        _cache.move_to_end(key)
+        while len(_cache) > FIT_CACHE_SIZE:
+            _drop(next(iter(_cache)))
+            _stats["evictions"] += 1
+
+
+def stats():
+    """Return the cache counters together with its current and maximum size."""
+    with _lock:
+        return {**_stats, "size": len(_cache), "max_size": FIT_CACHE_SIZE, "stations": len(_stations)}
+
+
+def clear():
+    """Remove every cached fit and reset the counters."""
+    with _lock:
+        _cache.clear()
+        _stations.clear()
+        _key_stations.clear()
+        for name in _stats:
+            _stats[name] = 0
@@ -1,7 +1,19 @@
 from google.cloud import storage
 
-# Create a Cloud Storage client
-storage_client = storage.Client()
+# Cloud Storage client, created on first use
+_storage_client = {"client": None}
+
+def get_storage_client():
+    """Return the Cloud Storage client, creating it on the first call so that importing
+    this module needs no credentials."""
+    if _storage_client["client"] is None:
+        _storage_client["client"] = storage.Client()
+    return _storage_client["client"]
+
+def set_storage_client(client):
+    """Replace the Cloud Storage client, e.g. with an in-process stand-in that has the same
+    'bucket(name).blob(name)' interface. None restores the default client."""
+    _storage_client["client"] = client
 
 def get_bucket_and_blob(gcs_url):
     """Parse a GCS URL into (bucket, blob)."""
@@ -12,7 +24,7 @@ def get_bucket_and_blob(gcs_url):
     bucket_name, blob_name = gcs_url.split('/', 1)
 
     # Get the bucket and blob
-    bucket = storage_client.bucket(bucket_name)
+    bucket = get_storage_client().bucket(bucket_name)
     blob = bucket.blob(blob_name)
 
     return bucket, blob
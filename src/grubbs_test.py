@@ -1,151 +1,58 @@
-def grubbs_test_table():
-    """The dictionary containing the Grubbs' Test values."""
-    data = {
-        3: 1.148,
-        4: 1.425,
-        5: 1.602,
-        6: 1.729,
-        7: 1.828,
-        8: 1.909,
-        9: 1.977,
-        10: 2.036,
-        11: 2.088,
-        12: 2.134,
-        13: 2.175,
-        14: 2.213,
-        15: 2.247,
-        16: 2.279,
-        17: 2.309,
-        18: 2.335,
-        19: 2.361,
-        20: 2.385,
-        21: 2.408,
-        22: 2.429,
-        23: 2.448,
-        24: 2.467,
-        25: 2.486,
-        26: 2.502,
-        27: 2.519,
-        28: 2.534,
-        29: 2.549,
-        30: 2.563,
-        31: 2.577,
-        32: 2.591,
-        33: 2.604,
-        34: 2.616,
-        35: 2.628,
-        36: 2.639,
-        37: 2.650,
-        38: 2.661,
-        39: 2.671,
-        40: 2.682,
-        41: 2.692,
-        42: 2.700,
-        43: 2.710,
-        44: 2.719,
-        45: 2.727,
-        46: 2.736,
-        47: 2.744,
-        48: 2.753,
-        49: 2.760,
-        50: 2.768,
-        51: 2.775,
-        52: 2.783,
-        53: 2.790,
-        54: 2.798,
-        55: 2.804,
-        56: 2.811,
-        57: 2.818,
-        58: 2.824,
-        59: 2.831,
-        60: 2.837,
-        61: 2.842,
-        62: 2.849,
-        63: 2.854,
-        64: 2.860,
-        65: 2.866,
-        66: 2.871,
-        67: 2.877,
-        68: 2.883,
-        69: 2.888,
-        70: 2.893,
-        71: 2.897,
-        72: 2.903,
-        73: 2.908,
-        74: 2.912,
-        75: 2.917,
-        76: 2.922,
-        77: 2.927,
-        78: 2.931,
-        79: 2.935,
-        80: 2.940,
-        81: 2.945,
-        82: 2.949,
-        83: 2.953,
-        84: 2.957,
-        85: 2.961,
-        86: 2.966,
-        87: 2.970,
-        88: 2.973,
-        89: 2.977,
-        90: 2.981,
-        91: 2.984,
-        92: 2.989,
-        93: 2.993,
-        94: 2.996,
-        95: 3.000,
-        96: 3.003,
-        97: 3.006,
-        98: 3.011,
-        99: 3.014,
-        100: 3.017,
-        101: 3.021,
-        102: 3.024,
-        103: 3.027,
-        104: 3.030,
-        105: 3.033,
-        106: 3.037,
-        107: 3.040,
-        108: 3.043,
-        109: 3.046,
-        110: 3.049,
-        111: 3.052,
-        112: 3.055,
-        113: 3.058,
-        114: 3.061,
-        115: 3.064,
-        116: 3.067,
-        117: 3.070,
-        118: 3.073,
-        119: 3.075,
-        120: 3.078,
-        121: 3.081,
-        122: 3.083,
-        123: 3.086,
-        124: 3.089,
-        125: 3.092,
-        126: 3.095,
-        127: 3.097,
-        128: 3.100,
-        129: 3.102,
-        130: 3.104,
-        131: 3.107,
-        132: 3.109,
-        133: 3.112,
-        134: 3.114,
-        135: 3.116,
-        136: 3.119,
-        137: 3.122,
-        138: 3.124,
-        139: 3.126,
-        140: 3.129,
-        141: 3.131,
-        142: 3.133,
-        143: 3.135,
-        144: 3.138,
-        145: 3.140,
-        146: 3.142,
-        147: 3.144
-    }
+import numpy as np
+from scipy.stats import t
+
+# Critical values of the Grubbs' Test (one-sided, 10% significance) indexed by
+# the sample size, ten values per line
+GRUBBS_TEST_VALUES = np.array([
+    np.nan, np.nan, np.nan, 1.148, 1.425, 1.602, 1.729, 1.828, 1.909, 1.977,
+    2.036, 2.088, 2.134, 2.175, 2.213, 2.247, 2.279, 2.309, 2.335, 2.361,
+    2.385, 2.408, 2.429, 2.448, 2.467, 2.486, 2.502, 2.519, 2.534, 2.549,
+    2.563, 2.577, 2.591, 2.604, 2.616, 2.628, 2.639, 2.650, 2.661, 2.671,
+    2.682, 2.692, 2.700, 2.710, 2.719, 2.727, 2.736, 2.744, 2.753, 2.760,
+    2.768, 2.775, 2.783, 2.790, 2.798, 2.804, 2.811, 2.818, 2.824, 2.831,
+    2.837, 2.842, 2.849, 2.854, 2.860, 2.866, 2.871, 2.877, 2.883, 2.888,
+    2.893, 2.897, 2.903, 2.908, 2.912, 2.917, 2.922, 2.927, 2.931, 2.935,
+    2.940, 2.945, 2.949, 2.953, 2.957, 2.961, 2.966, 2.970, 2.973, 2.977,
+    2.981, 2.984, 2.989, 2.993, 2.996, 3.000, 3.003, 3.006, 3.011, 3.014,
+    3.017, 3.021, 3.024, 3.027, 3.030, 3.033, 3.037, 3.040, 3.043, 3.046,
+    3.049, 3.052, 3.055, 3.058, 3.061, 3.064, 3.067, 3.070, 3.073, 3.075,
+    3.078, 3.081, 3.083, 3.086, 3.089, 3.092, 3.095, 3.097, 3.100, 3.102,
+    3.104, 3.107, 3.109, 3.112, 3.114, 3.116, 3.119, 3.122, 3.124, 3.126,
+    3.129, 3.131, 3.133, 3.135, 3.138, 3.140, 3.142, 3.144
+])
+GRUBBS_TABULATED_SIZE = GRUBBS_TEST_VALUES.size - 1
+GRUBBS_SIGNIFICANCE = 0.10
+
+
+def grubbs_formula(sample_size):
+    """Critical value of the one-sided Grubbs' Test from the Student's t quantile."""
+    sample_size = np.asarray(sample_size, dtype=float)
+    t_value = t.ppf(1 - GRUBBS_SIGNIFICANCE / sample_size, sample_size - 2)
+    return (sample_size - 1) / np.sqrt(sample_size) * \
+        np.sqrt(t_value ** 2 / (sample_size - 2 + t_value ** 2))
+
+
+# Offset that makes the formula continuous with the last tabulated value
+GRUBBS_FORMULA_OFFSET = GRUBBS_TEST_VALUES[-1] - grubbs_formula(GRUBBS_TABULATED_SIZE)
+
+
+def grubbs_critical_value(sample_size):
+    """Return the Grubbs' Test critical value for a sample size or an array of sample sizes.
+    Sizes up to 147 come from the table; larger ones from the t-distribution formula,
+    shifted to continue the table.
+    Args:
+        sample_size (int or array): The size of the sample(s), at least 3.
+    Returns:
+        float or array: The critical value(s).
+    """
+    sizes = np.asarray(sample_size)
+    if np.any(sizes < 3):
+        raise ValueError("The Grubbs' Test requires at least 3 values.")
+
+    tabulated = sizes <= GRUBBS_TABULATED_SIZE
+    if np.all(tabulated):
+        return GRUBBS_TEST_VALUES[sizes]
+
+    values = GRUBBS_TEST_VALUES[np.where(tabulated, sizes, 3)]
+    return np.where(tabulated, values, grubbs_formula(sizes) + GRUBBS_FORMULA_OFFSET)
 
-    return data
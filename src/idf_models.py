@@ -0,0 +1,240 @@
+import time
+from functools import partial
+
+import numpy as np
+from scipy.optimize import minimize
+
+from scheduler import CPU_EXECUTOR, run_graph
+
+# Constants
+# Durations up to this value (in minutes) use the first Ven Te Chow parameters, longer ones the second
+SPLIT_DURATION = 60
+MAX_FUNCTION_EVALUATIONS = 3000
+# Values of c scanned by 'log_linear_initial_guess'
+C_GRID = np.arange(0, 100.5, 0.5)
+
+
+def ven_te_chow_intensity(parameters, tr, td):
+    """i = k * Tr^m / (td + c)^n and its derivatives with respect to (k, m, c, n)."""
+    k, m, c, n = parameters
+    base = td + c
+    intensity = k * tr ** m / base ** n
+    jacobian = np.stack([intensity / k, intensity * np.log(tr), -n * intensity / base, -intensity * np.log(base)])
+    return intensity, jacobian
+
+
+def talbot_intensity(parameters, tr, td):
+    """i = k * Tr^m / (td + c) and its derivatives with respect to (k, m, c)."""
+    k, m, c = parameters
+    base = td + c
+    intensity = k * tr ** m / base
+    jacobian = np.stack([intensity / k, intensity * np.log(tr), -intensity / base])
+    return intensity, jacobian
+
+
+def bernard_intensity(parameters, tr, td):
+    """i = k * Tr^m / td^n and its derivatives with respect to (k, m, n)."""
+    k, m, n = parameters
+    intensity = k * tr ** m / td ** n
+    jacobian = np.stack([intensity / k, intensity * np.log(tr), -intensity * np.log(td)])
+    return intensity, jacobian
+
+
+def log_linear_initial_guess(tr, td, i_real, c_grid=C_GRID):
+    """Starting point for fitting i = k * Tr^m / (td + c)^n.
+    For a fixed c the model is linear in logs, log i = log k + m*log Tr - n*log(td + c),
+    so the least squares (log k, m, n) of every c in the grid come from one batched solve
+    of the normal equations. The c with the smallest summed relative error is returned.
+    'i_real' may also hold many series of intensities at the same points, ... x points.
+    Returns:
+        ndarray: (k, m, c, n), shaped ... x 4 for many series.
+    """
+    tr, td, i_real = (np.asarray(values, dtype=float) for values in (tr, td, i_real))
+    c_grid = np.asarray(c_grid, dtype=float)
+    log_base = np.log(td[None, :] + c_grid[:, None])
+    design = np.stack([np.ones_like(log_base), np.broadcast_to(np.log(tr), log_base.shape), -log_base], axis=2)
+    gram = np.einsum("gpi,gpj->gij", design, design)
+    moments = np.einsum("gpi,...p->...gi", design, np.log(i_real))
+    coefficients = np.linalg.solve(gram, moments[..., None])[..., 0]
+
+    log_k, m, n = np.moveaxis(coefficients, -1, 0)
+    i_calculated = np.exp(log_k[..., None] + m[..., None] * np.log(tr) - n[..., None] * log_base)
+    relative_error = np.abs((i_calculated - i_real[..., None, :]) / i_real[..., None, :]).sum(axis=-1)
+    best = np.nanargmin(relative_error, axis=-1)
+
+    def at_best(values):
+        return np.take_along_axis(values, best[..., None], axis=-1)[..., 0]
+
+    return np.stack([np.exp(at_best(log_k)), at_best(m), c_grid[best], at_best(n)], axis=-1)
+
+
+# IDF equation families. 'ven_te_chow' is the equation of 'ventechow', fitted separately
+# up to and after 60 minutes; the other families use one equation for every duration.
+IDF_MODELS = {
+    "ven_te_chow": {
+        "equation": "i = k*Tr^m/(td + c)^n, split at 60 min",
+        "parameters": ("k", "m", "c", "n"),
+        "intensity": ven_te_chow_intensity,
+        "initial_guess": [500, 0.1, 10, 0.7],
+        "bounds": [(100, 2000), (0, 3), (0, 100), (0, 10)],
+        "initializer": log_linear_initial_guess,
+        "split": True
+    },
+    "sherman": {
+        "equation": "i = k*Tr^m/(td + c)^n",
+        "parameters": ("k", "m", "c", "n"),
+        "intensity": ven_te_chow_intensity,
+        "initial_guess": [500, 0.1, 10, 0.7],
+        "bounds": [(1, 20000), (0, 3), (0, 100), (0, 10)],
+        "initializer": log_linear_initial_guess,
+        "split": False
+    },
+    "talbot": {
+        "equation": "i = k*Tr^m/(td + c)",
+        "parameters": ("k", "m", "c"),
+        "intensity": talbot_intensity,
+        "initial_guess": [1500, 0.1, 10],
+        "bounds": [(1, 100000), (0, 3), (0, 500)],
+        "split": False
+    },
+    "bernard": {
+        "equation": "i = k*Tr^m/td^n",
+        "parameters": ("k", "m", "n"),
+        "intensity": bernard_intensity,
+        "initial_guess": [500, 0.1, 0.7],
+        "bounds": [(1, 20000), (0, 3), (0, 10)],
+        "split": False
+    }
+}
+
+
+def objective_and_gradient(parameters, model, tr, td, i_real):
+    """Sum of the relative errors (%) of a model, the objective of 'ventechow', and its gradient.
+    Every model shares this evaluator; only the intensity function differs."""
+    intensity, jacobian = IDF_MODELS[model]["intensity"](np.asarray(parameters, dtype=float), tr, td)
+    if not np.all(np.isfinite(intensity)):
+        return np.inf, np.zeros(len(parameters))
+    residual = (intensity - i_real) / i_real
+    objective = np.abs(residual).sum() * 100
+    gradient = jacobian @ (np.sign(residual) / i_real) * 100
+    return objective, gradient
+
+
+def fit_equation(model, tr, td, i_real, max_evaluations=MAX_FUNCTION_EVALUATIONS):
+    """Fit one equation of a model to the given points.
+    Returns:
+        tuple: The fitted parameters and the optimizer report.
+    """
+    spec = IDF_MODELS[model]
+    # The optimizer works on the parameters divided by the initial guess, so that k, in the
+    # hundreds, and the exponents, below one, take steps of the same size
+    scale = np.asarray(spec["initial_guess"], dtype=float)
+    start = np.ones(len(scale))
+    if spec.get("initializer") is not None:
+        low, high = np.array(spec["bounds"], dtype=float).T
+        start = np.clip(spec["initializer"](tr, td, i_real), low, high) / scale
+
+    def scaled_objective(scaled_parameters):
+        objective, gradient = objective_and_gradient(scaled_parameters * scale, model, tr, td, i_real)
+        return objective, gradient * scale
+
+    result = minimize(scaled_objective, start, jac=True, method="L-BFGS-B",
+                      bounds=[(low / factor, high / factor) for (low, high), factor in zip(spec["bounds"], scale)],
+                      options={"maxfun": max_evaluations})
+    return result.x * scale, {
+        "converged": bool(result.success),
+        "message": str(result.message),
+        "iterations": int(result.nit),
+        "function_evaluations": int(result.nfev),
+        "objective": float(result.fun)
+    }
+
+
+def split_masks(td):
+    """Return the masks of the points fitted by each Ven Te Chow equation; the 60-minute
+    points belong to both, as in 'ventechow.condition_mask'."""
+    return td <= SPLIT_DURATION, td >= SPLIT_DURATION
+
+
+def model_intensity(model, parameter_sets, tr, td):
+    """Evaluate a model with its fitted parameters; split models use the first set up to
+    60 minutes and the second one after."""
+    intensity = IDF_MODELS[model]["intensity"]
+    if not IDF_MODELS[model]["split"]:
+        return intensity(parameter_sets[0], tr, td)[0]
+    return np.where(td <= SPLIT_DURATION, intensity(parameter_sets[0], tr, td)[0],
+                    intensity(parameter_sets[1], tr, td)[0])
+
+
+def fit_model(model, tr, td, i_real, parameter_sets=None, deadline=None,
+              max_evaluations=MAX_FUNCTION_EVALUATIONS):
+    """Fit a model, or only evaluate it when 'parameter_sets' is given, and measure its
+    goodness of fit over every point.
+    Returns:
+        dict: A row of the comparison table, or None when the fit would start after the
+              'deadline' ('time.time()').
+    """
+    if parameter_sets is None and deadline is not None and time.time() >= deadline:
+        return None
+    spec = IDF_MODELS[model]
+    start = time.perf_counter()
+    reports = []
+    if parameter_sets is None:
+        masks = split_masks(td) if spec["split"] else (np.ones(td.shape, dtype=bool),)
+        parameter_sets = []
+        for mask in masks:
+            parameters, report = fit_equation(model, tr[mask], td[mask], i_real[mask], max_evaluations)
+            parameter_sets.append(parameters)
+            reports.append(report)
+
+    i_calculated = model_intensity(model, parameter_sets, tr, td)
+    relative_error = np.abs((i_calculated - i_real) / i_real) * 100
+    ns = 1 - ((i_real - i_calculated) ** 2).sum() / ((i_real - i_real.mean()) ** 2).sum()
+
+    return {
+        "model": model,
+        "equation": spec["equation"],
+        "parameters": [
+            {name: round(float(value), 4) for name, value in zip(spec["parameters"], parameters)}
+            for parameters in parameter_sets
+        ],
+        "ns": float(ns),
+        "mean_relative_error": float(relative_error.mean()),
+        "fitted": bool(reports),
+        "converged": all(report["converged"] for report in reports) if reports else None,
+        "function_evaluations": sum(report["function_evaluations"] for report in reports),
+        "elapsed": round(time.perf_counter() - start, 4)
+    }
+
+
+def compare_models(tr, td, i_real, models=tuple(IDF_MODELS), fitted=None, metrics=None, deadline=None):
+    """Fit several IDF equation families to the same points and rank them.
+    Args:
+        tr (ndarray): Return period of every point, in years.
+        td (ndarray): Duration of every point, in minutes.
+        i_real (ndarray): Intensity of every point, in mm/h.
+        models (tuple): Names of the models in 'IDF_MODELS'.
+        fitted (dict): Parameter sets of models already fitted, such as the Ven Te Chow
+                       parameters of the main output; they are evaluated, not refitted.
+        metrics (dict): Request metrics; the fits are recorded as scheduler stages.
+        deadline (float): Time ('time.time()') after which fits are not started.
+    Returns:
+        dict: The comparison 'table', best first by NS and then by mean relative error,
+              and the name of the 'best' model. Models skipped at the deadline are listed
+              under 'skipped'.
+    """
+    fitted = fitted or {}
+    tr, td, i_real = (np.asarray(values, dtype=float) for values in (tr, td, i_real))
+
+    rows = run_graph({
+        "model_" + model: (partial(fit_model, model, tr, td, i_real, fitted.get(model), deadline), [])
+        for model in models
+    }, "idf_models", metrics, executor_type=CPU_EXECUTOR)
+
+    table = [row for row in rows.values() if row is not None]
+    table.sort(key=lambda row: (-row["ns"], row["mean_relative_error"]))
+    return {
+        "table": table,
+        "best": table[0]["model"] if table else None,
+        "skipped": [model for model in models if rows["model_" + model] is None]
+    }
@@ -2,80 +2,58 @@ import numpy as np
 import pandas as pd
 from scipy.stats import norm, gamma
 
+# Constants
+RETURN_PERIODS = [2, 5, 10, 20, 30, 50, 75, 100]
+
 
 def k_coeficient_calculation():
     """Calculate the k coefficient values based on the annual exceedance probabilities."""
     k_coefficient = pd.DataFrame()
-    k_coefficient["Tr_anos"] = [2, 5, 10, 20, 30, 50, 75, 100]
+    k_coefficient["Tr_anos"] = RETURN_PERIODS
     k_coefficient["exceedance"] = 1 / k_coefficient["Tr_anos"]
     k_coefficient["no_exceedance"] = 1 - k_coefficient["exceedance"]
     return k_coefficient
 
 
-def k_dist_log_normal_calc(k_coefficient):
-    """Calculate the k coefficient for a log-normal distribution."""
-
-    k_coefficient["k"] = norm.ppf(k_coefficient["no_exceedance"])
-    return k_coefficient.round(4)
-
-
-def k_dist_pearson_calc(k_coefficient, params):
-    """Calculate the k coefficient for a Pearson distribution."""
+DISTRIBUTIONS = ("log_normal", "pearson", "log_pearson", "gumbel_theoretical", "gumbel_finite")
 
-    k_coefficient['YTR'] = np.where(params["g"] > 0, 
-                                    gamma.ppf(k_coefficient["no_exceedance"], params["alpha"], scale=1), 
-                                    gamma.ppf(k_coefficient["exceedance"], params["alpha"], scale=1))
 
-    k_coefficient["k"] = (params["g"] / 2) * \
-        (k_coefficient["YTR"] - params["alpha"])
-    return k_coefficient.round(4)
-
-
-def k_dist_log_pearson_calc(k_coefficient, params):
-    """Calculate the k coefficient for a log-Pearson distribution."""
-
-    k_coefficient['YTRw'] = np.where(params["gw"] > 0, 
-                                     gamma.ppf(k_coefficient["no_exceedance"], params["alphaw"], scale=1), 
-                                     gamma.ppf(k_coefficient["exceedance"], params["alphaw"], scale=1))
-
-    k_coefficient["k"] = (params["gw"] / 2) * \
-        (k_coefficient["YTRw"] - params["alphaw"])
-    return k_coefficient.round(4)
-
-
-def k_dist_gumbel_theoretical_calc(k_coefficient):
-    """Calculate the k coefficient for a theoretical Gumbel distribution."""
-
-    k_coefficient["y"] = -np.log(-np.log(k_coefficient["no_exceedance"]))
-    k_coefficient["k"] = 0.7797 * k_coefficient["y"] - 0.45
+def k_all_distributions(params):
+    """Calculate the k coefficient of every distribution in one vectorized pass.
+    Returns:
+        DataFrame: The return periods with one k column per distribution name.
+    """
+    k_coefficient = k_coeficient_calculation()
+    no_exceedance = k_coefficient["no_exceedance"].to_numpy()
+    exceedance = k_coefficient["exceedance"].to_numpy()
+
+    # Pearson and log-Pearson gamma quantiles in a single call
+    skews = np.array([[params["g"]], [params["gw"]]])
+    alphas = np.array([[params["alpha"]], [params["alphaw"]]])
+    ytr = gamma.ppf(np.where(skews > 0, no_exceedance, exceedance), alphas, scale=1)
+    k_pearson = (skews / 2) * (ytr - alphas)
+
+    y = -np.log(-np.log(no_exceedance))
+
+    k_coefficient["log_normal"] = norm.ppf(no_exceedance)
+    k_coefficient["pearson"] = k_pearson[0]
+    k_coefficient["log_pearson"] = k_pearson[1]
+    k_coefficient["gumbel_theoretical"] = 0.7797 * y - 0.45
+    k_coefficient["gumbel_finite"] = (y - params["yn"]) / params["sigman"]
     return k_coefficient.round(4)
 
 
-def k_dist_gumbel_finite_calc(k_coefficient, params):
-    """Calculate the k coefficient for a finite Gumbel distribution."""
-
-    k_coefficient["y"] = -np.log(-np.log(k_coefficient["no_exceedance"]))
-    k_coefficient["k"] = (
-        k_coefficient["y"] - params["yn"]) / params["sigman"]
-    return k_coefficient.round(4)
+def main(params, dist_r2, k_all=None):
+    """Calculate the k coefficient values based on the type of distribution.
+    When 'k_all' holds the table from 'k_all_distributions', e.g. from a cached
+    fit, the k column of the distribution is taken from it."""
 
+    if dist_r2["max_dist"] not in DISTRIBUTIONS:
+        raise ValueError(f"Invalid distribution type: {dist_r2['max_dist']}")
 
-def main(params, dist_r2):
-    """Calculate the k coefficient values based on the type of distribution."""
+    if k_all is None:
+        k_all = k_all_distributions(params)
 
-    k_coefficient = k_coeficient_calculation()
-
-    if dist_r2["max_dist"] == 'log_normal':
-        k = k_dist_log_normal_calc(k_coefficient)
-    elif dist_r2["max_dist"] == 'pearson':
-        k = k_dist_pearson_calc(k_coefficient, params)
-    elif dist_r2["max_dist"] == 'log_pearson':
-        k = k_dist_log_pearson_calc(k_coefficient, params)
-    elif dist_r2["max_dist"] == 'gumbel_theoretical':
-        k = k_dist_gumbel_theoretical_calc(k_coefficient)
-    elif dist_r2["max_dist"] == 'gumbel_finite':
-        k = k_dist_gumbel_finite_calc(k_coefficient, params)
-    else:
-        raise ValueError(f"Invalid distribution type: {dist_r2['max_dist']}")
-    
+    k = k_all[["Tr_anos", "exceedance", "no_exceedance"]].copy()
+    k["k"] = k_all[dist_r2["max_dist"]]
     return k
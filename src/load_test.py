@@ -0,0 +1,275 @@
+import argparse
+import itertools
+import json
+import os
+import resource
+import threading
+import time
+import urllib.error
+import urllib.request
+from concurrent.futures import ThreadPoolExecutor
+
+import numpy as np
+import pandas as pd
+from flask import Flask, request
+from werkzeug.serving import make_server
+
+import gcs_utils
+from main import configure_logging, process_request
+
+# Constants
+BUCKET_NAME = "load-test"
+FIRST_STATION_CODE = 9000000
+FIRST_YEAR = 1970
+SYNTHETIC_YEARS = 40
+# Share of the record, from its start, that also has consistent (level 2) data
+CONSISTENT_SHARE = 0.6
+PERCENTILES = (50, 90, 95, 99)
+HEADER = [
+    "Sistema de Informações Hidrológicas",
+    "Versão Web 3.0",
+    "© 2018 Agência Nacional de Águas (ANA)",
+    "",
+    "NivelConsistencia: 1 = Bruto, 2 = Consistido",
+    "TipoMedicaoChuvas: 1 = Pluviômetro, 2 = Pluviógrafo, 3 = Data logger",
+    "Status: 0 = Branco, 1 = Real, 2 = Estimado, 3 = Duvidoso, 4 = Acumulado",
+    "",
+    "Restrições da consulta:",
+    "Código da Estação:{code}",
+    "",
+    ""
+]
+COLUMNS = "EstacaoCodigo;NivelConsistencia;Data;TipoMedicaoChuvas;Maxima"
+
+
+class FakeBlob:
+    """A blob of 'FakeStorageClient', with the methods used by 'gcs_utils'."""
+
+    def __init__(self, client, name):
+        self.client = client
+        self.name = name
+
+    def download_to_filename(self, file_name):
+        with self.client.lock:
+            data = self.client.blobs[self.name]
+            self.client.counts["downloads"] += 1
+        with open(file_name, "wb") as csv_file:
+            csv_file.write(data)
+
+    def delete(self):
+        with self.client.lock:
+            del self.client.blobs[self.name]
+            self.client.counts["deletes"] += 1
+
+
+class FakeBucket:
+    """A bucket of 'FakeStorageClient'; every bucket shares the blobs of the client."""
+
+    def __init__(self, client, name):
+        self.client = client
+        self.name = name
+
+    def blob(self, name):
+        return FakeBlob(self.client, name)
+
+
+class FakeStorageClient:
+    """In-process stand-in for 'google.cloud.storage.Client', installed with
+    'gcs_utils.set_storage_client'. Blobs are kept in memory."""
+
+    def __init__(self):
+        self.blobs = {}
+        self.counts = {"uploads": 0, "downloads": 0, "deletes": 0}
+        self.lock = threading.Lock()
+
+    def bucket(self, name):
+        return FakeBucket(self, name)
+
+    def upload(self, name, data):
+        """Store a blob, as the web client does before calling the function."""
+        with self.lock:
+            self.blobs[name] = data
+            self.counts["uploads"] += 1
+
+
+def synthetic_csv(code, years=SYNTHETIC_YEARS, seed=0):
+    """Build a HidroWeb CSV file of monthly maxima for a synthetic station.
+    The maxima follow a gamma distribution with wet summers and dry winters; the first
+    'CONSISTENT_SHARE' of the record has consistent data besides the raw data.
+    Returns:
+        bytes: The file, encoded as the HidroWeb downloads.
+    """
+    rng = np.random.default_rng([seed, code])
+    months = pd.date_range(f"{FIRST_YEAR}-01-01", periods=12 * years, freq="MS")
+    mean = 35 + 25 * np.cos(2 * np.pi * (months.month.to_numpy() - 1) / 12)
+    raw = rng.gamma(3.0, mean / 3.0).round(1)
+    consistent = (raw * rng.uniform(0.95, 1.05, raw.size)).round(1)
+    consistent_months = int(len(months) * CONSISTENT_SHARE)
+
+    lines = [line.format(code=code) for line in HEADER] + [COLUMNS]
+    for position, month in enumerate(months):
+        date = month.strftime("%d/%m/%Y")
+        lines.append(f"{code};1;{date};1;{raw[position]:.1f}".replace(".", ","))
+        if position < consistent_months:
+            lines.append(f"{code};2;{date};1;{consistent[position]:.1f}".replace(".", ","))
+    return ("\n".join(lines) + "\n").encode("ISO 8859-1")
+
+
+def make_app():
+    """Return a Flask application serving 'process_request' at '/'."""
+    app = Flask(__name__)
+    app.add_url_rule("/", "process_request", lambda: process_request(request), methods=["GET", "POST"])
+    return app
+
+
+def client_sender(app):
+    """Return a function sending a request body through the Flask test client."""
+
+    def send(body):
+        return app.test_client().post("/", json=body).status_code
+
+    return send, None
+
+
+def server_sender(app):
+    """Start a local threaded server in the background and return a function sending a
+    request body to it over HTTP, and the server to shut down."""
+    server = make_server("127.0.0.1", 0, app, threaded=True)
+    threading.Thread(target=server.serve_forever, daemon=True).start()
+    url = f"http://127.0.0.1:{server.server_port}/"
+
+    def send(body):
+        http_request = urllib.request.Request(url, data=json.dumps(body).encode("utf-8"),
+                                              headers={"Content-Type": "application/json"})
+        try:
+            with urllib.request.urlopen(http_request) as response:
+                response.read()
+                return response.status
+        except urllib.error.HTTPError as error:
+            return error.code
+
+    return send, server
+
+
+def current_rss_kb():
+    """Return the resident memory of this process, in KB, or the peak when the current
+    value is not available."""
+    try:
+        with open("/proc/self/statm") as statm:
+            return int(statm.read().split()[1]) * os.sysconf("SC_PAGE_SIZE") // 1024
+    except (OSError, ValueError):
+        return resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+
+
+def run_level(send, storage, stations, concurrency, requests, options, counter):
+    """Send 'requests' requests with 'concurrency' of them in flight at a time.
+    Returns:
+        dict: Throughput, latency percentiles (ms), error rate, status counts and memory growth.
+    """
+
+    def one_request(_):
+        number = next(counter)
+        code = stations[number % len(stations)][0]
+        blob_name = f"load_test_{os.getpid()}_{number}_{code}.csv"
+        storage.upload(blob_name, stations[number % len(stations)][1])
+        start = time.perf_counter()
+        try:
+            status = send({"csv_file_url": f"gs://{BUCKET_NAME}/{blob_name}", **options})
+        except Exception as e:
+            print(f"Request {number} failed: {e}")
+            status = None
+        return time.perf_counter() - start, status
+
+    rss_start = current_rss_kb()
+    start = time.perf_counter()
+    with ThreadPoolExecutor(max_workers=concurrency) as executor:
+        results = list(executor.map(one_request, range(requests)))
+    elapsed = time.perf_counter() - start
+    rss_end = current_rss_kb()
+
+    latencies = np.array([latency for latency, _ in results]) * 1000
+    statuses = [status for _, status in results]
+    errors = sum(status is None or status >= 400 for status in statuses)
+    return {
+        "concurrency": concurrency,
+        "requests": requests,
+        "elapsed": round(elapsed, 3),
+        "throughput_rps": round(requests / elapsed, 3),
+        "latency_ms": {
+            **{f"p{percentile}": round(float(np.percentile(latencies, percentile)), 2)
+               for percentile in PERCENTILES},
+            "mean": round(float(latencies.mean()), 2),
+            "max": round(float(latencies.max()), 2)
+        },
+        "error_rate": round(errors / requests, 4),
+        "status_counts": {str(status): statuses.count(status) for status in sorted(set(statuses), key=str)},
+        "rss_start_kb": rss_start,
+        "rss_end_kb": rss_end,
+        "rss_growth_kb": rss_end - rss_start
+    }
+
+
+def main(concurrency_levels=(1, 2, 4, 8), requests=50, stations=10, years=SYNTHETIC_YEARS, mode="client",
+         options=None, warmup=2, seed=0):
+    """Measure how one instance of 'process_request' behaves under concurrent requests.
+    'gcs_utils' is pointed to an in-process fake storage serving synthetic station CSVs,
+    so nothing leaves the machine.
+    Args:
+        concurrency_levels (tuple): Requests in flight at a time, one measurement each.
+        requests (int): Requests per concurrency level.
+        stations (int): Number of synthetic stations the requests cycle through; repeated
+                        stations hit the fit cache.
+        years (int): Years of data of every synthetic station.
+        mode (str): 'client' for the Flask test client, 'server' for a local HTTP server.
+        options (dict): Extra fields of every request body, e.g. {"distribution": "all"}.
+        warmup (int): Requests sent before measuring, not reported.
+        seed (int): Seed of the synthetic data.
+    Returns:
+        dict: The configuration, the fake storage counters and one report per level.
+    """
+    options = options or {}
+    storage = FakeStorageClient()
+    gcs_utils.set_storage_client(storage)
+    station_files = [(code, synthetic_csv(code, years, seed))
+                     for code in range(FIRST_STATION_CODE, FIRST_STATION_CODE + stations)]
+
+    app = make_app()
+    send, server = (server_sender if mode == "server" else client_sender)(app)
+    counter = itertools.count()
+    try:
+        if warmup:
+            run_level(send, storage, station_files, 1, warmup, options, counter)
+        levels = [run_level(send, storage, station_files, concurrency, requests, options, counter)
+                  for concurrency in concurrency_levels]
+    finally:
+        if server is not None:
+            server.shutdown()
+        gcs_utils.set_storage_client(None)
+
+    return {
+        "mode": mode,
+        "stations": stations,
+        "years": years,
+        "options": options,
+        "peak_rss_kb": resource.getrusage(resource.RUSAGE_SELF).ru_maxrss,
+        "storage": {**storage.counts, "left_over_blobs": len(storage.blobs)},
+        "levels": levels
+    }
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(
+        description="Load test 'process_request' with an in-process fake storage of synthetic stations.")
+    parser.add_argument("--concurrency", type=int, nargs="+", default=[1, 2, 4, 8])
+    parser.add_argument("--requests", type=int, default=50, help="Requests per concurrency level")
+    parser.add_argument("--stations", type=int, default=10)
+    parser.add_argument("--years", type=int, default=SYNTHETIC_YEARS)
+    parser.add_argument("--mode", choices=["client", "server"], default="client")
+    parser.add_argument("--options", type=json.loads, default={}, help="JSON of extra request fields")
+    parser.add_argument("--warmup", type=int, default=2)
+    parser.add_argument("--seed", type=int, default=0)
+    args = parser.parse_args()
+    configure_logging()
+
+    print(json.dumps(main(tuple(args.concurrency), args.requests, args.stations, args.years, args.mode,
+                          args.options, args.warmup, args.seed), indent=2))
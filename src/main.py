@@ -1,73 +1,403 @@
 import os
 import json
-import pandas as pd
+import logging
+import time
+from functools import partial
 from flask import jsonify
 from gcs_utils import download_csv_file, delete_blob
 
-from yn_sigman import yn_sigman
+import fit_cache
+import result_store
+from metrics import new_metrics, stage
+from profiling import profiling_requested, start_profile, stop_profile
+from scheduler import run_graph
+
+from data_loader import load_data
+from station_archive import load_station
+from spatial_index import lookup
+from serialization import make_response, FORMATS, LAYOUTS
 from process_data import main as process_data
 from outlier_test import main as outlier_test
 from distributions import main as distributions
-from k_coefficient import main as k_coefficient
+from k_coefficient import main as k_coefficient, k_all_distributions, DISTRIBUTIONS
 from disaggregation_coef import disaggregation_coef
-from ventechow import main as ventechow
+from ventechow import main as ventechow, optimizer_trace_requested
+from idf_models import IDF_MODELS
+from trend_tests import annual_maxima_tests
+from seasonal import main as seasonal, GROUPINGS
+from moving_window import main as moving_window, MIN_YEARS as MIN_WINDOW_YEARS
+
+
+logger = logging.getLogger(__name__)
+
+# Log level of the command line tools; hosts such as the Cloud Function configure logging themselves
+LOG_LEVEL_ENV = "IDF_LOG_LEVEL"
+
+# Default time budget of a request, in seconds; unlimited when not set
+REQUEST_TIMEOUT = float(os.environ["IDF_REQUEST_TIMEOUT"]) if os.environ.get("IDF_REQUEST_TIMEOUT") else None
+
+# Spatial index answering the nearest-station IDF lookups (see 'spatial_index')
+SPATIAL_INDEX_PATH = os.environ.get("IDF_SPATIAL_INDEX")
+
+
+def configure_logging():
+    """Configure the root logger at the IDF_LOG_LEVEL level (WARNING by default).
+    Called by the command line tools only, never on import."""
+    logging.basicConfig(level=os.environ.get(LOG_LEVEL_ENV, "WARNING").upper())
+
+
+class PipelineStopped(Exception):
+    """Raised by a pipeline stage when the analysis cannot go on; the message is returned to the user."""
+
+
+# Keys of the IDF output that depend on the distribution used for the intensities
+DISTRIBUTION_OUTPUT_KEYS = ("dist", "graph_data", "intensity_graph_data_1", "intensity_graph_data_2",
+                            "parameters", "mean_relative_errors", "ns", "optimization")
+
+
+def fit_distributions(no_outlier, metrics):
+    """Fit the distributions and compute the k coefficients of all of them, reusing
+    a cached fit of the same annual maxima when there is one."""
+    data_fingerprint = fit_cache.fingerprint(no_outlier)
+    cached_fit = fit_cache.get(data_fingerprint)
+    if cached_fit is not None:
+        return {**cached_fit, "fingerprint": data_fingerprint, "cached": True}
+
+    with stage(metrics, "distributions"):
+        distribution_data, params, dist_r2 = distributions(no_outlier)
+
+    with stage(metrics, "k_coefficient"):
+        k_all = k_all_distributions(params)
+
+    return {
+        "distribution_data": distribution_data,
+        "params": params,
+        "dist_r2": dist_r2,
+        "k_all": k_all,
+        "optimal_parameters": {},
+        "optimization": {},
+        "fingerprint": data_fingerprint,
+        "cached": False
+    }
+
+
+def selected_distributions(dist_r2, distribution=None):
+    """Return the distributions to compute the IDF for; the first one is the main result.
+    Args:
+        dist_r2 (dict): The r2 of the fitted distributions.
+        distribution (str): None for the distribution with the largest r2, one of
+                            'k_coefficient.DISTRIBUTIONS', or 'all'.
+    Returns:
+        list: Distribution names.
+    """
+    if distribution is None:
+        return [dist_r2["max_dist"]]
+    if distribution == "all":
+        return [dist_r2["max_dist"]] + [name for name in DISTRIBUTIONS if name != dist_r2["max_dist"]]
+    if distribution not in DISTRIBUTIONS:
+        raise ValueError(f"Invalid distribution type: {distribution}")
+    return [distribution]
+
+
+def idf_for_distribution(dist_name, fit, processed, disaggregation, trace_optimizer, metrics, deadline=None,
+                         models=None):
+    """Run the Ven Te Chow step with the intensities of the given distribution.
+    Cached Ven Te Chow parameters are reused unless the optimizer trace was requested,
+    as the cache keeps no trajectories."""
+    _, empty_consistent_data, year_range, empty_years = processed
+    disaggregation_data, time_interval = disaggregation
+    dist_r2 = {**fit["dist_r2"], "max_dist": dist_name,
+               "max_value_r2": fit["dist_r2"]["r2"][dist_name]}
+    k_coefficient_data = k_coefficient(fit["params"], dist_r2, fit["k_all"])
 
+    return ventechow(fit["distribution_data"], k_coefficient_data,
+                     disaggregation_data, fit["params"], time_interval, dist_r2,
+                     empty_consistent_data, year_range, empty_years,
+                     None if trace_optimizer else fit["optimal_parameters"].get(dist_name),
+                     trace_optimizer, metrics, deadline, models)
 
-def load_data(csv_file_path):
-    """Function to load the required data for further analysis."""
+
+def optimization_stopped(optimization):
+    """Return True when a Ven Te Chow fit ran out of its time or evaluation budget."""
+    return any(report.get("stopped") for report in (optimization or {}).values())
+
+
+def load_input(csv_file_path, station_code=None):
+    """Load the data and metadata of a station from a CSV file, or from a station archive
+    when 'station_code' is given. Returns None when it cannot be read."""
+    if station_code is None:
+        return load_data(csv_file_path)
+    return load_station(csv_file_path, station_code)
+
+
+def pipeline_graph(csv_file_path, metrics, trace_optimizer=False, distribution=None, station_code=None,
+                   loaded=None, deadline=None, models=None):
+    """Declare the pipeline stages and the stages each one takes its inputs from.
+    'loaded' is the output of 'load_input' when the data was already read."""
+
+    def load_stage():
+        result = loaded if loaded is not None else load_input(csv_file_path, station_code)
+        if result is None:
+            raise PipelineStopped("Erro ao carregar o arquivo")
+        return result
+
+    def process_stage(loaded):
+        processed = process_data(loaded[0])
+        if processed[0].empty:
+            raise PipelineStopped("Dados não são sufientes para completar a análise")
+        return processed
+
+    def outlier_stage(processed):
+        return outlier_test(processed[0])
+
+    def trend_stage(processed):
+        return annual_maxima_tests(processed[0])
+
+    def fit_stage(no_outlier):
+        return fit_distributions(no_outlier, metrics)
+
+    def ventechow_stage(fit, processed, disaggregation):
+        dist_names = selected_distributions(fit["dist_r2"], distribution)
+        outputs = run_graph({
+            dist_name: (partial(idf_for_distribution, dist_name, fit, processed,
+                                disaggregation, trace_optimizer, metrics, deadline, models), [])
+            for dist_name in dist_names
+        }, "idf_distributions", metrics)
+        return {dist_name: outputs[dist_name] for dist_name in dist_names}
+
+    return {
+        "load_data": (load_stage, []),
+        "disaggregation_coef": (disaggregation_coef, []),
+        "process_data": (process_stage, ["load_data"]),
+        "outlier_test": (outlier_stage, ["process_data"]),
+        "trend_tests": (trend_stage, ["process_data"]),
+        "fit": (fit_stage, ["outlier_test"]),
+        "ventechow": (ventechow_stage, ["fit", "process_data", "disaggregation_coef"])
+    }
+
+
+def run_pipeline(csv_file_path, metrics, trace_optimizer=False, distribution=None, station_code=None,
+                 loaded=None, deadline=None, models=None):
+    """Process the data, test for outliers, determine the distribution, 
+    calculate the k coefficient, and calculate the Ven Te Chow parameters.
+    Independent stages run concurrently through the scheduler, and fits are memoized
+    by a fingerprint of the annual maxima left after the outlier test; a new fit of a
+    station replaces its previous one. The station metadata is returned under 'station',
+    and the Mann-Kendall, Sen's slope and Pettitt tests of the annual maxima under 'trend'.
+    'distribution' overrides the distribution with the largest r2; with 'all' the IDF of
+    every distribution is returned under 'distributions'. Fits stopped at the 'deadline'
+    are returned but not cached."""
     try:
-        script_dir = os.path.dirname(os.path.abspath(__file__))
-        input_data = pd.read_csv(csv_file_path, sep=";", encoding='ISO 8859-1', skiprows=12,
-                                 decimal=",", usecols=["NivelConsistencia", "Data", "Maxima"], index_col=False)
-
-        # Check if the necessary columns are present
-        required_columns = ["NivelConsistencia", "Data", "Maxima"]
-        if not all(column in input_data.columns for column in required_columns):
-            print(
-                f"CSV file {csv_file_path} does not have the required columns")
-            return None
-
-        return input_data
-    except FileNotFoundError:
-        print(f"File {csv_file_path} not found")
-        return None
-    except pd.errors.ParserError:
-        print(f"Error parsing CSV file {csv_file_path}")
-        return None
-    except Exception as e:
-        print(f"Unexpected error reading CSV file {csv_file_path}: {e}")
-        return None
+        results = run_graph(pipeline_graph(csv_file_path, metrics, trace_optimizer, distribution,
+                                           station_code, loaded, deadline, models), "pipeline", metrics)
+    except PipelineStopped as stopped:
+        return json.dumps(str(stopped))
 
+    fit = results["fit"]
+    outputs = results["ventechow"]
 
-def main(csv_file_path):
-    """Main function to process the data, test for outliers, determine the distribution, 
-    calculate the k coefficient, and calculate the Ven Te Chow parameters."""
-    raw_df = load_data(csv_file_path)
-    if raw_df is None:
-        error_loading_data = "Erro ao carregar o arquivo"
-        return json.dumps(error_loading_data)
+    updated_fit = not fit["cached"]
+    for dist_name, dist_output in outputs.items():
+        if dist_output["optimization"] is None:
+            dist_output["optimization"] = {
+                condition: {**report, "cached": True}
+                for condition, report in fit["optimization"][dist_name].items()
+            }
+        elif not optimization_stopped(dist_output["optimization"]):
+            fit["optimal_parameters"][dist_name] = (
+                tuple(dist_output["parameters"]["parameters_1"].values()),
+                tuple(dist_output["parameters"]["parameters_2"].values())
+            )
+            # Trajectories belong to the request that asked for them
+            fit["optimization"][dist_name] = {
+                condition: {key: value for key, value in report.items() if key != "trajectory"}
+                for condition, report in dist_output["optimization"].items()
+            }
+            updated_fit = True
 
-    processed_data, empty_consistent_data, year_range, empty_years = process_data(raw_df)
-    if processed_data.empty:
-        insufficient_data = "Dados não são sufientes para completar a análise"
-        return json.dumps(insufficient_data)
+    station = results["load_data"][1]
+    if updated_fit:
+        fit_cache.put(fit["fingerprint"], {
+            key: fit[key] for key in ("distribution_data", "params", "dist_r2", "k_all",
+                                      "optimal_parameters", "optimization")
+        }, station["code"])
 
-    no_outlier = outlier_test(processed_data)
+    dist_names = list(outputs)
+    output = outputs[dist_names[0]]
+    output["station"] = station
+    output["trend"] = results["trend_tests"]
+    output["r2"] = {name: float(value) for name, value in fit["dist_r2"]["r2"].items()}
+    if distribution == "all":
+        output["distributions"] = {
+            dist_name: {key: outputs[dist_name][key] for key in DISTRIBUTION_OUTPUT_KEYS}
+            for dist_name in dist_names
+        }
 
-    yn_table, sigman_table = yn_sigman()
+    metrics["optimization"] = {
+        condition: {
+            "converged": report["converged"],
+            "iterations": report["iterations"],
+            "function_evaluations": report["function_evaluations"],
+            "elapsed": report["elapsed"],
+            "stopped": report.get("stopped"),
+            "cached": report.get("cached", False)
+        }
+        for condition, report in output["optimization"].items()
+    }
+
+    metrics["fit_cache"] = {**fit_cache.stats(), "hit": fit["cached"]}
+    output["metrics"] = metrics
+    return output
 
-    distribution_data, params, dist_r2 = distributions(
-        no_outlier, yn_table, sigman_table)
 
-    disaggregation_data, time_interval = disaggregation_coef()
-    k_coefficient_data = k_coefficient(params, dist_r2)
+def run_grouped(csv_file_path, grouping, metrics, station_code=None, deadline=None):
+    """Compute the IDF of every season or month of a station with 'seasonal' and add
+    the station metadata under 'station'."""
+    with stage(metrics, "load_data"):
+        loaded = load_input(csv_file_path, station_code)
+    if loaded is None:
+        return json.dumps("Erro ao carregar o arquivo")
 
-    output = ventechow(distribution_data, k_coefficient_data,
-                       disaggregation_data, params, time_interval, dist_r2,
-                       empty_consistent_data, year_range, empty_years)
+    output = seasonal(loaded[0], grouping, metrics, deadline)
+    output["station"] = loaded[1]
+    output["metrics"] = metrics
     return output
 
 
+def run_moving_window(csv_file_path, window, metrics, trace_optimizer=False, distribution=None,
+                      station_code=None, deadline=None):
+    """Compute the IDF parameters of a station over sliding windows of 'window' years with
+    'moving_window'. Every window uses the distribution with the largest r2 over the
+    whole record, or 'distribution' when given."""
+    with stage(metrics, "load_data"):
+        loaded = load_input(csv_file_path, station_code)
+    if loaded is None:
+        return json.dumps("Erro ao carregar o arquivo")
+    with stage(metrics, "process_data"):
+        processed = process_data(loaded[0])
+    if processed[0].empty:
+        return json.dumps("Dados não são sufientes para completar a análise")
+    with stage(metrics, "outlier_test"):
+        no_outlier = outlier_test(processed[0])
+    fit = fit_distributions(no_outlier, metrics)
+    dist_name = selected_distributions(fit["dist_r2"], distribution)[0]
+
+    output = moving_window(no_outlier, dist_name, window, trace_optimizer, metrics, deadline)
+    if not isinstance(output, dict):
+        return json.dumps(output)
+    output["station"] = loaded[1]
+    output["metrics"] = metrics
+    return output
+
+
+def main(csv_file_path, profile=False, trace_optimizer=False, distribution=None, station_code=None,
+         timeout=REQUEST_TIMEOUT, models=None, grouping=None, window=None):
+    """Main function to run the IDF pipeline for a CSV file.
+    Args:
+        csv_file_path (str): Path of the HidroWeb CSV file.
+        profile (bool): Collect a cProfile trace and per-stage memory peaks. Profiling
+                        is also enabled by the IDF_PROFILE environment variable.
+        trace_optimizer (bool): Record the objective trajectory of the Ven Te Chow fits.
+                                Also enabled by the IDF_OPTIMIZER_TRACE environment variable.
+        distribution (str): Distribution used for the IDF instead of the one with the
+                            largest r2, or 'all' to also return every distribution's IDF.
+        station_code (str): When given, 'csv_file_path' is a station archive and the
+                            station is read from it (see 'station_archive').
+        timeout (float): Time budget of the request, in seconds. Ven Te Chow fits still
+                         running at the deadline return the best parameters found so far
+                         with 'converged' false and 'stopped' set to 'deadline'.
+        models (list): IDF equation families of 'idf_models' to fit and compare with the
+                       Ven Te Chow equation, or 'all'.
+        grouping (str): 'season' or 'month' to compute one IDF per season or calendar
+                        month instead of the annual one (see 'seasonal').
+        window (int): Years per window to return the time series of the IDF parameters
+                      over sliding windows of the record (see 'moving_window').
+    When the IDF_RESULT_STORE directory is set, the default output of a station is stored
+    and returned without recomputing until new data for the station arrives.
+    Returns:
+        dict: The IDF output, or a JSON string describing why it could not be computed.
+    """
+    metrics = new_metrics()
+    if models == "all" or (models is not None and "all" in models):
+        models = list(IDF_MODELS)
+    deadline = None
+    if timeout is not None:
+        timeout = float(timeout)
+        deadline = time.time() + timeout
+        metrics["timeout"] = timeout
+    trace_optimizer = optimizer_trace_requested(trace_optimizer)
+    profile = profiling_requested(profile)
+
+    # Only the default output of a station is stored
+    use_store = (result_store.enabled() and distribution is None and models is None
+                 and grouping is None and window is None and not trace_optimizer and not profile)
+    loaded = None
+    if use_store:
+        with stage(metrics, "result_store"):
+            loaded = load_input(csv_file_path, station_code)
+            if loaded is not None:
+                data_fingerprint = result_store.data_fingerprint(loaded[0])
+                entry = result_store.get(loaded[1]["code"], data_fingerprint)
+        if loaded is not None and entry is not None:
+            output = dict(entry["output"])
+            metrics["result_store"] = {"hit": True, "version": entry["version"]}
+            output["metrics"] = metrics
+            return output
+
+    if grouping is not None:
+        pipeline = partial(run_grouped, csv_file_path, grouping, metrics, station_code, deadline)
+    elif window is not None:
+        pipeline = partial(run_moving_window, csv_file_path, int(window), metrics, trace_optimizer,
+                           distribution, station_code, deadline)
+    else:
+        pipeline = partial(run_pipeline, csv_file_path, metrics, trace_optimizer, distribution, station_code,
+                           loaded, deadline, models)
+
+    if not profile:
+        output = pipeline()
+    else:
+        session = start_profile(metrics)
+        try:
+            output = pipeline()
+        finally:
+            profile_summary = stop_profile(session, csv_file_path)
+        if isinstance(output, dict):
+            output["profile"] = profile_summary
+
+    if use_store and isinstance(output, dict) and not optimization_stopped(output["optimization"]):
+        result_store.put(loaded[1]["code"], data_fingerprint, output)
+        metrics["result_store"] = {"hit": False, "version": result_store.PIPELINE_VERSION}
+    return output
+
+
+def response_options(request_json, request_args):
+    """Read the serialization options of a request: 'decimals', 'layout' and 'format'.
+    Returns:
+        dict: Keyword arguments of 'serialization.make_response'.
+    Raises:
+        ValueError: When an option has an invalid value.
+    """
+    request_json = request_json or {}
+    options = {}
+    for option in ('decimals', 'layout', 'format'):
+        if option in request_json:
+            options[option] = request_json[option]
+        elif request_args and option in request_args:
+            options[option] = request_args[option]
+
+    if options.get('layout', 'records') not in LAYOUTS or options.get('format', 'json') not in FORMATS:
+        raise ValueError("Invalid layout or format")
+    try:
+        decimals = None if options.get('decimals') is None else int(options['decimals'])
+    except TypeError:
+        raise ValueError("Invalid decimals")
+    return {
+        "decimals": decimals,
+        "layout": options.get('layout', 'records'),
+        "output_format": options.get('format', 'json')
+    }
+
+
 def process_request(request):
     """HTTP Cloud Function.
     Args:
@@ -89,15 +419,68 @@ def process_request(request):
     else:
         return jsonify(error="csv_file_url not provided"), 400
 
+    options = {}
+    for option in ('profile', 'trace_optimizer', 'distribution', 'timeout', 'models', 'grouping', 'window'):
+        if request_json and option in request_json:
+            options[option] = request_json[option]
+        elif request_args and option in request_args:
+            options[option] = request_args[option]
+
+    if options.get('distribution') not in (None, 'all') + DISTRIBUTIONS:
+        return jsonify(error="Invalid distribution"), 400
+
+    if options.get('grouping') not in (None,) + tuple(GROUPINGS):
+        return jsonify(error="Invalid grouping"), 400
+
+    try:
+        if options.get('window') is not None and int(options['window']) < MIN_WINDOW_YEARS:
+            raise ValueError
+    except (TypeError, ValueError):
+        return jsonify(error="Invalid window"), 400
+    if options.get('window') is not None and options.get('grouping') is not None:
+        return jsonify(error="grouping and window cannot be combined"), 400
+    # The seasonal fits take the best distribution of every group and the Ven Te Chow
+    # equation, without a trace; the moving window fits only the Ven Te Chow equation
+    trace_optimizer = options.get('trace_optimizer')
+    if isinstance(trace_optimizer, str):
+        trace_optimizer = trace_optimizer.lower() in ("1", "true", "yes")
+    if options.get('grouping') is not None:
+        for option, value in (('distribution', options.get('distribution')), ('models', options.get('models')),
+                              ('trace_optimizer', trace_optimizer or None)):
+            if value is not None:
+                return jsonify(error=f"grouping and {option} cannot be combined"), 400
+    if options.get('window') is not None and options.get('models') is not None:
+        return jsonify(error="window and models cannot be combined"), 400
+
+    if isinstance(options.get('models'), str):
+        options['models'] = options['models'].split(",")
+    if options.get('models') is not None and not (
+            isinstance(options['models'], list) and all(isinstance(model, str) for model in options['models'])
+            and set(options['models']) <= set(IDF_MODELS) | {'all'}):
+        return jsonify(error="Invalid models"), 400
+
+    try:
+        if options.get('timeout') is not None and float(options['timeout']) <= 0:
+            raise ValueError
+    except (TypeError, ValueError):
+        return jsonify(error="Invalid timeout"), 400
+
+    try:
+        serialization_options = response_options(request_json, request_args)
+    except ValueError:
+        return jsonify(error="Invalid serialization options"), 400
+
     # Download the CSV file from Firebase Cloud Storage
     csv_file_path = download_csv_file(csv_file_url)
 
     # Process the data
     result = None
     try:
-        result = main(csv_file_path)
+        result = main(csv_file_path, **options)
+    except result_store.InvalidStationCode as e:
+        return jsonify(error=str(e)), 400
     except Exception as e:
-        print(f"Error processing data: {e}")
+        logger.exception("Error processing data: %s", e)
         return jsonify(error="Error processing data"), 500
 
     if not result:
@@ -109,4 +492,75 @@ def process_request(request):
     # Delete the CSV file from Firebase Storage
     delete_blob(csv_file_url)
 
-    return jsonify(result)
+    return make_response(result, request, **serialization_options)
+
+
+def lookup_request(request):
+    """HTTP Cloud Function answering 'IDF at this latitude/longitude' from the spatial index.
+    'latitude' and 'longitude' may be numbers or lists of the same length; 'k' is the
+    number of nearest stations used for the inverse distance interpolation. An index
+    without stations answers 404.
+    """
+    request_json = request.get_json(silent=True) or {}
+    request_args = request.args
+
+    def option(name, default=None):
+        if name in request_json:
+            return request_json[name]
+        if request_args and name in request_args:
+            # Query strings carry lists as comma separated values
+            return request_args[name].split(",")
+        return default
+
+    def as_list(value):
+        return [float(item) for item in (value if isinstance(value, list) else [value])]
+
+    if not SPATIAL_INDEX_PATH or not os.path.exists(SPATIAL_INDEX_PATH):
+        return jsonify(error="Spatial index not available"), 503
+
+    try:
+        latitude = as_list(option("latitude"))
+        longitude = as_list(option("longitude"))
+        k = int(as_list(option("k", 4))[0])
+    except (TypeError, ValueError):
+        return jsonify(error="latitude and longitude must be numbers"), 400
+    try:
+        serialization_options = response_options(request_json, request_args)
+    except ValueError:
+        return jsonify(error="Invalid serialization options"), 400
+    if not latitude or len(latitude) != len(longitude) or k < 1:
+        return jsonify(error="Invalid latitude, longitude or k"), 400
+
+    try:
+        result = lookup(SPATIAL_INDEX_PATH, latitude, longitude, k)
+    except ValueError as e:
+        # An index without stations has nothing to answer with
+        return jsonify(error=str(e)), 404
+    return make_response(result, request, **serialization_options)
+
+
+def result_request(request):
+    """HTTP Cloud Function returning the stored IDF output of a station from memory.
+    Stations without a stored result for the current pipeline version answer 404; their
+    output is computed and stored by 'process_request'.
+    """
+    if not result_store.enabled():
+        return jsonify(error="Result store not available"), 503
+
+    request_json = request.get_json(silent=True) or {}
+    station_code = request_json.get("station_code") or request.args.get("station_code")
+    if not station_code:
+        return jsonify(error="station_code not provided"), 400
+
+    try:
+        serialization_options = response_options(request_json, request.args)
+    except ValueError:
+        return jsonify(error="Invalid serialization options"), 400
+
+    try:
+        entry = result_store.get(station_code)
+    except result_store.InvalidStationCode as e:
+        return jsonify(error=str(e)), 400
+    if entry is None:
+        return jsonify(error="No stored result for this station"), 404
+    return make_response({**entry["output"], "version": entry["version"]}, request, **serialization_options)
@@ -0,0 +1,61 @@
+import itertools
+import threading
+import time
+import tracemalloc
+from contextlib import contextmanager
+
+# tracemalloc keeps one peak for the whole process, so every measurement in progress is
+# credited with it before it is reset
+_memory_lock = threading.Lock()
+_memory_peaks = {}
+_memory_tokens = itertools.count()
+
+
+def _credit_memory_peak():
+    """Add the peak since the last reset to every measurement in progress and reset it."""
+    peak = tracemalloc.get_traced_memory()[1]
+    for token in _memory_peaks:
+        _memory_peaks[token] = max(_memory_peaks[token], peak)
+    tracemalloc.reset_peak()
+
+
+def start_memory_peak():
+    """Start measuring the traced memory high-water mark.
+    Measurements may overlap, e.g. a request and its stages or concurrent requests.
+    Each one sees the peak of the whole process while it runs, so the peak of a stage
+    includes the memory held by everything running at the same time.
+    Returns:
+        int: The token to pass to 'stop_memory_peak'.
+    """
+    with _memory_lock:
+        _credit_memory_peak()
+        token = next(_memory_tokens)
+        _memory_peaks[token] = tracemalloc.get_traced_memory()[0]
+    return token
+
+
+def stop_memory_peak(token):
+    """Stop a measurement of 'start_memory_peak' and return its peak, in bytes."""
+    with _memory_lock:
+        _credit_memory_peak()
+        return _memory_peaks.pop(token)
+
+
+def new_metrics():
+    """Create the dictionary that collects the metrics of a single request."""
+    return {"stages": {}}
+
+
+@contextmanager
+def stage(metrics, name):
+    """Context manager to record the elapsed time, in seconds, of a pipeline stage.
+    While a profiling session is active the memory high-water mark of the stage is
+    recorded as well (see 'start_memory_peak')."""
+    memory_token = start_memory_peak() if "memory_peak_kb" in metrics else None
+    start = time.perf_counter()
+    try:
+        yield
+    finally:
+        metrics["stages"][name] = round(time.perf_counter() - start, 4)
+        if memory_token is not None:
+            metrics["memory_peak_kb"][name] = round(stop_memory_peak(memory_token) / 1024, 1)
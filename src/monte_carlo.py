@@ -0,0 +1,171 @@
+import argparse
+import json
+import os
+from concurrent.futures import ProcessPoolExecutor
+
+import numpy as np
+from scipy.stats import gumbel_r, lognorm, pearson3
+
+from batch import main as batch
+from k_coefficient import DISTRIBUTIONS, RETURN_PERIODS
+
+# Constants
+DEFAULT_MEAN = 90.0
+DEFAULT_CV = 0.3
+DEFAULT_SKEW = 1.0
+CHUNK_SIZE = 10000
+
+# Fitted distributions counted as a correct selection for each parent
+PARENT_FAMILIES = {
+    "log_normal": ("log_normal",),
+    "pearson": ("pearson",),
+    "gumbel": ("gumbel_theoretical", "gumbel_finite")
+}
+
+
+def parent_distribution(parent, mean=DEFAULT_MEAN, cv=DEFAULT_CV, skew=DEFAULT_SKEW):
+    """Return the frozen scipy distribution of a parent with the given mean and coefficient
+    of variation ('skew' is used by the Pearson type III parent only)."""
+    std = mean * cv
+    if parent == "log_normal":
+        sigma = np.sqrt(np.log(1 + cv ** 2))
+        return lognorm(s=sigma, scale=mean * np.exp(-sigma ** 2 / 2))
+    if parent == "pearson":
+        return pearson3(skew, loc=mean, scale=std)
+    if parent == "gumbel":
+        scale = std * np.sqrt(6) / np.pi
+        return gumbel_r(loc=mean - np.euler_gamma * scale, scale=scale)
+    raise ValueError(f"Invalid parent distribution: {parent}")
+
+
+def true_quantiles(parent, **parent_params):
+    """Return the 1-day rainfall of the parent for each return period in 'RETURN_PERIODS'."""
+    return parent_distribution(parent, **parent_params).ppf(1 - 1 / np.asarray(RETURN_PERIODS))
+
+
+def simulate_chunk(parent, sample_size, replicates, seed_sequence, parent_params):
+    """Draw 'replicates' samples from the parent, run them through the batched core and
+    return the sums needed for the selection counts and quantile errors."""
+    rng = np.random.default_rng(seed_sequence)
+    samples = parent_distribution(parent, **parent_params).rvs(
+        size=(replicates, sample_size), random_state=rng)
+    # Annual maxima of daily rainfall are positive
+    samples = np.maximum(samples, 0.1)
+
+    result = batch(samples)
+    valid = result["valid"]
+    truth = true_quantiles(parent, **parent_params)
+
+    selected_error = result["selected_one_day"][valid] - truth
+    fitted_error = result["one_day"][valid] - truth
+
+    return {
+        "replicates": int(valid.sum()),
+        "selection": np.bincount(result["max_dist"][valid], minlength=len(DISTRIBUTIONS)),
+        "selected_error_sum": np.nansum(selected_error, axis=0),
+        "selected_squared_error_sum": np.nansum(selected_error ** 2, axis=0),
+        "selected_error_count": np.isfinite(selected_error).sum(axis=0),
+        "fitted_error_sum": np.nansum(fitted_error, axis=0),
+        "fitted_squared_error_sum": np.nansum(fitted_error ** 2, axis=0),
+        "fitted_error_count": np.isfinite(fitted_error).sum(axis=0)
+    }
+
+
+def summarize(parent, sample_size, chunks, parent_params):
+    """Combine the chunk sums of one parent and sample size into the report entry."""
+    replicates = sum(chunk["replicates"] for chunk in chunks)
+    selection = sum(chunk["selection"] for chunk in chunks)
+    truth = true_quantiles(parent, **parent_params)
+
+    def error_report(prefix):
+        error_sum = sum(chunk[prefix + "_error_sum"] for chunk in chunks)
+        squared_sum = sum(chunk[prefix + "_squared_error_sum"] for chunk in chunks)
+        # Replicates whose quantile is not finite are left out of the sums, and of the means
+        count = sum(chunk[prefix + "_error_count"] for chunk in chunks)
+        with np.errstate(divide="ignore", invalid="ignore"):
+            bias = error_sum / count
+            rmse = np.sqrt(squared_sum / count)
+        return {
+            "bias": bias.round(4).tolist(),
+            "rmse": rmse.round(4).tolist(),
+            "relative_rmse": (rmse / truth).round(4).tolist(),
+            "finite_replicates": count.tolist()
+        }
+
+    correct = sum(selection[DISTRIBUTIONS.index(name)] for name in PARENT_FAMILIES[parent])
+    fitted = error_report("fitted")
+
+    return {
+        "replicates": replicates,
+        "selection": dict(zip(DISTRIBUTIONS, selection.tolist())),
+        "correct_selection_rate": round(correct / replicates, 4) if replicates else None,
+        "true_quantiles": truth.round(4).tolist(),
+        "selected_quantiles": error_report("selected"),
+        "fitted_quantiles": {
+            name: {key: values[index] for key, values in fitted.items()}
+            for index, name in enumerate(DISTRIBUTIONS)
+        }
+    }
+
+
+def main(replicates=10000, sample_sizes=(15, 30, 60), parents=tuple(PARENT_FAMILIES),
+         seed=0, workers=None, chunk_size=CHUNK_SIZE, **parent_params):
+    """Estimate how well the pipeline selects the distribution and estimates the quantiles.
+    Samples are drawn from known parents, split in chunks of 'chunk_size' replicates and run
+    in parallel. Every chunk has its own seed spawned from 'seed', so the report does not
+    depend on the number of workers.
+    Args:
+        replicates (int): Number of synthetic samples per parent and sample size.
+        sample_sizes (tuple): Sample sizes (years) to simulate.
+        parents (tuple): Parent distributions, keys of 'PARENT_FAMILIES'.
+        seed (int): Seed of the whole experiment.
+        workers (int): Number of processes; one runs everything in this process.
+        chunk_size (int): Replicates per task.
+        parent_params: 'mean', 'cv' and 'skew' of the parents.
+    Returns:
+        dict: For each parent and sample size, the selection confusion counts, the rate of
+              correct selections and the bias and RMSE of the 1-day quantiles.
+    """
+    workers = workers or os.cpu_count() or 1
+    chunk_counts = [min(chunk_size, replicates - start) for start in range(0, replicates, chunk_size)]
+
+    tasks = []
+    seed_sequences = iter(np.random.SeedSequence(seed).spawn(
+        len(parents) * len(sample_sizes) * len(chunk_counts)))
+    for parent in parents:
+        for sample_size in sample_sizes:
+            for chunk_replicates in chunk_counts:
+                tasks.append((parent, sample_size, chunk_replicates, next(seed_sequences), parent_params))
+
+    if workers <= 1:
+        chunks = [simulate_chunk(*task) for task in tasks]
+    else:
+        with ProcessPoolExecutor(max_workers=workers) as executor:
+            chunks = list(executor.map(simulate_chunk, *zip(*tasks)))
+
+    report = {"return_periods": RETURN_PERIODS, "parents": {}}
+    for parent in parents:
+        report["parents"][parent] = {}
+        for sample_size in sample_sizes:
+            parent_chunks = [chunk for task, chunk in zip(tasks, chunks)
+                             if task[0] == parent and task[1] == sample_size]
+            report["parents"][parent][str(sample_size)] = summarize(
+                parent, sample_size, parent_chunks, parent_params)
+    return report
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(
+        description="Monte Carlo validation of the distribution selection and quantile estimates.")
+    parser.add_argument("--replicates", type=int, default=10000)
+    parser.add_argument("--sizes", type=int, nargs="+", default=[15, 30, 60])
+    parser.add_argument("--parents", nargs="+", default=list(PARENT_FAMILIES), choices=list(PARENT_FAMILIES))
+    parser.add_argument("--seed", type=int, default=0)
+    parser.add_argument("--workers", type=int, default=None)
+    parser.add_argument("--mean", type=float, default=DEFAULT_MEAN)
+    parser.add_argument("--cv", type=float, default=DEFAULT_CV)
+    parser.add_argument("--skew", type=float, default=DEFAULT_SKEW)
+    args = parser.parse_args()
+
+    print(json.dumps(main(args.replicates, tuple(args.sizes), tuple(args.parents), args.seed,
+                          args.workers, mean=args.mean, cv=args.cv, skew=args.skew), indent=2))
@@ -0,0 +1,204 @@
+from functools import partial
+
+import numpy as np
+
+from batch import batch_k_coefficient, batch_rain_intensity_calculations
+from disaggregation_coef import disaggregation_coef
+from k_coefficient import DISTRIBUTIONS, RETURN_PERIODS
+from metrics import new_metrics, stage
+from scheduler import CPU_EXECUTOR, run_graph
+from ventechow import (calculate_i, condition_points, handle_dist_name, ns_coefficient,
+                       optimize_parameters, relative_error)
+from yn_sigman import yn_sigman_values
+
+# Constants
+WINDOW_SIZE = 30
+# Windows with fewer years of data are skipped, as records are in 'process_data.main'
+MIN_YEARS = 10
+PARAMETER_NAMES = ("k", "m", "c", "n")
+INSUFFICIENT_DATA = "Dados não são sufientes para completar a análise"
+
+
+def rolling_sums(values, present, window_size):
+    """Return the count and the sums of the first three powers of the values in every
+    window of consecutive years, as differences of prefix sums.
+    Args:
+        values (ndarray): One value per year; ignored where 'present' is False.
+        present (ndarray): True for the years with data.
+        window_size (int): Years per window.
+    Returns:
+        ndarray: 4 x windows; count, sum, sum of squares and sum of cubes.
+    """
+    values = np.where(present, values, 0.0)
+    powers = np.stack([present.astype(float), values, values ** 2, values ** 3])
+    prefix = np.concatenate([np.zeros((4, 1)), np.cumsum(powers, axis=1)], axis=1)
+    return prefix[:, window_size:] - prefix[:, :-window_size]
+
+
+def window_moments(values, present, window_size):
+    """Return the sample size, mean, standard deviation (ddof=1) and the skewness
+    coefficient of 'distributions.params_calculation' of every window.
+    The values are centred on the mean of the record before the power sums, so the
+    differences of the prefix sums do not lose precision."""
+    shift = values[present].mean()
+    count, sum_1, sum_2, sum_3 = rolling_sums(values - shift, present, window_size)
+    with np.errstate(divide="ignore", invalid="ignore"):
+        mean = sum_1 / count
+        squared_deviations = sum_2 - count * mean ** 2
+        cubed_deviations = sum_3 - 3 * mean * sum_2 + 2 * count * mean ** 3
+        std = np.sqrt(squared_deviations / (count - 1))
+        skew = count / ((count - 1) * (count - 2)) * cubed_deviations / std ** 3
+    return count, mean + shift, std, skew
+
+
+def window_params(water_years, maxima, window_size=WINDOW_SIZE):
+    """Compute the parameters of 'distributions.params_calculation' for every window of
+    consecutive hydrological years.
+    Args:
+        water_years (ndarray): Hydrological year of every annual maximum.
+        maxima (ndarray): The annual maxima.
+        window_size (int): Years per window.
+    Returns:
+        tuple: The first year of every window and the parameters, a dictionary of arrays
+               with one value per window under the keys of the scalar version.
+    """
+    years = np.arange(water_years.min(), water_years.max() + 1)
+    present = np.isin(years, water_years)
+    values = np.zeros(years.size)
+    values[np.searchsorted(years, water_years)] = maxima
+
+    sample_size, mean, std_dev, g = window_moments(values, present, window_size)
+    log_values = np.log10(np.where(present, values, 1.0))
+    _, meanw, stdw, gw = window_moments(log_values, present, window_size)
+    yn, sigman = yn_sigman_values(np.maximum(sample_size, 1).astype(int))
+
+    with np.errstate(divide="ignore"):
+        params = {
+            "size": sample_size.astype(int),
+            "mean": mean,
+            "std_dev": std_dev,
+            "g": g,
+            "alpha": 4 / (g * g),
+            "meanw": meanw,
+            "stdw": stdw,
+            "gw": gw,
+            "alphaw": 4 / (gw * gw),
+            "sigman": sigman,
+            "yn": yn
+        }
+    return years[:years.size - window_size + 1], params
+
+
+def fit_windows(matrices, condition, trace=False, deadline=None):
+    """Fit one condition of the Ven Te Chow equation for every window in order, each fit
+    starting from the parameters of the previous window.
+    Returns:
+        tuple: The parameters and the optimizer report of every window.
+    """
+    parameters, reports = [], []
+    previous = None
+    for matrix in matrices:
+        fitted, report = optimize_parameters(matrix, condition, trace, deadline, initial_guess=previous)
+        parameters.append(fitted)
+        reports.append(report)
+        previous = fitted
+    return parameters, reports
+
+
+def summarize_reports(reports):
+    """Combine the optimizer reports of the windows of one condition.
+    BFGS seldom meets its gradient tolerance on this objective and ends on a loss of
+    precision, so instead of the convergence flags the summary counts the windows stopped
+    by the evaluation budget or the deadline, and the work spent. When the fits were
+    traced, the trajectory of every window is kept under 'trajectories'."""
+    summary = {
+        "windows": len(reports),
+        "stopped": next((report["stopped"] for report in reports if report["stopped"]), None),
+        "stopped_windows": sum(bool(report["stopped"]) for report in reports),
+        "iterations": sum(report["iterations"] for report in reports),
+        "function_evaluations": sum(report["function_evaluations"] for report in reports),
+        "elapsed": round(sum(report["elapsed"] for report in reports), 4)
+    }
+    if any("trajectory" in report for report in reports):
+        summary["trajectories"] = [report.get("trajectory", []) for report in reports]
+    return summary
+
+
+def main(annual_maxima, dist_name, window_size=WINDOW_SIZE, trace=False, metrics=None, deadline=None):
+    """Compute the IDF parameters over sliding windows of consecutive hydrological years.
+    The moments behind the distribution parameters are updated from one window to the
+    next by rolling sums, and the Ven Te Chow fits of every window start from the
+    parameters of the previous one.
+    Args:
+        annual_maxima (DataFrame): The annual maxima of 'process_data.main', after the outlier test.
+        dist_name (str): Distribution of 'k_coefficient.DISTRIBUTIONS' used in every window.
+        window_size (int): Years per window; windows move one year at a time.
+        trace (bool): Record the objective trajectory of each fit.
+        metrics (dict): Request metrics; the stages are recorded in it.
+        deadline (float): Time ('time.time()') after which the fits are stopped.
+    Returns:
+        dict: The time series of the parameters, one entry per window under 'windows',
+              or a message when no window has enough years of data.
+    """
+    if metrics is None:
+        metrics = new_metrics()
+    annual_maxima = annual_maxima.sort_values("AnoHidrologico")
+    water_years = annual_maxima["AnoHidrologico"].to_numpy()
+    if water_years.max() - water_years.min() + 1 < window_size:
+        return INSUFFICIENT_DATA
+
+    with stage(metrics, "window_params"):
+        first_years, params = window_params(water_years, annual_maxima["Pmax_anual"].to_numpy(dtype=float),
+                                            window_size)
+        valid = params["size"] >= MIN_YEARS
+        first_years = first_years[valid]
+        params = {key: value[valid] for key, value in params.items()}
+        if not first_years.size:
+            return INSUFFICIENT_DATA
+
+        with np.errstate(divide="ignore", invalid="ignore"):
+            k = batch_k_coefficient(params)
+            _, intensities, durations = batch_rain_intensity_calculations(k, params)
+        intensities = intensities[:, DISTRIBUTIONS.index(dist_name)]
+
+    _, time_interval = disaggregation_coef()
+    tr = np.asarray(RETURN_PERIODS, dtype=float)
+    td = np.array([time_interval[name] * 60 for name in durations], dtype=float)
+    matrices = [{"tr": tr, "td": td, "i_real": i_real} for i_real in intensities]
+
+    fits = run_graph({
+        f"window_condition_{condition}": (partial(fit_windows, matrices, condition, trace, deadline), [])
+        for condition in (1, 2)
+    }, "moving_window", metrics, executor_type=CPU_EXECUTOR)
+
+    windows = {
+        "first_year": first_years.tolist(),
+        "last_year": (first_years + window_size - 1).tolist(),
+        "sample_size": params["size"].tolist(),
+        "mean": params["mean"].tolist(),
+        "std_dev": params["std_dev"].tolist(),
+        "g": params["g"].tolist()
+    }
+    optimization = {}
+    for condition in (1, 2):
+        parameters, reports = fits[f"window_condition_{condition}"]
+        fit_quality = []
+        for matrix, fitted in zip(matrices, parameters):
+            tr_points, td_points, i_real = condition_points(matrix, condition)
+            i_calculated = calculate_i(tr_points, td_points, fitted)
+            fit_quality.append((relative_error(i_calculated, i_real).mean(), ns_coefficient(i_real, i_calculated)))
+
+        windows[f"parameters_{condition}"] = {
+            f"{name}{condition}": [float(fitted[index]) for fitted in parameters]
+            for index, name in enumerate(PARAMETER_NAMES)
+        }
+        windows[f"mean_relative_error_{condition}"] = [float(error) for error, _ in fit_quality]
+        windows[f"ns_{condition}"] = [float(ns) for _, ns in fit_quality]
+        optimization[f"condition_{condition}"] = summarize_reports(reports)
+
+    return {
+        "window_size": window_size,
+        "dist": handle_dist_name({"max_dist": dist_name}),
+        "windows": windows,
+        "optimization": optimization
+    }
@@ -1,6 +1,6 @@
 import numpy as np
 import pandas as pd
-from grubbs_test import grubbs_test_table
+from grubbs_test import grubbs_critical_value
 
 
 def calculate_statistics(df):
@@ -23,12 +23,11 @@ def calculate_statistics(df):
     return sample_size, mean, ln_mean, std, ln_std
 
 
-def calc_critical_values(grubbs_test, sample_size, ln_p_mean, ln_p_std):
+def calc_critical_values(sample_size, ln_p_mean, ln_p_std):
     """
     Function to calculate critical values (t_crit_10, x_h, x_l) 
     based on Grubbs, and Grubbs and Beck Test.
     Args:
-        grubbs_test (Dictionary): The dictionary containing the Grubbs' Test values.
         sample_size (int): The size of the sample.
         ln_p_mean (float): The natural logarithm of the mean.
         ln_p_std (float): The natural logarithm of the standard deviation.
@@ -37,7 +36,7 @@ def calc_critical_values(grubbs_test, sample_size, ln_p_mean, ln_p_std):
     """
 
     # Calculate critical values for Grubbs' test
-    t_crit_10 = grubbs_test[sample_size]
+    t_crit_10 = grubbs_critical_value(sample_size)
 
     # Calculate critical values for Grubbs and Beck' test
     k_n_10 = -3.62201 + 6.28446*(sample_size**0.25) - 2.49835*(
@@ -92,7 +91,6 @@ def main(processed_data):
     Main function to calculate statistics, calculate critical values, and remove outliers.
     Args:
         processed_data (DataFrame): The processed dataframe.
-        grubbs_test (Dictionary): The dictionary containing the Grubbs' Test values.
     Returns:
         DataFrame: Returns the processed dataframe with outliers removed.
     """
@@ -100,9 +98,8 @@ def main(processed_data):
     try:
         sample_size, p_mean, ln_p_mean, p_std, ln_p_std = calculate_statistics(
             processed_data)
-        grubbs_test = grubbs_test_table()
         t_crit_10, x_h, x_l = calc_critical_values(
-            grubbs_test, sample_size, ln_p_mean, ln_p_std)
+            sample_size, ln_p_mean, ln_p_std)
         
         no_outliers_data = remove_outliers(
             processed_data, p_mean, p_std, t_crit_10, x_h, x_l)
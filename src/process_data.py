@@ -87,6 +87,11 @@ def remove_out_of_cycle_data(df):
     return df
 
 
+def water_year(dates):
+    """Return the hydrological year (October to September) of each date, named after the year it starts."""
+    return dates.dt.year.where(dates.dt.month >= 10, dates.dt.year - 1)
+
+
 def add_water_year(df):
     """
     Function to add a new column for the hydrological year and group the data by the maxima per hydrological year.
@@ -96,8 +101,7 @@ def add_water_year(df):
         DataFrame: Returns the dataframe with the new 'AnoHidrologico' and 'ln_Pmax_anual' columns.
     """
 
-    df["AnoHidrologico"] = df["Data"].dt.year.where(
-        df["Data"].dt.month >= 10, df["Data"].dt.year - 1)
+    df["AnoHidrologico"] = water_year(df["Data"])
 
     water_year_df = df.groupby("AnoHidrologico")["Maxima"].max(
     ).reset_index().rename(columns={"Maxima": "Pmax_anual"})
@@ -134,10 +138,12 @@ def check_empty_year(water_year_data):
     return water_year_data, empty_years
 
 
-def main(raw_df):
+def monthly_series(raw_df):
     """
-    Main function to process the raw data, get consistent and raw data,
-    merge and fill the data, remove out of cycle data, and add a water year.
+    Function to process the raw data into the series of monthly maxima of complete hydrological years,
+    filling the months without consistent data with the raw data.
+    Returns:
+        tuple: The monthly series ('Data' and 'Maxima') and whether there was no consistent data.
     """
 
     raw_df = raw_df.fillna(0)
@@ -154,6 +160,16 @@ def main(raw_df):
             consistent_rain_data, raw_rain_data)
 
     filled_rain_data = remove_out_of_cycle_data(filled_rain_data)
+    return filled_rain_data, empty_consistent_data
+
+
+def main(raw_df):
+    """
+    Main function to process the raw data, get consistent and raw data,
+    merge and fill the data, remove out of cycle data, and add a water year.
+    """
+
+    filled_rain_data, empty_consistent_data = monthly_series(raw_df)
 
     water_year_data = add_water_year(filled_rain_data)
 
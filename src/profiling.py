@@ -0,0 +1,94 @@
+import cProfile
+import io
+import itertools
+import os
+import pstats
+import threading
+import time
+import tracemalloc
+
+from metrics import start_memory_peak, stop_memory_peak
+
+# Constants
+PROFILE_ENV = "IDF_PROFILE"
+PROFILE_DIR_ENV = "IDF_PROFILE_DIR"
+PROFILE_TOP_FUNCTIONS = 25
+
+# Profiling sessions share tracemalloc, which is only stopped when the last of them ends
+_tracing = {"sessions": 0, "started_tracemalloc": False}
+_tracing_lock = threading.Lock()
+_trace_numbers = itertools.count()
+
+
+def profiling_requested(flag=False):
+    """Return True when profiling was asked for by the request flag or the environment."""
+    if isinstance(flag, str):
+        flag = flag.lower() in ("1", "true", "yes")
+    return bool(flag) or os.environ.get(PROFILE_ENV, "").lower() in ("1", "true", "yes")
+
+
+def start_profile(metrics):
+    """Start a cProfile trace and the memory tracking used by the stages of 'metrics'.
+    Returns:
+        dict: The profiling session to be passed to 'stop_profile'.
+    """
+    with _tracing_lock:
+        if _tracing["sessions"] == 0 and not tracemalloc.is_tracing():
+            tracemalloc.start()
+            _tracing["started_tracemalloc"] = True
+        _tracing["sessions"] += 1
+    metrics["memory_peak_kb"] = {}
+
+    profiler = cProfile.Profile()
+    session = {
+        "profiler": profiler,
+        "memory_token": start_memory_peak(),
+        "start": time.perf_counter()
+    }
+    profiler.enable()
+    return session
+
+
+def stop_profile(session, name):
+    """Stop the profiling session and summarize it.
+    Args:
+        session (dict): The session returned by 'start_profile'.
+        name (str): Name used for the trace file, e.g. the CSV file name.
+    Returns:
+        dict: Total time, the most expensive functions and, when IDF_PROFILE_DIR is set,
+              the path of the written cProfile trace.
+    """
+    profiler = session["profiler"]
+    profiler.disable()
+    elapsed = time.perf_counter() - session["start"]
+
+    # The stages reset the tracemalloc peak, so the request keeps its own
+    peak = stop_memory_peak(session["memory_token"])
+    with _tracing_lock:
+        _tracing["sessions"] -= 1
+        if _tracing["sessions"] == 0 and _tracing["started_tracemalloc"]:
+            tracemalloc.stop()
+            _tracing["started_tracemalloc"] = False
+
+    stream = io.StringIO()
+    stats = pstats.Stats(profiler, stream=stream)
+    stats.sort_stats("cumulative").print_stats(PROFILE_TOP_FUNCTIONS)
+
+    summary = {
+        "total_time": round(elapsed, 4),
+        "memory_peak_kb": round(peak / 1024, 1),
+        "top_functions": stream.getvalue()
+    }
+
+    profile_dir = os.environ.get(PROFILE_DIR_ENV)
+    if profile_dir:
+        os.makedirs(profile_dir, exist_ok=True)
+        base_name = os.path.splitext(os.path.basename(str(name)))[0]
+        # Concurrent requests start within the same second, so the name also has the
+        # process and a number unique within it
+        trace_path = os.path.join(profile_dir, f"{base_name}-{time.strftime('%Y%m%d-%H%M%S')}"
+                                               f"-{os.getpid()}-{next(_trace_numbers)}.prof")
+        stats.dump_stats(trace_path)
+        summary["trace_path"] = trace_path
+
+    return summary
@@ -0,0 +1,293 @@
+import argparse
+import copy
+import glob
+import json
+import math
+import os
+import sys
+import time
+
+import fit_cache
+import result_store
+from main import configure_logging, main as idf_pipeline
+from serialization import prepare
+
+# Constants
+CORPUS_DIR = os.path.join(os.path.dirname(os.path.abspath(__file__)), "csv")
+GOLDEN_DIR = os.path.join(os.path.dirname(os.path.abspath(__file__)), "golden")
+OUTPUTS_FILE = "outputs.json"
+TIMINGS_FILE = "timings.json"
+# Output changes accepted since the outputs were recorded, by request
+ACCEPTED_FILE = "accepted.json"
+RELATIVE_TOLERANCE = 1e-9
+ABSOLUTE_TOLERANCE = 1e-12
+# Optimizer work, inside 'optimization', may grow by this share of its golden value; less is fine
+EVALUATION_TOLERANCE = 0.2
+# A stage regresses when it is this much slower than its baseline...
+TIME_THRESHOLD = 0.5
+# ...and slower by at least this many seconds, so that noise in fast stages is ignored
+MIN_TIME_DIFFERENCE = 0.01
+# Output keys that change from run to run
+IGNORED_KEYS = ("metrics", "profile", "elapsed")
+OPTIMIZER_COUNT_KEYS = ("iterations", "function_evaluations", "gradient_evaluations")
+# Optimizer messages, skipped inside 'optimization'; their wording changes between SciPy versions
+OPTIMIZER_TELEMETRY_KEYS = ("message", "status")
+
+
+def corpus_files(corpus_dir=CORPUS_DIR):
+    """Return the station files of the corpus, by file name."""
+    return {os.path.basename(path): path for path in sorted(glob.glob(os.path.join(corpus_dir, "*.csv")))}
+
+
+def run_station(csv_file_path):
+    """Run the default pipeline on a station from a clean state, so neither earlier fits
+    nor stored results are reused.
+    Returns:
+        tuple: The output in JSON types and the stage timings of the run.
+    """
+    fit_cache.clear()
+    output = idf_pipeline(csv_file_path, timeout=None)
+    timings = dict(output["metrics"]["stages"]) if isinstance(output, dict) else {}
+    return prepare(output), timings
+
+
+def run_corpus(files, repeat=1):
+    """Run every station 'repeat' times.
+    Returns:
+        tuple: The output of every station and the time of every stage summed over the
+               corpus, taking the fastest of the repeats of each station.
+    """
+    # The gate measures the computation, never the result store
+    result_store.RESULT_STORE_DIR = None
+    outputs, timings = {}, {}
+    for name, path in files.items():
+        runs = [run_station(path) for _ in range(repeat)]
+        outputs[name] = runs[0][0]
+        for stage in set().union(*(run_timings for _, run_timings in runs)):
+            timings[stage] = timings.get(stage, 0) + min(run_timings.get(stage, math.inf) for _, run_timings in runs)
+    return outputs, {stage: round(value, 4) for stage, value in sorted(timings.items())}
+
+
+def compare(golden, actual, path="", rtol=RELATIVE_TOLERANCE, atol=ABSOLUTE_TOLERANCE,
+            evaluation_tolerance=EVALUATION_TOLERANCE):
+    """Compare an output with its golden value field by field.
+    Numbers match within the tolerances; every other value must be equal. Inside
+    'optimization', the counts of 'OPTIMIZER_COUNT_KEYS' may exceed their golden value by
+    'evaluation_tolerance' of it, and the keys of 'OPTIMIZER_TELEMETRY_KEYS' are skipped, as
+    are those of 'IGNORED_KEYS' everywhere.
+    Returns:
+        list: One (path, golden, actual) tuple per difference.
+    """
+    if isinstance(golden, dict) and isinstance(actual, dict):
+        differences = []
+        in_optimization = "optimization" in path.split("/")
+        for key in sorted(set(golden) | set(actual)):
+            if key in IGNORED_KEYS or (in_optimization and key in OPTIMIZER_TELEMETRY_KEYS):
+                continue
+            key_path = f"{path}/{key}"
+            if key not in actual:
+                differences.append((key_path, golden[key], "<missing>"))
+            elif key not in golden:
+                differences.append((key_path, "<missing>", actual[key]))
+            elif in_optimization and key in OPTIMIZER_COUNT_KEYS and all(
+                    isinstance(value, int) for value in (golden[key], actual[key])):
+                if actual[key] > golden[key] * (1 + evaluation_tolerance):
+                    differences.append((key_path, golden[key], actual[key]))
+            else:
+                differences.extend(compare(golden[key], actual[key], key_path, rtol, atol, evaluation_tolerance))
+        return differences
+    if isinstance(golden, list) and isinstance(actual, list):
+        if len(golden) != len(actual):
+            return [(f"{path}/length", len(golden), len(actual))]
+        return [difference for index, (golden_item, actual_item) in enumerate(zip(golden, actual))
+                for difference in compare(golden_item, actual_item, f"{path}/{index}", rtol, atol,
+                                          evaluation_tolerance)]
+    numbers = all(isinstance(value, (int, float)) and not isinstance(value, bool) for value in (golden, actual))
+    if numbers:
+        if (math.isnan(golden) and math.isnan(actual)) or math.isclose(golden, actual, rel_tol=rtol, abs_tol=atol):
+            return []
+    elif golden == actual:
+        return []
+    return [(path or "/", golden, actual)]
+
+
+def load_accepted(golden_dir=GOLDEN_DIR):
+    """Return the accepted output changes: for every request id, the 'reason' and the
+    accepted 'outputs', station -> top-level output key -> value."""
+    path = os.path.join(golden_dir, ACCEPTED_FILE)
+    if not os.path.exists(path):
+        return {}
+    with open(path, encoding="utf-8") as accepted_file:
+        return json.load(accepted_file)
+
+
+def expected_outputs(golden_outputs, accepted):
+    """Return the golden outputs with the accepted changes applied, in request order."""
+    expected = copy.deepcopy(golden_outputs)
+    for change in accepted.values():
+        for name, keys in change["outputs"].items():
+            expected[name].update(copy.deepcopy(keys))
+    return expected
+
+
+def accept(request_id, reason, keys=None, corpus_dir=CORPUS_DIR, golden_dir=GOLDEN_DIR):
+    """Run the corpus and accept its current differences from the expected outputs as the
+    change of a request, leaving the recorded outputs as they are.
+    Args:
+        request_id (str): The request that changed the outputs.
+        reason (str): Why the change is correct.
+        keys (list): Only accept differences under these top-level output keys.
+    Returns:
+        dict: The accepted output keys of every station.
+    """
+    with open(os.path.join(golden_dir, OUTPUTS_FILE), encoding="utf-8") as outputs_file:
+        golden_outputs = json.load(outputs_file)
+    accepted = load_accepted(golden_dir)
+    expected = expected_outputs(golden_outputs, accepted)
+    outputs, _ = run_corpus(corpus_files(corpus_dir))
+
+    change = accepted.setdefault(request_id, {"reason": reason, "outputs": {}})
+    change["reason"] = reason
+    for name in sorted(outputs):
+        if name not in expected or not isinstance(outputs[name], dict):
+            continue
+        changed = {path.split("/")[1] for path, _, _ in compare(expected[name], outputs[name])}
+        for key in sorted(changed):
+            if keys and key not in keys:
+                continue
+            if key not in outputs[name]:
+                raise ValueError(f"{name} lost '{key}'; record the outputs again instead")
+            change["outputs"].setdefault(name, {})[key] = outputs[name][key]
+
+    with open(os.path.join(golden_dir, ACCEPTED_FILE), "w", encoding="utf-8") as accepted_file:
+        json.dump(accepted, accepted_file, indent=1, ensure_ascii=False)
+        accepted_file.write("\n")
+    return {name: sorted(accepted_keys) for name, accepted_keys in change["outputs"].items()}
+
+
+def compare_timings(baseline, current, threshold=TIME_THRESHOLD, min_difference=MIN_TIME_DIFFERENCE):
+    """Compare the stage timings with their baselines.
+    Returns:
+        dict: For every stage in both, the 'baseline', 'current' and 'ratio' times and
+              whether it 'regressed'.
+    """
+    report = {}
+    for stage in sorted(set(baseline) & set(current)):
+        ratio = current[stage] / baseline[stage] if baseline[stage] else None
+        report[stage] = {
+            "baseline": baseline[stage],
+            "current": current[stage],
+            "ratio": round(ratio, 3) if ratio is not None else None,
+            "regressed": (current[stage] - baseline[stage] > min_difference
+                          and (ratio is None or ratio > 1 + threshold))
+        }
+    return report
+
+
+def record(corpus_dir=CORPUS_DIR, golden_dir=GOLDEN_DIR, repeat=3, timings_only=False):
+    """Run the corpus and store its outputs and stage timings as the golden results.
+    Recording the outputs starts a new baseline and drops the accepted changes, so an output
+    change is normally accepted with 'accept' instead. Timings depend on the machine, so
+    they are recorded again, with 'timings_only', on the machine that runs the gate."""
+    outputs, timings = run_corpus(corpus_files(corpus_dir), repeat)
+    os.makedirs(golden_dir, exist_ok=True)
+    if not timings_only:
+        with open(os.path.join(golden_dir, OUTPUTS_FILE), "w", encoding="utf-8") as outputs_file:
+            json.dump(outputs, outputs_file, indent=1, ensure_ascii=False)
+            outputs_file.write("\n")
+        if os.path.exists(os.path.join(golden_dir, ACCEPTED_FILE)):
+            os.remove(os.path.join(golden_dir, ACCEPTED_FILE))
+    with open(os.path.join(golden_dir, TIMINGS_FILE), "w", encoding="utf-8") as timings_file:
+        json.dump(timings, timings_file, indent=1)
+        timings_file.write("\n")
+    return {"stations": len(outputs), "timings": timings}
+
+
+def check(corpus_dir=CORPUS_DIR, golden_dir=GOLDEN_DIR, repeat=3, rtol=RELATIVE_TOLERANCE,
+          atol=ABSOLUTE_TOLERANCE, threshold=TIME_THRESHOLD, skip_timings=False,
+          evaluation_tolerance=EVALUATION_TOLERANCE):
+    """Run the corpus and compare it with the golden results, with the accepted changes applied.
+    Args:
+        repeat (int): Runs of every station; the fastest one is timed.
+        rtol (float): Relative tolerance of the numbers.
+        atol (float): Absolute tolerance of the numbers.
+        threshold (float): Relative slowdown of a stage that fails the gate.
+        skip_timings (bool): Only compare the outputs.
+        evaluation_tolerance (float): Relative growth of the optimizer work that fails the gate.
+    Returns:
+        dict: The accepted changes, the differences of every station, the timing comparison,
+              and whether the gate 'passed'.
+    """
+    with open(os.path.join(golden_dir, OUTPUTS_FILE), encoding="utf-8") as outputs_file:
+        golden_outputs = json.load(outputs_file)
+    accepted = load_accepted(golden_dir)
+    golden_outputs = expected_outputs(golden_outputs, accepted)
+    files = corpus_files(corpus_dir)
+    outputs, timings = run_corpus(files, 1 if skip_timings else repeat)
+
+    differences = {}
+    for name in sorted(set(golden_outputs) | set(outputs)):
+        if name not in outputs or name not in golden_outputs:
+            differences[name] = [("/", "<missing>" if name not in golden_outputs else "present",
+                                  "<missing>" if name not in outputs else "present")]
+            continue
+        station_differences = compare(golden_outputs[name], outputs[name], rtol=rtol, atol=atol,
+                                      evaluation_tolerance=evaluation_tolerance)
+        if station_differences:
+            differences[name] = station_differences
+
+    timing_report = {}
+    if not skip_timings:
+        with open(os.path.join(golden_dir, TIMINGS_FILE), encoding="utf-8") as timings_file:
+            timing_report = compare_timings(json.load(timings_file), timings, threshold)
+    regressed = [stage for stage, entry in timing_report.items() if entry["regressed"]]
+
+    return {
+        "stations": len(outputs),
+        "accepted": {request_id: change["reason"] for request_id, change in accepted.items()},
+        "output_differences": {
+            name: [{"field": field, "golden": golden, "actual": actual} for field, golden, actual in entries]
+            for name, entries in differences.items()
+        },
+        "timings": timing_report,
+        "regressed_stages": regressed,
+        "passed": not differences and not regressed
+    }
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(
+        description="Compare the pipeline outputs and stage timings on a corpus of stations with golden results.")
+    subparsers = parser.add_subparsers(dest="command", required=True)
+    record_parser = subparsers.add_parser("record", help="Store the current outputs and timings as golden")
+    record_parser.add_argument("--timings-only", action="store_true", help="Only record the timing baselines")
+    accept_parser = subparsers.add_parser("accept", help="Accept the current output changes for a request")
+    accept_parser.add_argument("request_id", help="The request that changed the outputs")
+    accept_parser.add_argument("--reason", required=True, help="Why the new outputs are correct")
+    accept_parser.add_argument("--keys", nargs="+", help="Only accept changes under these output keys")
+    check_parser = subparsers.add_parser("check", help="Fail when the outputs or the timings regress")
+    check_parser.add_argument("--rtol", type=float, default=RELATIVE_TOLERANCE)
+    check_parser.add_argument("--atol", type=float, default=ABSOLUTE_TOLERANCE)
+    check_parser.add_argument("--time-threshold", type=float, default=TIME_THRESHOLD)
+    check_parser.add_argument("--evaluation-tolerance", type=float, default=EVALUATION_TOLERANCE)
+    check_parser.add_argument("--skip-timings", action="store_true")
+    for subparser in (record_parser, accept_parser, check_parser):
+        subparser.add_argument("--corpus", default=CORPUS_DIR, help="Directory of the station CSV files")
+        subparser.add_argument("--golden", default=GOLDEN_DIR, help="Directory of the golden results")
+    for subparser in (record_parser, check_parser):
+        subparser.add_argument("--repeat", type=int, default=3)
+    args = parser.parse_args()
+    configure_logging()
+
+    start = time.perf_counter()
+    if args.command == "record":
+        result = record(args.corpus, args.golden, args.repeat, args.timings_only)
+    elif args.command == "accept":
+        result = {"accepted": accept(args.request_id, args.reason, args.keys, args.corpus, args.golden)}
+    else:
+        result = check(args.corpus, args.golden, args.repeat, args.rtol, args.atol,
+                       args.time_threshold, args.skip_timings, args.evaluation_tolerance)
+    result["elapsed"] = round(time.perf_counter() - start, 3)
+    print(json.dumps(result, indent=2, ensure_ascii=False))
+    if args.command == "check" and not result["passed"]:
+        sys.exit(1)
@@ -0,0 +1,142 @@
+import hashlib
+import json
+import os
+import re
+import threading
+
+import pandas as pd
+
+from serialization import to_json
+
+# Constants
+# Bump when a change to the pipeline changes its outputs, so stored results are recomputed
+PIPELINE_VERSION = "4"
+RESULT_STORE_DIR = os.environ.get("IDF_RESULT_STORE")
+# Output keys that describe one request rather than the station
+REQUEST_KEYS = ("metrics", "profile")
+# Station codes name the result files, so they are limited to characters safe in a file name
+STATION_CODE_PATTERN = re.compile(r"^[A-Za-z0-9_-]+$")
+
+_results = {}
+# Modification time of the version directory and of each result file when last loaded
+_loaded = {"mtime": None, "files": {}}
+_lock = threading.Lock()
+
+
+class InvalidStationCode(ValueError):
+    """Raised for a station code that cannot name a result file."""
+
+
+def result_path(station_code):
+    """Return the path of the result file of a station.
+    Raises:
+        InvalidStationCode: When the code has characters other than letters, digits, '_' and
+                            '-', e.g. a path separator from a crafted CSV header.
+    """
+    if not STATION_CODE_PATTERN.match(str(station_code)):
+        raise InvalidStationCode(f"Invalid station code: {station_code!r}")
+    return os.path.join(version_dir(), f"{station_code}.json")
+
+
+def enabled():
+    """Return True when a result store directory is configured."""
+    return bool(RESULT_STORE_DIR)
+
+
+def data_fingerprint(raw_data):
+    """Return a hash of the series returned by 'load_data', so a stored result is only
+    replaced when new data for the station arrives."""
+    hashes = pd.util.hash_pandas_object(raw_data[["NivelConsistencia", "Data", "Maxima"]], index=False)
+    return hashlib.blake2b(hashes.to_numpy().tobytes(), digest_size=16).hexdigest()
+
+
+def version_dir(version=PIPELINE_VERSION):
+    """Return the directory of the results of a pipeline version."""
+    return os.path.join(RESULT_STORE_DIR, f"v{version}")
+
+
+def refresh():
+    """Bring the stored results of the current pipeline version in memory up to date with
+    the files written by other processes. Only the files added or changed since the last
+    refresh are read, and only when the directory changed at all."""
+    directory = version_dir()
+    try:
+        mtime = os.stat(directory).st_mtime_ns
+    except FileNotFoundError:
+        return
+    if mtime == _loaded["mtime"]:
+        return
+
+    with _lock:
+        files = {}
+        for file in os.scandir(directory):
+            if not file.name.endswith(".json"):
+                continue
+            try:
+                files[file.name] = file.stat().st_mtime_ns
+            except FileNotFoundError:
+                continue
+        for file_name in set(_loaded["files"]) - set(files):
+            _results.pop(file_name[:-len(".json")], None)
+            del _loaded["files"][file_name]
+        for file_name, file_mtime in files.items():
+            if _loaded["files"].get(file_name) == file_mtime:
+                continue
+            try:
+                with open(os.path.join(directory, file_name), encoding="utf-8") as result_file:
+                    entry = json.load(result_file)
+            except (OSError, ValueError) as e:
+                print(f"Error reading stored result {file_name}: {e}")
+                continue
+            _results[entry["code"]] = entry
+            _loaded["files"][file_name] = file_mtime
+        _loaded["mtime"] = mtime
+
+
+def get(station_code, fingerprint=None):
+    """Return the stored entry of a station, or None when the station has no result for the
+    current pipeline version or, when 'fingerprint' is given, its data changed.
+    Returns:
+        dict: 'code', 'version', 'fingerprint' and the 'output' of the pipeline.
+    Raises:
+        InvalidStationCode: When the code cannot name a result file.
+    """
+    if not enabled() or station_code is None:
+        return None
+    result_path(station_code)
+    refresh()
+    entry = _results.get(station_code)
+    if entry is None or (fingerprint is not None and entry["fingerprint"] != fingerprint):
+        return None
+    return entry
+
+
+def put(station_code, fingerprint, output):
+    """Store the output of a station under the current pipeline version, replacing the
+    previous one. The file is written next to its destination and renamed, so readers
+    never see a partial result.
+    Raises:
+        InvalidStationCode: When the code cannot name a result file.
+    """
+    if not enabled() or station_code is None:
+        return
+    entry = {
+        "code": station_code,
+        "version": PIPELINE_VERSION,
+        "fingerprint": fingerprint,
+        "output": {key: value for key, value in output.items() if key not in REQUEST_KEYS}
+    }
+    path = result_path(station_code)
+    os.makedirs(os.path.dirname(path), exist_ok=True)
+    temporary_path = f"{path}.{os.getpid()}.{threading.get_ident()}.tmp"
+    body = to_json(entry)
+    with open(temporary_path, "wb") as result_file:
+        result_file.write(body)
+    os.replace(temporary_path, path)
+
+    # Keep the written entry in its JSON form, as a reload from disk would return it; the
+    # next refresh then skips the file
+    entry = json.loads(body)
+    with _lock:
+        _results[station_code] = entry
+        _loaded["files"][os.path.basename(path)] = os.stat(path).st_mtime_ns
@@ -0,0 +1,172 @@
+import os
+import threading
+import time
+from concurrent.futures import FIRST_COMPLETED, ProcessPoolExecutor, ThreadPoolExecutor, wait
+
+from metrics import stage
+
+# Constants
+SCHEDULER_WORKERS = int(os.environ.get("IDF_SCHEDULER_WORKERS", os.cpu_count() or 1))
+# Executor for CPU-bound, picklable nodes such as the optimizer fits ('thread' or 'process')
+CPU_EXECUTOR = os.environ.get("IDF_CPU_EXECUTOR", "thread")
+
+_process_executors = {}
+_thread_executors = {}
+_executors_lock = threading.Lock()
+
+
+def get_process_executor(max_workers=SCHEDULER_WORKERS):
+    """Return a process pool shared by every request, created on first use.
+    Functions and inputs sent to it must be picklable."""
+    with _executors_lock:
+        if max_workers not in _process_executors:
+            _process_executors[max_workers] = ProcessPoolExecutor(max_workers=max_workers)
+        return _process_executors[max_workers]
+
+
+def get_thread_executor(max_workers=SCHEDULER_WORKERS):
+    """Return a thread pool shared by every request and nested graph, created on first use."""
+    with _executors_lock:
+        if max_workers not in _thread_executors:
+            _thread_executors[max_workers] = ThreadPoolExecutor(max_workers=max_workers,
+                                                                thread_name_prefix="scheduler")
+        return _thread_executors[max_workers]
+
+
+def topological_order(graph):
+    """Return the node names ordered so that every node comes after its inputs.
+    Args:
+        graph (dict): Maps each node name to a tuple (function, list of input node names).
+    Returns:
+        list: The node names in execution order.
+    """
+    order = []
+    state = {}
+
+    def visit(name, path):
+        if name not in graph:
+            raise ValueError(f"Unknown pipeline stage: {name}")
+        if state.get(name) == "done":
+            return
+        if state.get(name) == "visiting":
+            raise ValueError(f"Cyclic dependency: {' -> '.join(path + [name])}")
+        state[name] = "visiting"
+        for input_name in graph[name][1]:
+            visit(input_name, path + [name])
+        state[name] = "done"
+        order.append(name)
+
+    for name in graph:
+        visit(name, [])
+    return order
+
+
+def critical_path(graph, elapsed):
+    """Return the chain of dependent nodes with the largest total time and that time."""
+    finish = {}
+    previous = {}
+    for name in topological_order(graph):
+        inputs = graph[name][1]
+        slowest_input = max(inputs, key=lambda input_name: finish[input_name], default=None)
+        previous[name] = slowest_input
+        finish[name] = elapsed[name] + (finish[slowest_input] if slowest_input else 0)
+
+    path = []
+    name = max(finish, key=finish.get, default=None)
+    total = finish.get(name, 0)
+    while name is not None:
+        path.append(name)
+        name = previous[name]
+    return path[::-1], round(total, 4)
+
+
+def _timed_call(func, args):
+    """Call the node function and measure its elapsed time inside the worker."""
+    start = time.perf_counter()
+    result = func(*args)
+    return result, time.perf_counter() - start
+
+
+def run_graph(graph, name, metrics=None, max_workers=SCHEDULER_WORKERS, executor_type="thread"):
+    """Run every node of a dependency graph as soon as its inputs are available.
+    Each node function receives the results of its input nodes as positional arguments,
+    in the order in which they are declared. Independent nodes run concurrently.
+    Args:
+        graph (dict): Maps each node name to a tuple (function, list of input node names).
+        name (str): Name of the graph in the scheduler report.
+        metrics (dict): Request metrics; the elapsed time of every node is recorded in its
+                        stages and the critical path under 'scheduler'.
+        max_workers (int): With one worker, a single node, or while a profiling session
+                           tracks the stage memory, the nodes run one after the other in
+                           the calling thread.
+        executor_type (str): 'thread' uses the shared thread pool and 'process' the shared
+                             process pool. Graphs can be nested on the thread pool: while
+                             waiting, the calling thread runs the nodes of its graph that
+                             no worker has started, so a full pool cannot deadlock.
+    Returns:
+        dict: Maps each node name to its result.
+    """
+    order = topological_order(graph)
+    results = {}
+    elapsed = {}
+    start = time.perf_counter()
+
+    if max_workers <= 1 or len(order) <= 1 or (metrics is not None and "memory_peak_kb" in metrics):
+        for node in order:
+            func, inputs = graph[node]
+            node_start = time.perf_counter()
+            if metrics is not None:
+                with stage(metrics, node):
+                    results[node] = func(*[results[input_name] for input_name in inputs])
+            else:
+                results[node] = func(*[results[input_name] for input_name in inputs])
+            elapsed[node] = time.perf_counter() - node_start
+    else:
+        if executor_type == "process":
+            executor = get_process_executor(max_workers)
+        elif executor_type == "thread":
+            executor = get_thread_executor(max_workers)
+        else:
+            raise ValueError(f"Invalid executor type: {executor_type}")
+
+        pending = {node: graph[node] for node in order}
+        running = {}
+        try:
+            while pending or running:
+                for node, (func, inputs) in list(pending.items()):
+                    if all(input_name in results for input_name in inputs):
+                        args = [results[input_name] for input_name in inputs]
+                        running[executor.submit(_timed_call, func, args)] = node
+                        del pending[node]
+
+                if executor_type == "thread":
+                    # Run a node still queued here instead of waiting for a worker
+                    queued = next((future for future in running if future.cancel()), None)
+                    if queued is not None:
+                        node = running.pop(queued)
+                        func, inputs = graph[node]
+                        results[node], elapsed[node] = _timed_call(
+                            func, [results[input_name] for input_name in inputs])
+                        continue
+
+                done, _ = wait(running, return_when=FIRST_COMPLETED)
+                for future in done:
+                    node = running.pop(future)
+                    results[node], elapsed[node] = future.result()
+        finally:
+            for future in running:
+                future.cancel()
+
+        if metrics is not None:
+            for node in order:
+                metrics["stages"][node] = round(elapsed[node], 4)
+
+    if metrics is not None:
+        path, path_time = critical_path(graph, elapsed)
+        metrics.setdefault("scheduler", {})[name] = {
+            "wall_time": round(time.perf_counter() - start, 4),
+            "critical_path": path,
+            "critical_path_time": path_time
+        }
+
+    return results
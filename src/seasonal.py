@@ -0,0 +1,224 @@
+import time
+from functools import partial
+
+import numpy as np
+from scipy.optimize import minimize
+
+from batch import main as batch
+from disaggregation_coef import disaggregation_coef
+from idf_models import IDF_MODELS, log_linear_initial_guess, ven_te_chow_intensity
+from metrics import new_metrics, stage
+from process_data import monthly_series, water_year
+from scheduler import CPU_EXECUTOR, run_graph
+from ventechow import MAX_FUNCTION_EVALUATIONS, BudgetExhausted, condition_mask, handle_dist_name
+
+# Constants
+# Months of each group; the seasons are those of the southern hemisphere, summer first
+GROUPINGS = {
+    "season": {"DJF": (12, 1, 2), "MAM": (3, 4, 5), "JJA": (6, 7, 8), "SON": (9, 10, 11)},
+    "month": {f"{month:02d}": (month,) for month in range(1, 13)}
+}
+# Groups with fewer years with rain are not analysed, as in 'process_data.main'
+MIN_YEARS = 10
+# The intensities of dry months are far below those of the year, so the wider bounds
+# of the same equation in 'idf_models' are used
+PARAMETER_BOUNDS = IDF_MODELS["sherman"]["bounds"]
+INSUFFICIENT_DATA = "Dados não são sufientes para completar a análise"
+
+
+def group_maxima(monthly, groups):
+    """Arrange the monthly maxima as the maximum of each group of months per hydrological year.
+    Args:
+        monthly (DataFrame): The monthly series of 'process_data.monthly_series'.
+        groups (dict): Maps each group name to its months, as in 'GROUPINGS'.
+    Returns:
+        tuple: The hydrological years and the maxima, groups x years; 0 where the group had no rain.
+    """
+    years = water_year(monthly["Data"]).to_numpy()
+    water_years = np.unique(years)
+    table = np.zeros((13, water_years.size))
+    table[monthly["Data"].dt.month.to_numpy(), np.searchsorted(water_years, years)] = monthly["Maxima"].to_numpy()
+    return water_years, np.stack([table[list(months)].max(axis=0) for months in groups.values()])
+
+
+def year_summary(water_years, present):
+    """Return the 'year_range' and 'empty_years' of a group, as 'process_data.main' does for the year."""
+    years = water_years[present]
+    first_year, last_year = years.min(), years.max()
+    empty_years = water_years[(water_years > first_year) & (water_years < last_year) & ~present].tolist()
+    return {"first_year": str(first_year), "last_year": str(last_year)}, empty_years or False
+
+
+def fit_groups(tr, td, i_real, deadline=None, max_evaluations=MAX_FUNCTION_EVALUATIONS):
+    """Fit the Ven Te Chow equation to the intensities of every group at once.
+    The objectives of the groups are independent, so their sum is minimized over the
+    parameters of all groups by a single L-BFGS-B run, each evaluation computing every
+    group in one array expression with the analytic gradient.
+    Args:
+        tr (ndarray): Return period of every point, in years.
+        td (ndarray): Duration of every point, in minutes.
+        i_real (ndarray): Intensities, groups x points, in mm/h.
+        deadline (float): Time ('time.time()') after which the fit is stopped.
+        max_evaluations (int): Evaluations after which the fit is stopped.
+    When stopped, every group keeps the best parameters evaluated so far, as in
+    'ventechow.optimize_parameters'.
+    Returns:
+        tuple: The parameters, groups x (k, m, c, n), and the optimizer report.
+    """
+    low, high = np.array(PARAMETER_BOUNDS, dtype=float).T
+    initial_guess = np.clip(log_linear_initial_guess(tr, td, i_real), low, high)
+    scale = np.where(initial_guess != 0, np.abs(initial_guess), 1)
+
+    best = {"parameters": initial_guess, "objective": np.full(len(i_real), np.inf),
+            "evaluations": 0, "iterations": 0}
+
+    def objective(scaled_parameters):
+        if best["evaluations"] >= max_evaluations:
+            raise BudgetExhausted("evaluations")
+        if deadline is not None and best["evaluations"] > 0 and time.time() >= deadline:
+            raise BudgetExhausted("deadline")
+        parameters = scaled_parameters.reshape(scale.shape) * scale
+        intensity, jacobian = ven_te_chow_intensity(parameters.T[..., None], tr, td)
+        residual = (intensity - i_real) / i_real
+        group_objective = np.abs(residual).sum(axis=1) * 100
+        gradient = (jacobian * (np.sign(residual) / i_real)).sum(axis=2).T * 100
+        best["evaluations"] += 1
+
+        improved = group_objective < best["objective"]
+        best["parameters"] = np.where(improved[:, None], parameters, best["parameters"])
+        best["objective"] = np.where(improved, group_objective, best["objective"])
+        return group_objective.sum(), (gradient * scale).ravel()
+
+    def callback(xk):
+        best["iterations"] += 1
+
+    start = time.perf_counter()
+    try:
+        result = minimize(objective, np.ones(scale.size), jac=True, method="L-BFGS-B", callback=callback,
+                          bounds=list(zip((low / scale).ravel(), (high / scale).ravel())))
+        parameters = result.x.reshape(scale.shape) * scale
+        report = {
+            "converged": bool(result.success),
+            "message": str(result.message),
+            "iterations": int(result.nit),
+            "function_evaluations": int(result.nfev),
+            "objective": float(result.fun),
+            "stopped": None
+        }
+    except BudgetExhausted as exhausted:
+        parameters = best["parameters"]
+        reason = str(exhausted)
+        report = {
+            "converged": False,
+            "message": ("Request deadline reached" if reason == "deadline"
+                        else f"Evaluation budget of {max_evaluations} exhausted")
+                       + "; returning the best parameters found so far.",
+            "iterations": best["iterations"],
+            "function_evaluations": best["evaluations"],
+            "objective": float(best["objective"].sum()),
+            "stopped": reason
+        }
+    report["groups"] = len(i_real)
+    report["elapsed"] = round(time.perf_counter() - start, 4)
+    return parameters, report
+
+
+def goodness_of_fit(parameters, tr, td, i_real):
+    """Return the mean relative error (%) and the NS coefficient of every group."""
+    i_calculated = ven_te_chow_intensity(parameters.T[..., None], tr, td)[0]
+    mean_relative_error = (np.abs((i_calculated - i_real) / i_real) * 100).mean(axis=1)
+    ns = 1 - (((i_real - i_calculated) ** 2).sum(axis=1) /
+              ((i_real - i_real.mean(axis=1, keepdims=True)) ** 2).sum(axis=1))
+    return mean_relative_error, ns
+
+
+def fit_condition(tr, td, intensities, condition, deadline=None):
+    """Fit one condition of the Ven Te Chow equation for every group.
+    Args:
+        intensities (ndarray): Intensities, groups x return periods x durations.
+    Returns:
+        tuple: The parameters, the mean relative errors and NS of every group, and the optimizer report.
+    """
+    mask = condition_mask(td, condition)
+    tr, td = (grid.ravel() for grid in np.meshgrid(tr, td[mask], indexing="ij"))
+    i_real = intensities[:, :, mask].reshape(len(intensities), -1)
+    parameters, report = fit_groups(tr, td, i_real, deadline)
+    return (parameters, *goodness_of_fit(parameters, tr, td, i_real), report)
+
+
+def main(raw_df, grouping="season", metrics=None, deadline=None):
+    """Compute an IDF for every season or calendar month of a station in one pass.
+    The maxima of every group and hydrological year go through the outlier test, the
+    distribution fits and the k coefficients of 'batch' together, and the Ven Te Chow
+    equation of every group is fitted by one optimization per condition ('fit_groups').
+    Args:
+        raw_df (DataFrame): The data returned by 'load_data'.
+        grouping (str): A key of 'GROUPINGS', 'season' or 'month'.
+        metrics (dict): Request metrics; the stages are recorded in it.
+        deadline (float): Time ('time.time()') after which the fits are stopped.
+    Returns:
+        dict: The 'groups' with their IDF, or a message when a group has too few years
+              with rain, and the 'optimization' reports of both conditions.
+    """
+    if metrics is None:
+        metrics = new_metrics()
+    groups = GROUPINGS[grouping]
+
+    with stage(metrics, "process_data"):
+        monthly, empty_consistent_data = monthly_series(raw_df)
+        water_years, values = group_maxima(monthly, groups)
+        present = values > 0
+
+    with stage(metrics, "batch"):
+        result = batch(values, present)
+    analysed = np.flatnonzero((present.sum(axis=1) >= MIN_YEARS) & result["valid"])
+
+    optimization = None
+    fits = {}
+    if analysed.size:
+        _, time_interval = disaggregation_coef()
+        tr = result["return_periods"].astype(float)
+        td = np.array([time_interval[name] * 60 for name in result["durations"]], dtype=float)
+        intensities = result["selected_intensities"][analysed]
+        fits = run_graph({
+            f"{grouping}_condition_{condition}": (partial(fit_condition, tr, td, intensities, condition, deadline), [])
+            for condition in (1, 2)
+        }, "seasonal_ventechow", metrics, executor_type=CPU_EXECUTOR)
+        optimization = {
+            f"condition_{condition}": fits[f"{grouping}_condition_{condition}"][3]
+            for condition in (1, 2)
+        }
+
+    outputs = {name: INSUFFICIENT_DATA for name in groups}
+    names = list(groups)
+    for position, group in enumerate(analysed):
+        year_range, empty_years = year_summary(water_years, present[group])
+        output = {
+            "months": list(groups[names[group]]),
+            "dist": handle_dist_name({"max_dist": result["distributions"][result["max_dist"][group]]}),
+            "r2": {name: float(value) for name, value in zip(result["distributions"], result["r2"][group])},
+            "sample_size": int(result["sample_size"][group]),
+            "outliers": int(result["outliers"][group]),
+            "sample_size_above_30_years": bool(result["sample_size"][group] >= 30),
+            "year_range": year_range,
+            "empty_years": empty_years,
+            "parameters": {},
+            "mean_relative_errors": {},
+            "ns": {}
+        }
+        for condition in (1, 2):
+            parameters, mean_relative_error, ns, _ = fits[f"{grouping}_condition_{condition}"]
+            output["parameters"][f"parameters_{condition}"] = {
+                f"{name}{condition}": round(float(value), 4)
+                for name, value in zip(IDF_MODELS["ven_te_chow"]["parameters"], parameters[position])
+            }
+            output["mean_relative_errors"][f"interval_{condition}"] = float(mean_relative_error[position])
+            output["ns"][f"parameter_{condition}"] = float(ns[position])
+        outputs[names[group]] = output
+
+    return {
+        "grouping": grouping,
+        "groups": outputs,
+        "empty_consistent_data": empty_consistent_data,
+        "optimization": optimization
+    }
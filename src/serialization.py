@@ -0,0 +1,133 @@
+import gzip
+import io
+import json
+
+import numpy as np
+import pandas as pd
+from flask import Response
+
+# Constants
+JSON_MIMETYPE = "application/json"
+NPZ_MIMETYPE = "application/x-npz"
+FORMATS = ("json", "npz")
+LAYOUTS = ("records", "columnar")
+GZIP_LEVEL = 6
+# Responses smaller than this are not worth compressing
+GZIP_MIN_SIZE = 1024
+# Separator of the nested keys in the flat names of the binary format
+KEY_SEPARATOR = "/"
+
+
+def prepare(value, decimals=None):
+    """Convert a pipeline output to JSON types in one pass, writing NumPy arrays with
+    'tolist' and rounding floats to 'decimals' places when given."""
+    if isinstance(value, dict):
+        return {str(key): prepare(item, decimals) for key, item in value.items()}
+    if isinstance(value, (list, tuple)):
+        return [prepare(item, decimals) for item in value]
+    if isinstance(value, np.ndarray):
+        if decimals is not None and value.dtype.kind == "f":
+            value = np.round(value, decimals)
+        return value.tolist()
+    if isinstance(value, (pd.Series, pd.Index)):
+        return prepare(value.to_numpy(), decimals)
+    if isinstance(value, pd.DataFrame):
+        return {str(column): prepare(value[column].to_numpy(), decimals) for column in value.columns}
+    if isinstance(value, np.generic):
+        value = value.item()
+    if isinstance(value, float) and decimals is not None:
+        return round(value, decimals)
+    return value
+
+
+def columnar(records):
+    """Turn a list of dictionaries, such as the outputs of many stations, into nested
+    dictionaries of lists with one entry per record. Missing keys become None."""
+    if not records or not all(isinstance(record, dict) for record in records):
+        return records
+    keys = list(dict.fromkeys(key for record in records for key in record))
+    return {key: columnar([record.get(key) for record in records]) for key in keys}
+
+
+def columnar_layout(value):
+    """Apply 'columnar' to every list of dictionaries in a nested output."""
+    if isinstance(value, dict):
+        return {key: columnar_layout(item) for key, item in value.items()}
+    if isinstance(value, list) and value and all(isinstance(item, dict) for item in value):
+        return columnar(value)
+    return value
+
+
+def to_json(value, decimals=None, layout="records"):
+    """Serialize an output, or a list of outputs, to compact JSON bytes."""
+    value = prepare(value, decimals)
+    if layout == "columnar":
+        value = columnar_layout(value)
+    return json.dumps(value, separators=(",", ":"), ensure_ascii=False).encode("utf-8")
+
+
+def flatten(value, prefix="", decimals=None):
+    """Yield (name, array) pairs for every leaf of a nested output; nested keys are joined
+    with 'KEY_SEPARATOR'. Lists of records are stored column by column."""
+    if isinstance(value, list) and value and all(isinstance(item, dict) for item in value):
+        value = columnar(value)
+    if isinstance(value, dict):
+        for key, item in value.items():
+            yield from flatten(item, f"{prefix}{KEY_SEPARATOR}{key}" if prefix else str(key), decimals)
+    elif isinstance(value, pd.DataFrame):
+        yield from flatten({column: value[column].to_numpy() for column in value.columns}, prefix, decimals)
+    else:
+        array = np.asarray([np.nan if item is None else item for item in value]
+                           if isinstance(value, list) else np.nan if value is None else value)
+        if array.dtype == object:
+            array = array.astype(str)
+        elif decimals is not None and array.dtype.kind == "f":
+            array = np.round(array, decimals)
+        yield prefix, array
+
+
+def to_npz(value, decimals=None):
+    """Serialize an output, or a batch of outputs, to the NumPy '.npz' binary format.
+    Arrays are written as they are, without conversion to Python lists; None is stored as NaN.
+    Returns:
+        bytes: The archive, readable with 'from_npz' or 'numpy.load'.
+    """
+    buffer = io.BytesIO()
+    np.savez(buffer, **dict(flatten(value, decimals=decimals)))
+    return buffer.getvalue()
+
+
+def from_npz(data):
+    """Read a binary response back into a dictionary of arrays keyed by the flat names."""
+    with np.load(io.BytesIO(data)) as arrays:
+        return {name: arrays[name] for name in arrays.files}
+
+
+def accepts_gzip(request):
+    """Return True when the client accepts gzip encoded responses."""
+    return request is not None and "gzip" in request.headers.get("Accept-Encoding", "")
+
+
+def make_response(value, request=None, decimals=None, layout="records", output_format="json", status=200):
+    """Build the HTTP response of an output in the requested format, compressed with gzip
+    when the client accepts it.
+    Args:
+        value: The output, or a list of outputs.
+        request (flask.Request): The request, used for content negotiation.
+        decimals (int): Round floats to this many decimal places.
+        layout (str): 'records' keeps lists of outputs as they are, 'columnar' stores
+                      them as one list per field. The binary format is always columnar.
+        output_format (str): 'json' or the opt-in binary 'npz'.
+    Returns:
+        flask.Response: The response.
+    """
+    if output_format == "npz":
+        body, mimetype = to_npz(value, decimals), NPZ_MIMETYPE
+    else:
+        body, mimetype = to_json(value, decimals, layout), JSON_MIMETYPE
+
+    headers = {"Vary": "Accept-Encoding"}
+    if accepts_gzip(request) and len(body) >= GZIP_MIN_SIZE:
+        body = gzip.compress(body, compresslevel=GZIP_LEVEL)
+        headers["Content-Encoding"] = "gzip"
+    return Response(body, status=status, mimetype=mimetype, headers=headers)
@@ -0,0 +1,246 @@
+import argparse
+import json
+import os
+
+import numpy as np
+from scipy.spatial import cKDTree
+
+from disaggregation_coef import disaggregation_coef
+from k_coefficient import RETURN_PERIODS
+
+# Constants
+EARTH_RADIUS_KM = 6371.0088
+# Durations up to this value (in minutes) use 'parameters_1', longer ones 'parameters_2'
+CONDITION_1_MAX_DURATION = 60
+# Durations of the pipeline, in minutes
+DURATIONS = sorted(round(hours * 60) for hours in disaggregation_coef()[1].values())
+IDW_POWER = 2
+PARAMETER_NAMES = ("k", "m", "c", "n")
+
+_loaded_indexes = {}
+
+
+def unit_vectors(latitude, longitude):
+    """Convert latitudes and longitudes in degrees to points on the unit sphere, so that
+    nearest neighbours in the tree are nearest on the globe."""
+    latitude = np.radians(np.asarray(latitude, dtype=np.float64))
+    longitude = np.radians(np.asarray(longitude, dtype=np.float64))
+    return np.stack([np.cos(latitude) * np.cos(longitude),
+                     np.cos(latitude) * np.sin(longitude),
+                     np.sin(latitude)], axis=-1)
+
+
+def chord_to_km(chord):
+    """Convert the straight-line distance between unit vectors to the great-circle distance."""
+    return 2 * EARTH_RADIUS_KM * np.arcsin(np.clip(np.asarray(chord) / 2, 0, 1))
+
+
+def station_parameters(output, condition):
+    """Return the (k, m, c, n) parameters of a condition from a 'ventechow.main' output."""
+    return [output["parameters"][f"parameters_{condition}"][f"{name}{condition}"] for name in PARAMETER_NAMES]
+
+
+def build_index(results, coordinates=None):
+    """Build the spatial index of the stations fitted by the pipeline.
+    The coordinates of a station come from 'coordinates' or, failing that, from the
+    'Latitude' and 'Longitude' lines of its HidroWeb header ('data_loader.parse_header').
+    The HidroWeb series downloads, like the files in 'csv', only carry the station code,
+    so their coordinates have to be given, e.g. from the HidroWeb station inventory.
+    Args:
+        results (dict or list): Outputs of 'main.main'; outputs that are not dictionaries
+                                (stations without a result) are skipped.
+        coordinates (dict): Maps station codes to (latitude, longitude), for stations whose
+                            header has no coordinates.
+    Returns:
+        dict: The station 'codes', 'latitude', 'longitude', the 'parameters_1' and
+              'parameters_2' arrays (stations x (k, m, c, n)) and the KD-tree.
+    Raises:
+        ValueError: When no station has coordinates, which would give an empty index.
+    """
+    coordinates = coordinates or {}
+    outputs = results.values() if isinstance(results, dict) else results
+
+    stations = {}
+    for output in outputs:
+        if not isinstance(output, dict):
+            continue
+        station = output.get("station") or {}
+        latitude, longitude = coordinates.get(station.get("code"), (station.get("latitude"), station.get("longitude")))
+        if latitude is None or longitude is None:
+            print(f"Station {station.get('code')} has no coordinates and was not indexed")
+            continue
+        # A later result of the same station replaces an earlier one
+        stations[station.get("code")] = (latitude, longitude,
+                                         station_parameters(output, 1), station_parameters(output, 2))
+
+    if not stations:
+        raise ValueError("No station has coordinates; give them with 'coordinates' (--coordinates)")
+
+    codes = list(stations)
+    values = list(stations.values())
+    return make_index(
+        np.array(codes, dtype=str),
+        np.array([value[0] for value in values], dtype=np.float64),
+        np.array([value[1] for value in values], dtype=np.float64),
+        np.array([value[2] for value in values], dtype=np.float64).reshape(-1, 4),
+        np.array([value[3] for value in values], dtype=np.float64).reshape(-1, 4)
+    )
+
+
+def make_index(codes, latitude, longitude, parameters_1, parameters_2):
+    """Assemble the index dictionary and build its KD-tree."""
+    return {
+        "codes": codes,
+        "latitude": latitude,
+        "longitude": longitude,
+        "parameters_1": parameters_1,
+        "parameters_2": parameters_2,
+        "tree": cKDTree(unit_vectors(latitude, longitude).reshape(-1, 3))
+    }
+
+
+def save_index(index, index_path):
+    """Persist the index arrays; the tree is rebuilt on load, which takes milliseconds."""
+    with open(index_path, "wb") as index_file:
+        np.savez(index_file, **{key: value for key, value in index.items() if key != "tree"})
+
+
+def load_index(index_path):
+    """Load a persisted index, keeping it in memory between calls until the file changes."""
+    key = (index_path, os.stat(index_path).st_mtime_ns)
+    if key not in _loaded_indexes:
+        with np.load(index_path) as arrays:
+            _loaded_indexes[key] = make_index(arrays["codes"], arrays["latitude"], arrays["longitude"],
+                                              arrays["parameters_1"], arrays["parameters_2"])
+    return _loaded_indexes[key]
+
+
+def idf_intensity(parameters_1, parameters_2, return_periods=RETURN_PERIODS, durations=DURATIONS):
+    """Evaluate the Ven Te Chow equation i = k * T^m / (c + t)^n for many stations at once.
+    Args:
+        parameters_1 (ndarray): (k, m, c, n) of the durations up to 60 minutes, ... x 4.
+        parameters_2 (ndarray): (k, m, c, n) of the longer durations, ... x 4.
+        return_periods (list): Return periods, in years.
+        durations (list): Durations, in minutes.
+    Returns:
+        ndarray: Intensities in mm/h shaped ... x return periods x durations.
+    """
+    return_periods = np.asarray(return_periods, dtype=np.float64)[:, None]
+    durations = np.asarray(durations, dtype=np.float64)[None, :]
+    parameters = np.where(durations <= CONDITION_1_MAX_DURATION,
+                          np.asarray(parameters_1)[..., None, None],
+                          np.asarray(parameters_2)[..., None, None])
+    k, m, c, n = (parameters[..., index, :, :] for index in range(4))
+    with np.errstate(divide="ignore", invalid="ignore", over="ignore"):
+        intensity = k * return_periods ** m / (c + durations) ** n
+    return np.where(np.isfinite(intensity), intensity, 0)
+
+
+def nearest(index, latitude, longitude, k=1):
+    """Find the k stations nearest to each query point.
+    Args:
+        index (dict): Index from 'build_index' or 'load_index'.
+        latitude (float or array): Latitudes of the points, in degrees.
+        longitude (float or array): Longitudes of the points, in degrees.
+        k (int): Number of stations per point; limited to the number of stations.
+    Returns:
+        dict: 'codes', 'distance_km' and 'position' (row in the index) shaped points x k.
+    Raises:
+        ValueError: When the index has no stations.
+    """
+    if len(index["codes"]) == 0:
+        raise ValueError("The spatial index has no stations")
+    k = min(k, len(index["codes"]))
+    points = unit_vectors(np.atleast_1d(latitude), np.atleast_1d(longitude))
+    chord, position = index["tree"].query(points, k=k)
+    chord, position = chord.reshape(len(points), k), position.reshape(len(points), k)
+    return {
+        "codes": index["codes"][position],
+        "distance_km": chord_to_km(chord),
+        "position": position
+    }
+
+
+def interpolate_intensity(index, latitude, longitude, k=4, power=IDW_POWER,
+                          return_periods=RETURN_PERIODS, durations=DURATIONS):
+    """Interpolate the IDF intensities at each query point by inverse distance weighting of
+    the k nearest stations. A point on top of a station takes the intensities of that station.
+    Returns:
+        dict: The neighbours of 'nearest' and the 'intensities', points x return periods x durations.
+    """
+    neighbours = nearest(index, latitude, longitude, k)
+    position = neighbours["position"]
+    intensities = idf_intensity(index["parameters_1"][position], index["parameters_2"][position],
+                                return_periods, durations)
+
+    distance = neighbours["distance_km"]
+    exact = distance <= 1e-9
+    with np.errstate(divide="ignore"):
+        weights = np.where(exact.any(axis=1, keepdims=True), exact.astype(np.float64), 1 / distance ** power)
+    weights /= weights.sum(axis=1, keepdims=True)
+
+    return {
+        **neighbours,
+        "weights": weights,
+        "return_periods": list(return_periods),
+        "durations": list(durations),
+        "intensities": np.einsum("pk,pktd->ptd", weights, intensities)
+    }
+
+
+def lookup(index_path, latitude, longitude, k=4, power=IDW_POWER,
+           return_periods=RETURN_PERIODS, durations=DURATIONS):
+    """Answer an IDF query for one or many points from a persisted index.
+    Returns:
+        dict: The interpolated intensities and the nearest stations of every point, as lists.
+    """
+    result = interpolate_intensity(load_index(index_path), latitude, longitude, k, power,
+                                   return_periods, durations)
+    return {
+        "return_periods": result["return_periods"],
+        "durations": result["durations"],
+        "points": [
+            {
+                "latitude": float(point_latitude),
+                "longitude": float(point_longitude),
+                "stations": result["codes"][point].tolist(),
+                "distance_km": result["distance_km"][point].round(3).tolist(),
+                "weights": result["weights"][point].round(4).tolist(),
+                "intensities": result["intensities"][point].round(4).tolist()
+            }
+            for point, (point_latitude, point_longitude)
+            in enumerate(zip(np.atleast_1d(latitude), np.atleast_1d(longitude)))
+        ]
+    }
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Build or query the nearest-station IDF index.")
+    subparsers = parser.add_subparsers(dest="command", required=True)
+    build_parser = subparsers.add_parser("build", help="Build the index from pipeline outputs")
+    build_parser.add_argument("index", help="Path of the index file (.npz)")
+    build_parser.add_argument("results", help="JSON file with the outputs of 'main.main'")
+    build_parser.add_argument("--coordinates", help="JSON file mapping station codes to [latitude, longitude]; "
+                                                    "required for stations whose header has no coordinates")
+    query_parser = subparsers.add_parser("query", help="Interpolate the IDF at a point")
+    query_parser.add_argument("index", help="Path of the index file (.npz)")
+    query_parser.add_argument("latitude", type=float)
+    query_parser.add_argument("longitude", type=float)
+    query_parser.add_argument("-k", type=int, default=4)
+    args = parser.parse_args()
+
+    if args.command == "build":
+        with open(args.results) as results_file:
+            results = json.load(results_file)
+        coordinates = None
+        if args.coordinates:
+            with open(args.coordinates) as coordinates_file:
+                coordinates = json.load(coordinates_file)
+        try:
+            index = build_index(results, coordinates)
+        except ValueError as e:
+            parser.error(str(e))
+        save_index(index, args.index)
+        print(f"{len(index['codes'])} stations written to {args.index}")
+    else:
+        print(json.dumps(lookup(args.index, args.latitude, args.longitude, args.k), indent=2))
@@ -0,0 +1,256 @@
+import argparse
+import glob
+import os
+import threading
+import time
+from collections import OrderedDict
+
+import numpy as np
+import pandas as pd
+
+from data_loader import load_data
+
+# Constants
+ARCHIVE_MAGIC = b"IDFARCH1"
+ARCHIVE_VERSION = 2
+ALIGNMENT = 8
+
+HEADER_DTYPE = np.dtype([("magic", "S8"), ("version", "<u4"), ("stations", "<u4"), ("records", "<u8")])
+INDEX_DTYPE = np.dtype([("code", "S32"), ("offset", "<u8"), ("count", "<u8"), ("name", "S64"),
+                        ("latitude", "<f8"), ("longitude", "<f8"), ("altitude", "<f8")])
+COLUMNS = (("month", "<i4"), ("maxima", "<f8"), ("level", "i1"))
+# Archives kept mapped by 'load_station'
+OPEN_ARCHIVES_SIZE = int(os.environ.get("IDF_OPEN_ARCHIVES_SIZE", 8))
+
+# Archive path -> (modification time, open archive), least recently used first
+_open_archives = OrderedDict()
+_open_archives_lock = threading.Lock()
+
+
+def month_ordinal(dates):
+    """Convert dates to the number of months since January of year 0."""
+    dates = pd.DatetimeIndex(dates)
+    return (dates.year * 12 + dates.month - 1).to_numpy(dtype=np.int32)
+
+
+def month_dates(ordinals):
+    """Convert month ordinals back to the first day of each month."""
+    months_since_epoch = np.asarray(ordinals, dtype=np.int64) - 1970 * 12
+    return months_since_epoch.astype("datetime64[M]").astype("datetime64[ns]")
+
+
+def aligned(offset):
+    """Round an offset up to the archive alignment."""
+    return -(-offset // ALIGNMENT) * ALIGNMENT
+
+
+def section_offsets(stations, records):
+    """Return the byte offsets of the index and of each column for the given sizes."""
+    offsets = {"index": aligned(HEADER_DTYPE.itemsize)}
+    position = offsets["index"] + stations * INDEX_DTYPE.itemsize
+    for name, dtype in COLUMNS:
+        offsets[name] = aligned(position)
+        position = offsets[name] + records * np.dtype(dtype).itemsize
+    offsets["end"] = position
+    return offsets
+
+
+def write_archive(archive_path, stations, metadata=None):
+    """Write the monthly series of many stations to one archive file.
+    Args:
+        archive_path (str): Path of the archive to create.
+        stations (dict): Maps each station code to a DataFrame with the 'NivelConsistencia',
+                         'Data' and 'Maxima' columns returned by 'load_data'.
+        metadata (dict): Maps station codes to the metadata returned by 'load_data'; the
+                         name and coordinates are stored in the index.
+    """
+    metadata = metadata or {}
+    codes = list(stations)
+    counts = [len(stations[code]) for code in codes]
+    records = int(sum(counts))
+    offsets = section_offsets(len(codes), records)
+
+    archive = np.memmap(archive_path, dtype=np.uint8, mode="w+", shape=(offsets["end"],))
+
+    header = np.zeros(1, dtype=HEADER_DTYPE)
+    header[0] = (ARCHIVE_MAGIC, ARCHIVE_VERSION, len(codes), records)
+    archive[:HEADER_DTYPE.itemsize] = header.view(np.uint8)
+
+    index = np.zeros(len(codes), dtype=INDEX_DTYPE)
+    index["code"] = [str(code).encode() for code in codes]
+    index["count"] = counts
+    index["offset"] = np.concatenate([[0], np.cumsum(counts)[:-1]]) if codes else []
+    index["name"] = [(metadata.get(code, {}).get("name") or "").encode("utf-8")[:64] for code in codes]
+    for field in ("latitude", "longitude", "altitude"):
+        index[field] = [np.nan if metadata.get(code, {}).get(field) is None else metadata[code][field]
+                        for code in codes]
+    archive[offsets["index"]:offsets["index"] + index.nbytes] = index.view(np.uint8)
+
+    columns = {name: np.ndarray((records,), dtype=dtype, buffer=archive, offset=offsets[name])
+               for name, dtype in COLUMNS}
+    for code, offset, count in zip(codes, index["offset"], counts):
+        data = stations[code]
+        rows = slice(int(offset), int(offset) + count)
+        columns["month"][rows] = month_ordinal(pd.to_datetime(data["Data"], format="%d/%m/%Y"))
+        columns["maxima"][rows] = data["Maxima"].to_numpy(dtype=np.float64)
+        columns["level"][rows] = data["NivelConsistencia"].fillna(0).to_numpy(dtype=np.int8)
+
+    archive.flush()
+    del archive
+
+
+def open_archive(archive_path):
+    """Memory-map an archive.
+    Returns:
+        dict: The station index ('stations', code -> (offset, count)), the station
+              'metadata' and one read-only memory-mapped array per column.
+    """
+    archive = np.memmap(archive_path, dtype=np.uint8, mode="r")
+    header = archive[:HEADER_DTYPE.itemsize].view(HEADER_DTYPE)[0]
+    if header["magic"] != ARCHIVE_MAGIC or header["version"] != ARCHIVE_VERSION:
+        raise ValueError(f"{archive_path} is not a station archive")
+
+    stations, records = int(header["stations"]), int(header["records"])
+    offsets = section_offsets(stations, records)
+    index = np.ndarray((stations,), dtype=INDEX_DTYPE, buffer=archive, offset=offsets["index"])
+
+    return {
+        "path": archive_path,
+        "stations": {code.decode(): (int(offset), int(count))
+                     for code, offset, count in zip(index["code"], index["offset"], index["count"])},
+        "metadata": {
+            entry["code"].decode(): {
+                "code": entry["code"].decode(),
+                "name": entry["name"].decode("utf-8", errors="ignore") or None,
+                **{field: None if np.isnan(entry[field]) else float(entry[field])
+                   for field in ("latitude", "longitude", "altitude")}
+            }
+            for entry in index
+        },
+        **{name: np.ndarray((records,), dtype=dtype, buffer=archive, offset=offsets[name])
+           for name, dtype in COLUMNS}
+    }
+
+
+def read_station(archive, station_code):
+    """Return zero-copy views of the month ordinals, maxima and consistency levels of a station."""
+    if station_code not in archive["stations"]:
+        raise KeyError(f"Station {station_code} is not in {archive['path']}")
+    offset, count = archive["stations"][station_code]
+    return {name: archive[name][offset:offset + count] for name, _ in COLUMNS}
+
+
+def station_dataframe(archive, station_code):
+    """Return the station in the format of 'load_data', ready for 'process_data.main'."""
+    series = read_station(archive, station_code)
+    return pd.DataFrame({
+        "NivelConsistencia": series["level"],
+        "Data": month_dates(series["month"]),
+        "Maxima": series["maxima"]
+    })
+
+
+def cached_archive(archive_path):
+    """Return the mapped archive, opening it when it is not mapped or the file changed.
+    At most OPEN_ARCHIVES_SIZE archives are kept; the least recently used are dropped and
+    unmapped once the data still read from them is released. Closing the map right away
+    would leave those views pointing at unmapped memory."""
+    mtime = os.stat(archive_path).st_mtime_ns
+    with _open_archives_lock:
+        entry = _open_archives.get(archive_path)
+        if entry is not None and entry[0] == mtime:
+            _open_archives.move_to_end(archive_path)
+            return entry[1]
+        archive = open_archive(archive_path)
+        _open_archives[archive_path] = (mtime, archive)
+        while len(_open_archives) > max(OPEN_ARCHIVES_SIZE, 1):
+            _open_archives.popitem(last=False)
+        return archive
+
+
+def load_station(archive_path, station_code):
+    """Load a station from an archive for the pipeline, keeping the archive mapped between
+    calls until the file changes.
+    Returns:
+        tuple: The data and the station metadata, like 'load_data', or None when the
+               station cannot be read.
+    """
+    try:
+        archive = cached_archive(archive_path)
+        return station_dataframe(archive, station_code), archive["metadata"][station_code]
+    except FileNotFoundError:
+        print(f"File {archive_path} not found")
+        return None
+    except (KeyError, ValueError) as e:
+        print(f"Error reading station archive {archive_path}: {e}")
+        return None
+
+
+def convert_csv_files(csv_paths, archive_path):
+    """Convert HidroWeb CSV files to an archive. Each station is stored under the code in its
+    header, or the file name without extension when the header has none; a later file of
+    the same station replaces an earlier one. Files that cannot be loaded are skipped.
+    Returns:
+        list: The station codes written.
+    """
+    stations = {}
+    metadata = {}
+    for csv_path in csv_paths:
+        loaded = load_data(csv_path)
+        if loaded is None:
+            continue
+        data, station = loaded
+        code = station["code"] or os.path.splitext(os.path.basename(csv_path))[0]
+        if code in stations:
+            print(f"Station {code} in {csv_path} replaces a previous file")
+        stations[code] = data
+        metadata[code] = {**station, "code": code}
+    write_archive(archive_path, stations, metadata)
+    return list(stations)
+
+
+def benchmark(csv_paths, archive_path, repeat=5):
+    """Compare the time to load every station from the CSV files and from the archive.
+    Returns:
+        dict: Best total time of each method, in seconds, and the speedup.
+    """
+    archive = open_archive(archive_path)
+    codes = list(archive["stations"])
+
+    def best_time(load):
+        times = []
+        for _ in range(repeat):
+            start = time.perf_counter()
+            load()
+            times.append(time.perf_counter() - start)
+        return min(times)
+
+    csv_time = best_time(lambda: [load_data(csv_path) for csv_path in csv_paths])
+    archive_time = best_time(lambda: [station_dataframe(archive, code) for code in codes])
+    zero_copy_time = best_time(lambda: [read_station(archive, code) for code in codes])
+
+    return {
+        "stations": len(codes),
+        "csv": round(csv_time, 6),
+        "archive_dataframe": round(archive_time, 6),
+        "archive_zero_copy": round(zero_copy_time, 6),
+        "speedup_dataframe": round(csv_time / archive_time, 1),
+        "speedup_zero_copy": round(csv_time / zero_copy_time, 1)
+    }
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Pack HidroWeb CSV files into a memory-mapped station archive.")
+    parser.add_argument("archive", help="Path of the archive file")
+    parser.add_argument("csv", nargs="+", help="CSV files or directories containing them")
+    parser.add_argument("--benchmark", action="store_true", help="Compare loading from CSV and from the archive")
+    args = parser.parse_args()
+
+    csv_paths = []
+    for path in args.csv:
+        csv_paths.extend(sorted(glob.glob(os.path.join(path, "*.csv"))) if os.path.isdir(path) else [path])
+
+    codes = convert_csv_files(csv_paths, args.archive)
+    print(f"{len(codes)} stations written to {args.archive}")
+    if args.benchmark:
+        print(benchmark(csv_paths, args.archive))
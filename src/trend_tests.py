@@ -0,0 +1,238 @@
+import argparse
+import json
+import os
+import warnings
+from concurrent.futures import ProcessPoolExecutor
+
+import numpy as np
+from scipy.stats import norm
+
+from process_data import main as process_data
+from station_archive import load_station, open_archive
+
+# Constants
+SIGNIFICANCE_LEVEL = 0.05
+# Stations per task; the pairwise arrays take stations x years x years values
+CHUNK_SIZE = 256
+MIN_SAMPLE_SIZE = 3
+
+
+def compact(values, mask, years):
+    """Move the entries of every row that are inside the mask to the start of the row,
+    keeping them in chronological order."""
+    order = np.argsort(~mask, axis=1, kind="stable")
+    return (np.take_along_axis(values, order, axis=1), np.take_along_axis(mask, order, axis=1),
+            np.take_along_axis(years, order, axis=1))
+
+
+def pairwise_signs(values, mask):
+    """Return the signs of x_j - x_i for every pair of years of every row, 0 for pairs
+    outside the mask, and the differences. Both are shaped stations x i x j."""
+    difference = values[:, None, :] - values[:, :, None]
+    valid = mask[:, :, None] & mask[:, None, :]
+    return np.where(valid, np.sign(difference), 0), difference
+
+
+def mann_kendall(signs, values, mask):
+    """Mann-Kendall test of every row, with the variance corrected for ties.
+    Returns:
+        dict: 'S', its 'variance', the normal score 'z', the two-sided 'p_value' and Kendall's 'tau'.
+    """
+    sample_size = mask.sum(axis=1)
+    later = np.triu(np.ones(signs.shape[1:], dtype=bool), k=1)
+    s = (signs * later).sum(axis=(1, 2))
+
+    # Each value of a group of t ties adds (t - 1)(2t + 5), so the group adds t(t - 1)(2t + 5)
+    ties = ((values[:, None, :] == values[:, :, None]) & mask[:, :, None] & mask[:, None, :]).sum(axis=2)
+    tie_correction = np.where(mask, (ties - 1) * (2 * ties + 5), 0).sum(axis=1)
+    variance = (sample_size * (sample_size - 1) * (2 * sample_size + 5) - tie_correction) / 18
+
+    z = np.where(s > 0, (s - 1) / np.sqrt(variance), np.where(s < 0, (s + 1) / np.sqrt(variance), 0.0))
+    return {
+        "S": s,
+        "variance": variance,
+        "z": z,
+        "p_value": 2 * norm.sf(np.abs(z)),
+        "tau": s / (sample_size * (sample_size - 1) / 2)
+    }
+
+
+def sen_slope(difference, mask, years):
+    """Sen's slope of every row: the median of the slopes between every pair of years,
+    in units of the values per year."""
+    later = np.triu(np.ones(difference.shape[1:], dtype=bool), k=1)
+    valid = later & mask[:, :, None] & mask[:, None, :]
+    slopes = np.where(valid, difference / (years[:, None, :] - years[:, :, None]), np.nan)
+    # Rows with fewer than two values have no slope; their result is NaN
+    with warnings.catch_warnings():
+        warnings.simplefilter("ignore", RuntimeWarning)
+        return np.nanmedian(slopes.reshape(len(slopes), -1), axis=1)
+
+
+def pettitt(signs, mask, years):
+    """Pettitt change-point test of every row, on rows compacted by 'compact'.
+    U_t adds up sgn(x_i - x_j) for i up to t and j after it, which is the running sum of
+    the row sums of the sign matrix.
+    Returns:
+        dict: The statistic 'K', its approximate 'p_value' and the 'change_year', the last
+              year before the change.
+    """
+    sample_size = mask.sum(axis=1)
+    u = np.cumsum(-signs.sum(axis=2), axis=1)
+    # U_t is defined up to the year before the last one
+    position = np.arange(u.shape[1])
+    u = np.where(position < (sample_size - 1)[:, None], np.abs(u), -1)
+    change = np.argmax(u, axis=1)
+    k = u[np.arange(len(u)), change]
+    p_value = np.minimum(2 * np.exp(-6.0 * k ** 2 / (sample_size ** 3 + sample_size ** 2)), 1)
+    return {"K": k, "p_value": p_value, "change_year": years[np.arange(len(u)), change]}
+
+
+def main(values, mask=None, years=None):
+    """Run the Mann-Kendall, Sen's slope and Pettitt tests on many series at once.
+    Args:
+        values (ndarray): Annual maxima padded to a stations x years matrix.
+        mask (ndarray): True where 'values' holds an annual maximum. Defaults to the
+                        finite, positive entries.
+        years (ndarray): Year of every column, or of every entry (stations x years).
+                         Defaults to the column index.
+    Returns:
+        dict: Per-station arrays. 'valid' marks the stations with at least three values;
+              the results of the other stations are meaningless.
+    """
+    values = np.atleast_2d(np.asarray(values, dtype=float))
+    if mask is None:
+        mask = np.isfinite(values) & (values > 0)
+    mask = np.atleast_2d(np.asarray(mask, dtype=bool)) & np.isfinite(values)
+    years = np.arange(values.shape[1]) if years is None else np.asarray(years)
+    years = np.broadcast_to(years, values.shape).astype(float)
+    if values.shape[1] == 0:
+        # A single empty column gives every row the invalid result of a row without values
+        values, mask, years = np.zeros((len(values), 1)), np.zeros((len(values), 1), dtype=bool), np.zeros((len(values), 1))
+
+    values, mask, years = compact(np.where(mask, values, 0.0), mask, years)
+    with np.errstate(divide="ignore", invalid="ignore"):
+        signs, difference = pairwise_signs(values, mask)
+        result = {
+            "sample_size": mask.sum(axis=1),
+            "mann_kendall": mann_kendall(signs, values, mask),
+            "sen_slope": sen_slope(difference, mask, years),
+            "pettitt": pettitt(signs, mask, years)
+        }
+    result["valid"] = result["sample_size"] >= MIN_SAMPLE_SIZE
+    return result
+
+
+def station_result(result, station=0, significance_level=SIGNIFICANCE_LEVEL):
+    """Return the tests of one row of 'main' as JSON types, with their conclusions at the
+    significance level. Returns None for stations with too few values."""
+    if not result["valid"][station]:
+        return None
+    mann_kendall_test = {key: float(value[station]) for key, value in result["mann_kendall"].items()}
+    pettitt_test = {key: float(value[station]) for key, value in result["pettitt"].items()}
+
+    trend = "no trend"
+    if mann_kendall_test["p_value"] < significance_level:
+        trend = "increasing" if mann_kendall_test["S"] > 0 else "decreasing"
+    return {
+        "sample_size": int(result["sample_size"][station]),
+        "significance_level": significance_level,
+        "mann_kendall": {**mann_kendall_test, "trend": trend},
+        "sen_slope": float(result["sen_slope"][station]),
+        "pettitt": {
+            **pettitt_test,
+            "change_year": int(pettitt_test["change_year"]),
+            "significant": pettitt_test["p_value"] < significance_level
+        },
+        "stationary": trend == "no trend" and pettitt_test["p_value"] >= significance_level
+    }
+
+
+def annual_maxima_matrix(series):
+    """Pad the annual maxima of many stations to a stations x years matrix.
+    Args:
+        series (list): DataFrames with 'AnoHidrologico' and 'Pmax_anual', as returned by
+                       'process_data.main'; empty ones give rows without values.
+    Returns:
+        tuple: The maxima, the mask of the entries with a value and the years of the columns.
+    """
+    known_years = [frame["AnoHidrologico"].to_numpy() for frame in series if not frame.empty]
+    if not known_years:
+        return np.zeros((len(series), 0)), np.zeros((len(series), 0), dtype=bool), np.zeros(0, dtype=int)
+    all_years = np.concatenate(known_years)
+    years = np.arange(all_years.min(), all_years.max() + 1)
+
+    values = np.zeros((len(series), years.size))
+    mask = np.zeros(values.shape, dtype=bool)
+    for row, frame in enumerate(series):
+        if frame.empty:
+            continue
+        columns = np.searchsorted(years, frame["AnoHidrologico"].to_numpy())
+        values[row, columns] = frame["Pmax_anual"].to_numpy()
+        mask[row, columns] = True
+    return values, mask, years
+
+
+def annual_maxima_tests(annual_maxima, significance_level=SIGNIFICANCE_LEVEL):
+    """Run the tests on the annual maxima of one station, as returned by 'process_data.main'."""
+    values, mask, years = annual_maxima_matrix([annual_maxima])
+    return station_result(main(values, mask, years), 0, significance_level)
+
+
+def screen_chunk(archive_path, codes, significance_level=SIGNIFICANCE_LEVEL):
+    """Test the annual maxima of some stations of an archive; run by each worker."""
+    series = []
+    for code in codes:
+        loaded = load_station(archive_path, code)
+        try:
+            series.append(process_data(loaded[0])[0] if loaded is not None else None)
+        except Exception as e:
+            print(f"Error processing station {code}: {e}")
+            series.append(None)
+    known = [row for row, frame in enumerate(series) if frame is not None and not frame.empty]
+
+    results = dict.fromkeys(codes)
+    if known:
+        values, mask, years = annual_maxima_matrix([series[row] for row in known])
+        tested = main(values, mask, years)
+        for position, row in enumerate(known):
+            results[codes[row]] = station_result(tested, position, significance_level)
+    return results
+
+
+def screen_archive(archive_path, codes=None, workers=None, chunk_size=CHUNK_SIZE,
+                   significance_level=SIGNIFICANCE_LEVEL):
+    """Screen the stations of an archive for trends and change points.
+    The stations are split in chunks of 'chunk_size' that are processed, from the raw
+    data to the tests, in parallel.
+    Args:
+        archive_path (str): Station archive of 'station_archive'.
+        codes (list): Stations to test; all of them by default.
+        workers (int): Number of processes; one runs everything in this process.
+    Returns:
+        dict: The tests of every station, None for stations with too few years.
+    """
+    codes = list(codes or open_archive(archive_path)["stations"])
+    workers = workers or os.cpu_count() or 1
+    chunks = [codes[start:start + chunk_size] for start in range(0, len(codes), chunk_size)]
+
+    if workers <= 1:
+        results = [screen_chunk(archive_path, chunk, significance_level) for chunk in chunks]
+    else:
+        with ProcessPoolExecutor(max_workers=workers) as executor:
+            results = list(executor.map(screen_chunk, [archive_path] * len(chunks), chunks,
+                                        [significance_level] * len(chunks)))
+    return {code: result for chunk in results for code, result in chunk.items()}
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(
+        description="Screen the stations of an archive with the Mann-Kendall, Sen's slope and Pettitt tests.")
+    parser.add_argument("archive", help="Path of the station archive")
+    parser.add_argument("--codes", nargs="+", help="Stations to test; all of them by default")
+    parser.add_argument("--workers", type=int, default=None)
+    parser.add_argument("--significance", type=float, default=SIGNIFICANCE_LEVEL)
+    args = parser.parse_args()
+
+    print(json.dumps(screen_archive(args.archive, args.codes, args.workers,
+                                    significance_level=args.significance), indent=2))
@@ -1,12 +1,30 @@
+import logging
+import os
+import pprint
+import time
+from functools import partial
 import pandas as pd
 import numpy as np
 from scipy.optimize import minimize
-from sklearn.linear_model import LinearRegression
-import pprint
+
+from idf_models import compare_models, log_linear_initial_guess
+from scheduler import CPU_EXECUTOR, run_graph
 
 # Constants
 INITIAL_GUESS = [500, 0.1, 10, 0.7]
-OPTIMIZATION_BOUNDS = [(100, 2000), (0, 3), (0, 100), (0, 10)]
+OPTIMIZER_TRACE_ENV = "IDF_OPTIMIZER_TRACE"
+# Budget of each fit; the finite difference gradient of BFGS costs 5 evaluations per iteration
+MAX_FUNCTION_EVALUATIONS = int(os.environ.get("IDF_MAX_EVALUATIONS", 3000))
+MAX_ITERATIONS = 400
+
+logger = logging.getLogger(__name__)
+
+
+def optimizer_trace_requested(flag=False):
+    """Return True when the objective trajectory was asked for by the request flag or the environment."""
+    if isinstance(flag, str):
+        flag = flag.lower() in ("1", "true", "yes")
+    return bool(flag) or os.environ.get(OPTIMIZER_TRACE_ENV, "").lower() in ("1", "true", "yes")
 
 
 def rain_intensity_calculations(k_coefficient_data, coefficients, params, time_interval, dist_r2):
@@ -34,140 +52,200 @@ def rain_intensity_calculations(k_coefficient_data, coefficients, params, time_i
     return idf_data
 
 
-def transform_dataframe(idf_data, time_interval):
-    """Transforms the original DataFrame to facilitate the calculation of the relative error."""
-    rows = [
-        {"Tr (years)": tr, "td (min)": interval_value * 60,
-         "i_real": idf_data.loc[idf_data["Tr_years"] == tr, td].values[0]}
-        for tr in idf_data["Tr_years"]
-        for td, interval_value in time_interval.items()
-    ]
-
-    return pd.DataFrame(rows)
-
-
-def add_condition(df):
-    """Adds a column to the DataFrame with the condition based on the time duration."""
-    rows = []
-    for index, row in df.iterrows():
-        td_min = row["td (min)"]
-        if td_min == 60:
-            new_row = row.copy()
-            new_row["condition"] = 1
-            rows.append(new_row.to_dict())
-            new_row["condition"] = 2
-            rows.append(new_row.to_dict())
-        elif 5 <= td_min < 60:
-            row["condition"] = 1
-            rows.append(row.to_dict())
-        elif 60 < td_min <= 1440:
-            row["condition"] = 2
-            rows.append(row.to_dict())
-        else:
-            row["condition"] = 3
-            rows.append(row.to_dict())
-
-    return pd.DataFrame(rows)
-
-
-def apply_i_calculated(df, parameters_1, parameters_2):
-    """Applies the Ven Te Chow equation to calculate the
-    estimated rainfall intensity (i_calculated) for each row."""
-    df["i_calculated"] = df.apply(
-        lambda row: calculate_i(
-            row, parameters_1) if row["condition"] == 1 else calculate_i(row, parameters_2),
-        axis=1
-    )
-    return df
-
-
-def calculate_i(row, parameters):
+def intensity_matrix(idf_data, time_interval):
+    """Arrange the intensities as a return period x duration matrix.
+    Returns:
+        dict: 'tr' (years), 'td' (minutes) and 'i_real', the intensities shaped
+              return periods x durations, with the durations in the order of 'time_interval'.
+    """
+    return {
+        "tr": idf_data["Tr_years"].to_numpy(dtype=float),
+        "td": np.array([interval_value * 60 for interval_value in time_interval.values()], dtype=float),
+        "i_real": idf_data[list(time_interval)].to_numpy(dtype=float)
+    }
+
+
+def condition_mask(td, condition):
+    """Durations fitted by each condition: 1 from 5 to 60 minutes and 2 from 60 minutes to
+    one day. The 60-minute duration belongs to both."""
+    if condition == 1:
+        return (td >= 5) & (td <= 60)
+    return (td >= 60) & (td <= 1440)
+
+
+def condition_points(matrix, condition):
+    """Return the return periods, durations and intensities of a condition as flat arrays,
+    ordered by return period and then by duration."""
+    mask = condition_mask(matrix["td"], condition)
+    tr, td = np.meshgrid(matrix["tr"], matrix["td"][mask], indexing="ij")
+    return tr.ravel(), td.ravel(), matrix["i_real"][:, mask].ravel()
+
+
+def calculate_i(tr, td, parameters):
     """Calculates the estimated rainfall intensity."""
     k, m, c, n = parameters
-    result = (k * row["Tr (years)"] ** m) / ((c + row["td (min)"]) ** n)
+    result = (k * tr ** m) / ((c + td) ** n)
     result = np.where(np.isfinite(result), result, 0)
     return result
 
 
-def optimize_parameters(df, condition):
+def relative_error(i_calculated, i_real):
+    """Relative error of the estimated intensities, in percent."""
+    return np.abs((i_calculated - i_real) / i_real) * 100
+
+
+class BudgetExhausted(Exception):
+    """Raised inside the optimizer when a fit runs out of evaluations or time."""
+
+
+def fit_from_start(points, start, scale, trace=False, deadline=None, max_evaluations=MAX_FUNCTION_EVALUATIONS):
+    """Run BFGS on the parameters divided by 'scale', starting from 'start'.
+    When stopped, the best parameters evaluated so far are returned, with 'converged'
+    false and 'stopped' set to 'deadline' or 'evaluations' in the report.
+    Returns: The unrounded parameters and the optimizer report."""
+    best = {"parameters": start, "objective": np.inf,
+            "evaluations": 0, "iterations": 0}
+
+    def objective(scaled_parameters):
+        parameters = scaled_parameters * scale
+        # The first evaluation always runs, so there is a best point to return
+        if best["evaluations"] >= max_evaluations:
+            raise BudgetExhausted("evaluations")
+        if deadline is not None and best["evaluations"] > 0 and time.time() >= deadline:
+            raise BudgetExhausted("deadline")
+        value = objective_function(parameters, *points)
+        best["evaluations"] += 1
+        if value < best["objective"]:
+            best["parameters"], best["objective"] = np.array(parameters, dtype=float), value
+        return value
+
+    trajectory = []
+
+    def callback(xk):
+        best["iterations"] += 1
+        if trace:
+            trajectory.append({
+                "parameters": [float(value) for value in xk * scale],
+                "objective": float(objective_function(xk * scale, *points))
+            })
+
+    start_time = time.perf_counter()
+    try:
+        result = minimize(
+            objective,
+            start / scale,
+            method="BFGS",
+            callback=callback,
+            options={"maxiter": MAX_ITERATIONS}
+        )
+        parameters = result.x * scale
+        report = {
+            "converged": bool(result.success),
+            "status": int(result.status),
+            "message": str(result.message),
+            "iterations": int(result.nit),
+            "function_evaluations": int(result.nfev),
+            "gradient_evaluations": int(result.njev),
+            "objective": float(result.fun),
+            "stopped": None
+        }
+    except BudgetExhausted as exhausted:
+        parameters = best["parameters"]
+        reason = str(exhausted)
+        report = {
+            "converged": False,
+            "status": -1,
+            "message": ("Request deadline reached" if reason == "deadline"
+                        else f"Evaluation budget of {max_evaluations} exhausted")
+                       + "; returning the best parameters found so far.",
+            "iterations": best["iterations"],
+            "function_evaluations": best["evaluations"],
+            "gradient_evaluations": None,
+            "objective": float(best["objective"]),
+            "stopped": reason
+        }
+    report["initial_guess"] = [round(float(value), 4) for value in start]
+    report["elapsed"] = round(time.perf_counter() - start_time, 4)
+    if trace:
+        report["trajectory"] = trajectory
+    return parameters, report
+
+
+def start_scale(start):
+    """Scale of the optimized parameters, so that k, in the hundreds, and the exponents,
+    below one, take steps of the same size."""
+    return np.where(start != 0, np.abs(start), 1)
+
+
+def fit_failed(parameters, report):
+    """Return True when a fit ended on non-finite parameters or objective. A fit stopped by
+    its budget or deadline is not a failure; another start would be stopped as well."""
+    if report["stopped"]:
+        return False
+    return not (np.all(np.isfinite(parameters)) and np.isfinite(report["objective"]))
+
+
+def optimize_parameters(matrix, condition, trace=False, deadline=None, max_evaluations=MAX_FUNCTION_EVALUATIONS,
+                        initial_guess=None):
     """Optimizes the parameters of the Ven Te Chow equation for a given condition.
     Parameters:
-    df (pandas.DataFrame): The DataFrame containing the rainfall data.
+    matrix (dict): The intensity matrix from 'intensity_matrix'.
     condition (int): The condition to optimize for. This should be 1 for time durations between 5 and 60 minutes, and 2 for other time durations.
-    Returns: A tuple containing the optimized parameters (k, m, c, n)."""
-    df_condition = df[df['condition'] == condition]
-
-    result = minimize(
-        objective_function,
-        INITIAL_GUESS,
-        args=(df_condition),
-        method="BFGS"
-    )
-    k_opt, m_opt, c_opt, n_opt = result.x
-    return k_opt.round(4), m_opt.round(4), c_opt.round(4), n_opt.round(4)
-
-
-def objective_function(parameters, df):
+    trace (bool): Record the objective value at the end of every iteration.
+    deadline (float): Time ('time.time()') after which the fit is stopped.
+    max_evaluations (int): Evaluations of the objective, per start, after which the fit is stopped.
+    initial_guess (tuple): Parameters to start from, such as those of a neighbouring fit.
+    Otherwise the optimizer starts from the log-linear least squares fit of
+    'log_linear_initial_guess', on the parameters divided by it (see 'start_scale'). The
+    fixed INITIAL_GUESS is only used when that start cannot be computed or its fit fails.
+    When stopped, the best parameters evaluated so far are returned, with 'converged'
+    false and 'stopped' set to 'deadline' or 'evaluations' in the report.
+    Returns: A tuple containing the optimized parameters (k, m, c, n) and a dictionary
+    with the optimizer telemetry (iterations, evaluations, convergence and time spent)."""
+    points = condition_points(matrix, condition)
+    if initial_guess is not None:
+        initial_guess = np.asarray(initial_guess, dtype=float)
+        parameters, report = fit_from_start(points, initial_guess, start_scale(initial_guess), trace, deadline,
+                                            max_evaluations)
+    else:
+        try:
+            with np.errstate(divide="ignore", invalid="ignore"):
+                log_linear_guess = log_linear_initial_guess(*points)
+        except (ValueError, np.linalg.LinAlgError):
+            # e.g. zero intensities, whose logarithm is not finite
+            log_linear_guess = None
+        parameters, report = None, None
+        if log_linear_guess is not None and np.all(np.isfinite(log_linear_guess)):
+            parameters, report = fit_from_start(points, log_linear_guess, start_scale(log_linear_guess), trace,
+                                                deadline, max_evaluations)
+        if report is None or fit_failed(parameters, report):
+            parameters, report = fit_from_start(points, np.asarray(INITIAL_GUESS, dtype=float), np.ones(4), trace,
+                                                deadline, max_evaluations)
+
+    k_opt, m_opt, c_opt, n_opt = parameters
+    return (k_opt.round(4), m_opt.round(4), c_opt.round(4), n_opt.round(4)), report
+
+
+def objective_function(parameters, tr, td, i_real):
     """Defines the objective function for optimization."""
-    df_temp = df.copy()
-    k, m, c, n = parameters
-    df_temp["i_calculated"] = calculate_i(df_temp, parameters)
-    df_temp = add_relative_error(df_temp)
-    return df_temp["relative_error"].sum()
-
-
-def recalculate_dataframe(df, parameters_1, parameters_2):
-    """Recalculates the DataFrame with the optimal parameters found."""
-    df_temp = df.copy()
-    df_temp["i_calculated"] = df_temp.apply(
-        lambda row: calculate_i(
-            row, parameters_1) if row["condition"] == 1 else calculate_i(row, parameters_2),
-        axis=1
-    )
-    df_temp = add_relative_error(df_temp)
-
-    df_interval_1 = df_temp[df_temp["condition"] == 1]
-    df_interval_2 = df_temp[df_temp["condition"] == 2]
-    mean_relative_error_1 = df_interval_1["relative_error"].mean()
-    mean_relative_error_2 = df_interval_2["relative_error"].mean()
-    mean_relative_errors = {
-        "interval_1": mean_relative_error_1,
-        "interval_2": mean_relative_error_2
-    }
-    return mean_relative_errors, df_temp
-
-
-def add_relative_error(df):
-    """Adds a column to the DataFrame with the relative error."""
-    df["relative_error"] = abs(
-        (df["i_calculated"] - df["i_real"]) / df["i_real"]) * 100
-    return df
+    return relative_error(calculate_i(tr, td, parameters), i_real).sum()
 
 
-def ns_coefficient(df, condition):
-    df_interval = df[df["condition"] == condition]
-    i_real_mean = df_interval["i_real"].mean()
-
-    term1 = 0
-    term2 = 0
-
-    for index, row in df_interval.iterrows():
-        term1 += ((row["i_real"] - row["i_calculated"])**2)
-        term2 += (row["i_real"] - i_real_mean)**2
-
-    ns = 1 - term1/term2
-
-    return ns
+def ns_coefficient(i_real, i_calculated):
+    """Nash-Sutcliffe efficiency of the estimated intensities."""
+    term1 = np.sum((i_real - i_calculated) ** 2)
+    term2 = np.sum((i_real - i_real.mean()) ** 2)
+    return 1 - term1 / term2
 
 
 def calculate_linear_regression(i_real, i_calculated):
-    model = LinearRegression()
-
-    model.fit(i_real, i_calculated)
-
-    slope = model.coef_[0]
-    intercept = model.intercept_
-
+    """Least squares line of the estimated against the observed intensities.
+    Returns:
+        tuple: The slope and the intercept.
+    """
+    i_real_deviation = i_real - i_real.mean()
+    slope = (i_real_deviation * (i_calculated - i_calculated.mean())).sum() / (i_real_deviation ** 2).sum()
+    intercept = i_calculated.mean() - slope * i_real.mean()
     return slope, intercept
 
 
@@ -189,49 +267,57 @@ def handle_dist_name(dist_r2):
 
 
 def main(distribution_data, k_coefficient_data, disaggregation_data,
-         params, time_interval, dist_r2, empty_consistent_data, year_range, empty_years):
-    """Main function to calculate optimal parameters and recalculate the DataFrame."""
+         params, time_interval, dist_r2, empty_consistent_data, year_range, empty_years,
+         optimal_parameters=None, trace=False, metrics=None, deadline=None, models=None):
+    """Main function to calculate optimal parameters and the goodness of fit of the IDF.
+    When 'optimal_parameters' holds the (k, m, c, n) tuples of both conditions,
+    e.g. from a cached fit, the optimization is skipped and the output has no
+    optimizer telemetry. 'trace' records the objective trajectory of each fit.
+    The fits of both conditions are independent and run concurrently, each one
+    stopping at the 'deadline' of the request (see 'optimize_parameters').
+    When 'models' lists IDF equation families of 'idf_models', they are fitted to the
+    same intensities and compared under 'models'."""
 
     idf_data = rain_intensity_calculations(
         k_coefficient_data, disaggregation_data, params, time_interval, dist_r2)
     
-    transformed_df = transform_dataframe(
-        idf_data, time_interval)
-    
-
-    transformed_df = add_condition(transformed_df)
-
-    transformed_df = apply_i_calculated(
-        transformed_df, INITIAL_GUESS, INITIAL_GUESS)
-
-    transformed_df = add_relative_error(transformed_df)
-
-    k_opt1, m_opt1, c_opt1, n_opt1 = optimize_parameters(transformed_df, 1)
-    k_opt2, m_opt2, c_opt2, n_opt2 = optimize_parameters(transformed_df, 2)
-
-    mean_relative_errors, transformed_df = recalculate_dataframe(
-        transformed_df, (k_opt1, m_opt1, c_opt1, n_opt1), (k_opt2, m_opt2, c_opt2, n_opt2))
-
-    ns_parameter_1 = ns_coefficient(transformed_df, 1)
-    ns_parameter_2 = ns_coefficient(transformed_df, 2)
+    matrix = intensity_matrix(idf_data, time_interval)
+
+    optimization = None
+    if optimal_parameters is None:
+        graph_name = "ventechow_" + dist_r2["max_dist"]
+        fits = run_graph({
+            graph_name + "_condition_1": (partial(optimize_parameters, matrix, 1, trace, deadline), []),
+            graph_name + "_condition_2": (partial(optimize_parameters, matrix, 2, trace, deadline), [])
+        }, graph_name, metrics, executor_type=CPU_EXECUTOR)
+        parameters_1, report_1 = fits[graph_name + "_condition_1"]
+        parameters_2, report_2 = fits[graph_name + "_condition_2"]
+        optimal_parameters = (parameters_1, parameters_2)
+        optimization = {
+            "condition_1": report_1,
+            "condition_2": report_2
+        }
+
+    (k_opt1, m_opt1, c_opt1, n_opt1), (k_opt2, m_opt2, c_opt2, n_opt2) = optimal_parameters
+
+    intervals = {}
+    for condition, parameters in ((1, optimal_parameters[0]), (2, optimal_parameters[1])):
+        tr, td, i_real = condition_points(matrix, condition)
+        i_calculated = calculate_i(tr, td, parameters)
+        intervals[condition] = {
+            "i_real": i_real,
+            "i_calculated": i_calculated,
+            "mean_relative_error": relative_error(i_calculated, i_real).mean(),
+            "ns": ns_coefficient(i_real, i_calculated),
+            "regression": calculate_linear_regression(i_real, i_calculated)
+        }
 
+    mean_relative_errors = {
+        "interval_1": intervals[1]["mean_relative_error"],
+        "interval_2": intervals[2]["mean_relative_error"]
+    }
     chosen_dist = handle_dist_name(dist_r2)
 
-    df_interval_1 = transformed_df[transformed_df["condition"] == 1]
-    df_interval_2 = transformed_df[transformed_df["condition"] == 2]
-
-    df_interval_1['i_calculated'] = df_interval_1['i_calculated'].apply(lambda x: x.item())
-    df_interval_2['i_calculated'] = df_interval_2['i_calculated'].apply(lambda x: x.item())
-
-    i_real_1 = df_interval_1["i_real"].values.reshape(-1, 1)
-    i_calculated_1 = df_interval_1["i_calculated"].values
-
-    i_real_2 = df_interval_2["i_real"].values.reshape(-1, 1)
-    i_calculated_2 = df_interval_2["i_calculated"].values
-
-    slope_interval_1, intercept_interval_1 = calculate_linear_regression(i_real_1, i_calculated_1)
-    slope_interval_2, intercept_interval_2 = calculate_linear_regression(i_real_2, i_calculated_2)
-
     output = {
         "graph_data": {
             "F": (100*distribution_data["F"]).tolist(),
@@ -239,19 +325,19 @@ def main(distribution_data, k_coefficient_data, disaggregation_data,
             "P_dist": distribution_data["P_" + dist_r2["max_dist"]].tolist()[::-1],
         },
         "intensity_graph_data_1": {
-            "i_real": df_interval_1["i_real"].sort_values(ascending=True).tolist(),
-            "i_calculated": df_interval_1["i_calculated"].sort_values(ascending=True).tolist(),
+            "i_real": np.sort(intervals[1]["i_real"]).tolist(),
+            "i_calculated": np.sort(intervals[1]["i_calculated"]).tolist(),
             "regression": {
-                "slope": slope_interval_1,
-                "intercept": intercept_interval_1,
+                "slope": intervals[1]["regression"][0],
+                "intercept": intervals[1]["regression"][1],
             },
         },
         "intensity_graph_data_2": {
-            "i_real": df_interval_2["i_real"].sort_values(ascending=True).tolist(),
-            "i_calculated": df_interval_2["i_calculated"].sort_values(ascending=True).tolist(),
+            "i_real": np.sort(intervals[2]["i_real"]).tolist(),
+            "i_calculated": np.sort(intervals[2]["i_calculated"]).tolist(),
             "regression": {
-                "slope": slope_interval_2,
-                "intercept": intercept_interval_2,
+                "slope": intervals[2]["regression"][0],
+                "intercept": intervals[2]["regression"][1],
             },
         },
         "parameters": {
@@ -274,13 +360,20 @@ def main(distribution_data, k_coefficient_data, disaggregation_data,
         "year_range": year_range,
         "dist": chosen_dist,
         "ns": {
-            "parameter_1": ns_parameter_1,
-            "parameter_2": ns_parameter_2
+            "parameter_1": intervals[1]["ns"],
+            "parameter_2": intervals[2]["ns"]
         },
-        "empty_years": empty_years
+        "empty_years": empty_years,
+        "optimization": optimization
     }
 
-    pp = pprint.PrettyPrinter(indent=4)
-    pp.pprint(output)
+    if models:
+        tr, td = np.meshgrid(matrix["tr"], matrix["td"], indexing="ij")
+        output["models"] = compare_models(tr.ravel(), td.ravel(), matrix["i_real"].ravel(), models, {"ven_te_chow": optimal_parameters},
+                                          metrics, deadline)
+
+    # Formatting the whole output is costly, so it is only done when debugging
+    if logger.isEnabledFor(logging.DEBUG):
+        logger.debug("Ven Te Chow output:\n%s", pprint.pformat(output, indent=4))
     
     return output
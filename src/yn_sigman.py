@@ -1,46 +1,90 @@
-def yn_sigman():
-    sigman = {
-        1: 0.0000, 2: 0.4984, 3: 0.6435, 4: 0.7315, 5: 0.7928, 6: 0.8388, 7: 0.8749, 8: 0.9043, 9: 0.9288,
-        10: 0.9496, 11: 0.9676, 12: 0.9833, 13: 0.9971, 14: 1.0095, 15: 1.0206, 16: 1.0306, 17: 1.0397,
-        18: 1.0481, 19: 1.0557, 20: 1.0628, 21: 1.0694, 22: 1.0755, 23: 1.0812, 24: 1.0865, 25: 1.0914,
-        26: 1.0961, 27: 1.1005, 28: 1.1047, 29: 1.1086, 30: 1.1124, 31: 1.1159, 32: 1.1193, 33: 1.1225,
-        34: 1.1256, 35: 1.1285, 36: 1.1313, 37: 1.1339, 38: 1.1365, 39: 1.1390, 40: 1.1413, 41: 1.1436,
-        42: 1.1458, 43: 1.1479, 44: 1.1499, 45: 1.1518, 46: 1.1537, 47: 1.1555, 48: 1.1573, 49: 1.1590,
-        50: 1.1607, 51: 1.1623, 52: 1.1638, 53: 1.1653, 54: 1.1668, 55: 1.1682, 56: 1.1695, 57: 1.1709,
-        58: 1.1722, 59: 1.1734, 60: 1.1747, 61: 1.1759, 62: 1.1770, 63: 1.1782, 64: 1.1793, 65: 1.1803,
-        66: 1.1814, 67: 1.1824, 68: 1.1834, 69: 1.1844, 70: 1.1854, 71: 1.1863, 72: 1.1872, 73: 1.1881,
-        74: 1.1890, 75: 1.1898, 76: 1.1907, 77: 1.1915, 78: 1.1923, 79: 1.1931, 80: 1.1938, 81: 1.1946,
-        82: 1.1953, 83: 1.1960, 84: 1.1967, 85: 1.1974, 86: 1.1981, 87: 1.1988, 88: 1.1995, 89: 1.2001,
-        90: 1.2007, 91: 1.2014, 92: 1.2020, 93: 1.2026, 94: 1.2032, 95: 1.2037, 96: 1.2043, 97: 1.2049,
-        98: 1.2054, 99: 1.2060, 100: 1.2065, 101: 1.2070, 102: 1.2075, 103: 1.2080, 104: 1.2085, 105: 1.2090,
-        106: 1.2095, 107: 1.2100, 108: 1.2105, 109: 1.2109, 110: 1.2114, 111: 1.2118, 112: 1.2123, 113: 1.2127,
-        114: 1.2131, 115: 1.2136, 116: 1.2140, 117: 1.2144, 118: 1.2148, 119: 1.2152, 120: 1.2156, 121: 1.2160,
-        122: 1.2164, 123: 1.2167, 124: 1.2171, 125: 1.2175, 126: 1.2178, 127: 1.2182, 128: 1.2186, 129: 1.2189,
-        130: 1.2192, 131: 1.2196, 132: 1.2199, 133: 1.2203, 134: 1.2206, 135: 1.2209, 136: 1.2212, 137: 1.2215,
-        138: 1.2219, 139: 1.2222, 140: 1.2225, 141: 1.2228, 142: 1.2231, 143: 1.2234, 144: 1.2237, 145: 1.2239,
-        146: 1.2242, 147: 1.2245, 148: 1.2248, 149: 1.2251, 150: 1.2253
-    }
-
-    yn = {
-        1: 0.3665, 2: 0.4043, 3: 0.4286, 4: 0.4458, 5: 0.4588, 6: 0.4690, 7: 0.4774, 8: 0.4843, 9: 0.4902,
-        10: 0.4952, 11: 0.4996, 12: 0.5035, 13: 0.5070, 14: 0.5100, 15: 0.5128, 16: 0.5154, 17: 0.5177,
-        18: 0.5198, 19: 0.5217, 20: 0.5236, 21: 0.5252, 22: 0.5268, 23: 0.5282, 24: 0.5296, 25: 0.5309,
-        26: 0.5321, 27: 0.5332, 28: 0.5343, 29: 0.5353, 30: 0.5362, 31: 0.5371, 32: 0.5380, 33: 0.5388,
-        34: 0.5396, 35: 0.5403, 36: 0.5411, 37: 0.5417, 38: 0.5424, 39: 0.5430, 40: 0.5436, 41: 0.5442,
-        42: 0.5448, 43: 0.5453, 44: 0.5458, 45: 0.5463, 46: 0.5468, 47: 0.5472, 48: 0.5477, 49: 0.5481,
-        50: 0.5485, 51: 0.5489, 52: 0.5493, 53: 0.5497, 54: 0.5501, 55: 0.5504, 56: 0.5508, 57: 0.5511,
-        58: 0.5515, 59: 0.5518, 60: 0.5521, 61: 0.5524, 62: 0.5527, 63: 0.5530, 64: 0.5532, 65: 0.5535,
-        66: 0.5538, 67: 0.5540, 68: 0.5543, 69: 0.5545, 70: 0.5548, 71: 0.5550, 72: 0.5552, 73: 0.5555,
-        74: 0.5557, 75: 0.5559, 76: 0.5561, 77: 0.5563, 78: 0.5565, 79: 0.5567, 80: 0.5569, 81: 0.5571,
-        82: 0.5573, 83: 0.5574, 84: 0.5576, 85: 0.5578, 86: 0.5580, 87: 0.5581, 88: 0.5583, 89: 0.5584,
-        90: 0.5586, 91: 0.5588, 92: 0.5589, 93: 0.5591, 94: 0.5592, 95: 0.5593, 96: 0.5595, 97: 0.5596,
-        98: 0.5598, 99: 0.5599, 100: 0.5600, 101: 0.5602, 102: 0.5603, 103: 0.5604, 104: 0.5605, 105: 0.5606,
-        106: 0.5608, 107: 0.5609, 108: 0.5610, 109: 0.5611, 110: 0.5612, 111: 0.5613, 112: 0.5614, 113: 0.5615,
-        114: 0.5617, 115: 0.5618, 116: 0.5619, 117: 0.5620, 118: 0.5621, 119: 0.5622, 120: 0.5623, 121: 0.5623,
-        122: 0.5624, 123: 0.5625, 124: 0.5626, 125: 0.5627, 126: 0.5628, 127: 0.5629, 128: 0.5630, 129: 0.5631,
-        130: 0.5631, 131: 0.5632, 132: 0.5633, 133: 0.5634, 134: 0.5635, 135: 0.5635, 136: 0.5636, 137: 0.5637,
-        138: 0.5638, 139: 0.5639, 140: 0.5639, 141: 0.5640, 142: 0.5641, 143: 0.5641, 144: 0.5642, 145: 0.5643,
-        146: 0.5643, 147: 0.5644, 148: 0.5645, 149: 0.5646, 150: 0.5646
-    }
+from functools import lru_cache
 
+import numpy as np
+
+# Mean (yn) and standard deviation (sigman) of the Gumbel reduced variate of a
+# sample, indexed by the sample size, ten values per line
+YN_VALUES = np.array([
+    np.nan, 0.3665, 0.4043, 0.4286, 0.4458, 0.4588, 0.4690, 0.4774, 0.4843, 0.4902,
+    0.4952, 0.4996, 0.5035, 0.5070, 0.5100, 0.5128, 0.5154, 0.5177, 0.5198, 0.5217,
+    0.5236, 0.5252, 0.5268, 0.5282, 0.5296, 0.5309, 0.5321, 0.5332, 0.5343, 0.5353,
+    0.5362, 0.5371, 0.5380, 0.5388, 0.5396, 0.5403, 0.5411, 0.5417, 0.5424, 0.5430,
+    0.5436, 0.5442, 0.5448, 0.5453, 0.5458, 0.5463, 0.5468, 0.5472, 0.5477, 0.5481,
+    0.5485, 0.5489, 0.5493, 0.5497, 0.5501, 0.5504, 0.5508, 0.5511, 0.5515, 0.5518,
+    0.5521, 0.5524, 0.5527, 0.5530, 0.5532, 0.5535, 0.5538, 0.5540, 0.5543, 0.5545,
+    0.5548, 0.5550, 0.5552, 0.5555, 0.5557, 0.5559, 0.5561, 0.5563, 0.5565, 0.5567,
+    0.5569, 0.5571, 0.5573, 0.5574, 0.5576, 0.5578, 0.5580, 0.5581, 0.5583, 0.5584,
+    0.5586, 0.5588, 0.5589, 0.5591, 0.5592, 0.5593, 0.5595, 0.5596, 0.5598, 0.5599,
+    0.5600, 0.5602, 0.5603, 0.5604, 0.5605, 0.5606, 0.5608, 0.5609, 0.5610, 0.5611,
+    0.5612, 0.5613, 0.5614, 0.5615, 0.5617, 0.5618, 0.5619, 0.5620, 0.5621, 0.5622,
+    0.5623, 0.5623, 0.5624, 0.5625, 0.5626, 0.5627, 0.5628, 0.5629, 0.5630, 0.5631,
+    0.5631, 0.5632, 0.5633, 0.5634, 0.5635, 0.5635, 0.5636, 0.5637, 0.5638, 0.5639,
+    0.5639, 0.5640, 0.5641, 0.5641, 0.5642, 0.5643, 0.5643, 0.5644, 0.5645, 0.5646,
+    0.5646
+])
+
+SIGMAN_VALUES = np.array([
+    np.nan, 0.0000, 0.4984, 0.6435, 0.7315, 0.7928, 0.8388, 0.8749, 0.9043, 0.9288,
+    0.9496, 0.9676, 0.9833, 0.9971, 1.0095, 1.0206, 1.0306, 1.0397, 1.0481, 1.0557,
+    1.0628, 1.0694, 1.0755, 1.0812, 1.0865, 1.0914, 1.0961, 1.1005, 1.1047, 1.1086,
+    1.1124, 1.1159, 1.1193, 1.1225, 1.1256, 1.1285, 1.1313, 1.1339, 1.1365, 1.1390,
+    1.1413, 1.1436, 1.1458, 1.1479, 1.1499, 1.1518, 1.1537, 1.1555, 1.1573, 1.1590,
+    1.1607, 1.1623, 1.1638, 1.1653, 1.1668, 1.1682, 1.1695, 1.1709, 1.1722, 1.1734,
+    1.1747, 1.1759, 1.1770, 1.1782, 1.1793, 1.1803, 1.1814, 1.1824, 1.1834, 1.1844,
+    1.1854, 1.1863, 1.1872, 1.1881, 1.1890, 1.1898, 1.1907, 1.1915, 1.1923, 1.1931,
+    1.1938, 1.1946, 1.1953, 1.1960, 1.1967, 1.1974, 1.1981, 1.1988, 1.1995, 1.2001,
+    1.2007, 1.2014, 1.2020, 1.2026, 1.2032, 1.2037, 1.2043, 1.2049, 1.2054, 1.2060,
+    1.2065, 1.2070, 1.2075, 1.2080, 1.2085, 1.2090, 1.2095, 1.2100, 1.2105, 1.2109,
+    1.2114, 1.2118, 1.2123, 1.2127, 1.2131, 1.2136, 1.2140, 1.2144, 1.2148, 1.2152,
+    1.2156, 1.2160, 1.2164, 1.2167, 1.2171, 1.2175, 1.2178, 1.2182, 1.2186, 1.2189,
+    1.2192, 1.2196, 1.2199, 1.2203, 1.2206, 1.2209, 1.2212, 1.2215, 1.2219, 1.2222,
+    1.2225, 1.2228, 1.2231, 1.2234, 1.2237, 1.2239, 1.2242, 1.2245, 1.2248, 1.2251,
+    1.2253
+])
+YN_SIGMAN_TABULATED_SIZE = YN_VALUES.size - 1
+# Sizes above the table whose formula values are kept
+FORMULA_CACHE_SIZE = 1024
+
+
+@lru_cache(maxsize=FORMULA_CACHE_SIZE)
+def yn_sigman_formula(sample_size):
+    """Compute yn and sigman from the reduced variates -ln(-ln(i / (n + 1))), i = 1..n."""
+    reduced_variate = -np.log(-np.log(np.arange(1, sample_size + 1) / (sample_size + 1)))
+    return float(reduced_variate.mean()), float(reduced_variate.std())
+
+
+def yn_sigman_values(sample_size):
+    """Return yn and sigman for a sample size or an array of sample sizes.
+    Sizes up to 150 come from the table; larger ones are computed once with the formula
+    the table was built from and then kept by 'yn_sigman_formula'.
+    Args:
+        sample_size (int or array): The size of the sample(s), at least 1.
+    Returns:
+        tuple: yn and sigman, as floats or arrays shaped like 'sample_size'.
+    """
+    if isinstance(sample_size, (int, np.integer)):
+        if sample_size < 1:
+            raise ValueError("The sample size must be at least 1.")
+        if sample_size <= YN_SIGMAN_TABULATED_SIZE:
+            return float(YN_VALUES[sample_size]), float(SIGMAN_VALUES[sample_size])
+        return yn_sigman_formula(int(sample_size))
+
+    sizes = np.asarray(sample_size)
+    if np.any(sizes < 1):
+        raise ValueError("The sample size must be at least 1.")
+    if sizes.ndim == 0:
+        return yn_sigman_values(int(sizes))
+
+    if np.all(sizes <= YN_SIGMAN_TABULATED_SIZE):
+        yn, sigman = YN_VALUES[sizes], SIGMAN_VALUES[sizes]
+    else:
+        unique_sizes, inverse = np.unique(sizes, return_inverse=True)
+        values = np.array([
+            (YN_VALUES[size], SIGMAN_VALUES[size]) if size <= YN_SIGMAN_TABULATED_SIZE
+            else yn_sigman_formula(int(size))
+            for size in unique_sizes
+        ])
+        yn = values[inverse, 0].reshape(sizes.shape)
+        sigman = values[inverse, 1].reshape(sizes.shape)
     return yn, sigman
+
@@ -0,0 +1,5 @@
+import os
+import sys
+
+# The modules of src import each other by their top-level names
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), "..", "src"))
@@ -0,0 +1,32 @@
+import os
+
+import regression_gate
+
+# Set to also compare the stage timings, which only hold on the machine that recorded them
+TIMINGS_ENV = "IDF_GATE_TIMINGS"
+
+
+def test_optimizer_work_may_only_shrink():
+    golden = {"optimization": {"condition_1": {"iterations": 10, "function_evaluations": 100,
+                                               "objective": 1.0, "message": "a"}}}
+
+    def with_work(iterations, function_evaluations):
+        return {"optimization": {"condition_1": {"iterations": iterations, "function_evaluations": function_evaluations,
+                                                 "objective": 1.0, "message": "b"}}}
+
+    assert regression_gate.compare(golden, with_work(5, 50)) == []
+    assert regression_gate.compare(golden, with_work(12, 120)) == []
+    assert regression_gate.compare(golden, with_work(10, 121)) == [
+        ("/optimization/condition_1/function_evaluations", 100, 121)]
+
+
+def test_accepted_changes_replace_golden_keys():
+    golden = {"a.csv": {"parameters": 1, "ns": 2}}
+    accepted = {"user-1": {"reason": "", "outputs": {"a.csv": {"parameters": 3, "trend": 4}}}}
+    assert regression_gate.expected_outputs(golden, accepted) == {"a.csv": {"parameters": 3, "ns": 2, "trend": 4}}
+    assert golden == {"a.csv": {"parameters": 1, "ns": 2}}
+
+
+def test_corpus_matches_golden_outputs():
+    result = regression_gate.check(skip_timings=not os.environ.get(TIMINGS_ENV))
+    assert result["passed"], {key: result[key] for key in ("output_differences", "regressed_stages")}
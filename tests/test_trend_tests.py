@@ -0,0 +1,72 @@
+import math
+
+import numpy as np
+import pandas as pd
+import pytest
+from scipy.stats import norm
+
+import trend_tests
+
+
+def sign(value):
+    return (value > 0) - (value < 0)
+
+
+def loop_tests(values, years):
+    """Straightforward loop versions of the Mann-Kendall, Sen's slope and Pettitt tests."""
+    n = len(values)
+    s = sum(sign(values[j] - values[i]) for i in range(n) for j in range(i + 1, n))
+    ties = [values.count(value) for value in set(values)]
+    variance = (n * (n - 1) * (2 * n + 5) - sum(t * (t - 1) * (2 * t + 5) for t in ties)) / 18
+    z = (s - 1) / math.sqrt(variance) if s > 0 else (s + 1) / math.sqrt(variance) if s < 0 else 0.0
+
+    slopes = [(values[j] - values[i]) / (years[j] - years[i]) for i in range(n) for j in range(i + 1, n)]
+
+    u = [abs(sum(sign(values[i] - values[j]) for i in range(t + 1) for j in range(t + 1, n))) for t in range(n - 1)]
+    k = max(u)
+    return {
+        "S": s,
+        "variance": variance,
+        "z": z,
+        "p_value": 2 * norm.sf(abs(z)),
+        "tau": s / (n * (n - 1) / 2),
+        "sen_slope": float(np.median(slopes)),
+        "K": k,
+        "pettitt_p_value": min(2 * math.exp(-6.0 * k ** 2 / (n ** 3 + n ** 2)), 1),
+        "change_year": years[u.index(k)]
+    }
+
+
+def test_matches_loop_implementations():
+    rng = np.random.default_rng(0)
+    stations, columns = 40, 35
+    # Rounded values give ties; missing years give gaps of different lengths
+    values = rng.gamma(4.0, 20.0, (stations, columns)).round(0)
+    mask = rng.random((stations, columns)) > 0.25
+    mask[0, :] = True
+    mask[1, 3:] = False
+    years = np.arange(1970, 1970 + columns)
+
+    result = trend_tests.main(values, mask, years)
+    for station in range(stations):
+        station_values = values[station, mask[station]].tolist()
+        station_years = years[mask[station]].tolist()
+        assert result["sample_size"][station] == len(station_values)
+        assert result["valid"][station] == (len(station_values) >= trend_tests.MIN_SAMPLE_SIZE)
+        if not result["valid"][station]:
+            continue
+
+        expected = loop_tests(station_values, station_years)
+        for key in ("S", "variance", "z", "p_value", "tau"):
+            assert result["mann_kendall"][key][station] == pytest.approx(expected[key], rel=1e-12, abs=1e-12)
+        assert result["sen_slope"][station] == pytest.approx(expected["sen_slope"], rel=1e-12)
+        assert result["pettitt"]["K"][station] == expected["K"]
+        assert result["pettitt"]["p_value"][station] == pytest.approx(expected["pettitt_p_value"], rel=1e-12)
+        assert result["pettitt"]["change_year"][station] == expected["change_year"]
+
+
+def test_empty_series_are_invalid():
+    result = trend_tests.main(np.zeros((3, 0)))
+    assert result["sample_size"].tolist() == [0, 0, 0]
+    assert not result["valid"].any()
+    assert trend_tests.annual_maxima_tests(pd.DataFrame({"AnoHidrologico": [], "Pmax_anual": []})) is None